@@ -1,5 +1,5 @@
 import logging
-import random
+import os
 import threading
 import time
 import uuid
@@ -10,22 +10,50 @@ from typing import List
 import pytz
 import telegram
 from fastapi import (BackgroundTasks, Depends, FastAPI, File, Header,
-                     HTTPException, Path, Query, UploadFile)
+                     HTTPException, Path, Query, Request, Response, UploadFile)
 from fastapi.background import BackgroundTasks
-from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from openpyxl import load_workbook
 from pydantic import BaseModel
-from sqlalchemy import (Boolean, Column, DateTime, Integer, Sequence, String,
-                        create_engine, desc, distinct, inspect, true)
+from sqlalchemy import (Boolean, Column, DateTime, Index, Integer, Sequence,
+                        String, create_engine, desc, distinct, func, inspect,
+                        or_, text, true)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Session, sessionmaker
 from sqlalchemy.sql.expression import false
+from starlette.background import BackgroundTask
 from telegram import (InlineKeyboardButton, InlineKeyboardMarkup,
                       ReplyKeyboardMarkup, ReplyKeyboardRemove, Update)
 from telegram.ext import (CallbackContext, CallbackQueryHandler,
                           CommandHandler, ContextTypes, ConversationHandler,
                           Filters, MessageHandler, Updater, filters)
 
+import account_cache
+import account_stripes
+import api_keys
+import broadcast
+import callback_guard
+import delta_sync
+import exports
+import exposure
+import graphql_resolver
+import isnad_codes
+import load_shedding
+import media_cache
+import rate_limit
+import prefetch
+import recorder
+import search
+import send_budget
+import status_refresh
+import task_sampler
+import tracing
+import tweet_urls
+import twitter_scheduler
+import user_dispatch
+
 # configure the log format
 formatter  = logging.Formatter('%(asctime)s - %(message)s')
 
@@ -68,15 +96,37 @@ Access to these services is protected by an API key mechanism. Users must provid
 
 **How to Use:**
  
-- To upload target users: Use the `/upload-target-accounts/` endpoint, ensuring the provided API key is valid.
+- To upload target users: Use the `/upload-target-accounts/` endpoint, ensuring the provided API key is valid. For daily re-uploads of mostly the same sheet, pass `mode=delta` to write only the new and changed accounts (and, with `remove_missing=true`, delete the ones no longer in the sheet).
+
+- To upload excel file of Isnad tasks: Use the `/upload-isnad-tasks/` endpoint, providing an excel sheet of the accounts details and ensuring the provided API key is valid. Tweets listed twice, under any form of their link, or already uploaded in an earlier batch are skipped (pass `allow_repeats=true` to keep the latter); the tweets of the batch being replaced are kept.
+
+- To check Target Account Details: Access the `/get-target-account-details/` specifying the account name and providing the API key for authentication. To look up many accounts at once, use `/get-target-account-details/batch/` with one `account_names` parameter per name. Both return an `ETag`; send it back in `If-None-Match` to get a `304 Not Modified` when nothing changed.
+
+- To list Target Accounts or Isnad Tasks: Access `/target-accounts/` or `/isnad-tasks/`, optionally filtered. Pages are chained with keyset pagination: pass the `next_after_id` of a page as `after_id` to get the next one.
 
-- To upload excel file of Isnad tasks: Use the `/upload-isnad-tasks/` endpoint, providing an excel sheet of the accounts details and ensuring the provided API key is valid.
+- To export Target Accounts or Isnad Tasks: Access `/target-accounts/export/` or `/isnad-tasks/export/` with `format` `csv` or `xlsx` and the same filters. The columns are those of the upload sheets, so an export can be uploaded back.
 
-- To check Target Account Details: Access the `/get-target-account-details/` specifying the account name and providing the API key for authentication.
+- To search Target Accounts: Access the `/search-target-accounts/` with part of an account name or link handle (case-insensitive, typos tolerated), optionally filtered by category and type.
+
+- To attach images or videos to tasks: Use the `/batch-media/` endpoints. The media are sent with every task of the batch, and uploaded to Telegram only once.
+
+- To notify every Isnad user, e.g. of a new batch of tasks: Use the `/broadcasts/` endpoints with the admin API key. A broadcast runs in the background, resumes after a restart and reports its send rate and ETA.
 
 - To check User Membership: Access the `/check-membership/` specifying the JSON object using isnad_code of the user and providing the API key for authentication.
 
 - To display logs: Access the `/logs/` endpoint.
+
+- To manage API keys: Use the `/api-keys/` endpoints with the admin API key. New and revoked keys take effect without a restart.
+
+- To check your API usage: Access the `/usage/` endpoint with your API key. Every API key has a budget per endpoint (500 requests per 15 minutes by default, adjustable per key with the admin `/rate-limits/` endpoint); requests over it get a `429` response with a `Retry-After` header.
+
+- To check the bot's own Twitter budget: Access the `/twitter-budget/` endpoint with the admin API key to see, per operation, the requests left in the current 15-minute window and how long the queued checks will take to go out.
+
+- To check the account status refresh: Access the `/account-status-refresh/` endpoint with the admin API key. When Twitter credentials are set, target account statuses are re-checked on Twitter in the background, and accounts found suspended or deleted on two checks in a row are no longer handed out.
+
+- To check the bot's update workers: Access the `/bot-dispatcher/` endpoint with the admin API key to see the queue depth, the age of the oldest waiting update and the worker utilisation. Updates of different users are handled in parallel (`ISNAD_DISPATCH_WORKERS`, 8 by default), each user's in order. When the oldest waiting update gets too old, the bot sheds load: optional messages are skipped (after `ISNAD_SHED_SKIP_AFTER` seconds), a user's waiting taps are replaced by their latest (`ISNAD_SHED_SUPERSEDE_AFTER`), and new taps get a "busy, retry shortly" alert (`ISNAD_SHED_BUSY_AFTER`).
+
+- To check how evenly accounts and tasks are handed out: Access the `/exposure-stats/` endpoint. Every target account and task counts the times it was served: the least served accounts go first, and tasks are handed out in proportion to their priority.
  
 
 **Obtaining an API Key:**
@@ -92,8 +142,10 @@ app = FastAPI(title="Isnad Tasks Bot",
               )
 
 # SQLite database setup
-DATABASE_URL = "sqlite:///./isnadTasks.db"
+DATABASE_URL = os.getenv("ISNAD_DATABASE_URL", "sqlite:///./isnadTasks.db")
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+tracing.instrument_engine(engine)
+SessionLocal = sessionmaker(bind=engine, class_=tracing.TracedSession)
 Base = declarative_base()
 
 
@@ -102,6 +154,23 @@ class CheckMembershipRequest(BaseModel):
     isnad_code: str
 
 
+class CreateBroadcastRequest(BaseModel):
+    # None sends the default notice of a new batch
+    message: str = None
+
+
+class CreateApiKeyRequest(BaseModel):
+    name: str
+    scopes: List[str] = [api_keys.USER_SCOPE]
+
+
+class SetRateLimitRequest(BaseModel):
+    name: str
+    endpoint: str = rate_limit.ALL_ENDPOINTS
+    max_requests: int
+    window_seconds: int = rate_limit.DEFAULT_WINDOW_SECONDS
+
+
 class TargetAccount(Base):
     __tablename__ = "target_accounts"
 
@@ -114,18 +183,91 @@ class TargetAccount(Base):
     account_type = Column(String,index=True)
     publishing_level = Column(String,index=True)
     access_level = Column(String,index=True)
+    # Served at least once; the rotation goes by served_count
     is_used = Column(Boolean, default=false(),index=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # Hash of the sheet columns, set by delta uploads (see delta_sync.py)
+    row_hash = Column(Integer)
+    # Status found on Twitter, apart from the account_status of the sheet, and when it was last
+    # checked; dead_checks counts the checks in a row that found it dead (see status_refresh.py)
+    twitter_status = Column(String, index=True)
+    dead_checks = Column(Integer, default=0, server_default=text("0"))
+    status_checked_at = Column(DateTime, index=True)
+    # Times the account was handed out, and when last: the least served go first (see exposure.py)
+    served_count = Column(Integer, default=0, server_default=text("0"))
+    last_served_at = Column(DateTime)
+
+    __table_args__ = (Index("ix_target_accounts_rotation", "account_type", "served_count", "publishing_level",
+                            "access_level"),)
 
 class IsnadTasks(Base):
     __tablename__ = "isnad_tasks"
 
     id = Column(Integer, primary_key=True, index=True)
+    # Tweets are stored by tweet_id; only tasks uploaded before links were checked have a task_url
     task_url = Column(String, index=True)
     task_target_type = Column(String, index=True)
+    # Served at least once; the rotation goes by served_count
     is_used = Column(Boolean, default=false(),index=True)
     batch_id = Column(Integer, index=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+    tweet_id = Column(Integer, index=True)
+    # Weight of the task in the rotation, from the optional PRIORITY column (see task_sampler.py)
+    priority = Column(Integer, default=task_sampler.DEFAULT_PRIORITY,
+                      server_default=text(str(task_sampler.DEFAULT_PRIORITY)))
+    # Times the task was handed out, and when last (see exposure.py)
+    served_count = Column(Integer, default=0, server_default=text("0"))
+    last_served_at = Column(DateTime)
+
+    __table_args__ = (Index("ix_isnad_tasks_rotation", "batch_id", "served_count"),)
+
+    @property
+    def link(self):
+        return tweet_urls.tweet_url(self.tweet_id) if self.tweet_id is not None else self.task_url
+
+
+# Every tweet ever uploaded as a task, so a later batch does not hand it out again
+class UploadedTweet(Base):
+    __tablename__ = 'uploaded_tweets'
+
+    tweet_id = Column(Integer, primary_key=True, autoincrement=False)
+    batch_id = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+# Images and videos sent along with the tasks of a batch (see media_cache.py)
+class BatchMedia(Base):
+    __tablename__ = 'batch_media'
+
+    id = Column(Integer, primary_key=True)
+    batch_id = Column(String, index=True)
+    kind = Column(String)
+    filename = Column(String)
+    path = Column(String)
+    size = Column(Integer)
+    sha256 = Column(String, index=True)
+    # Set once the media has been sent to Telegram, later sends reuse it
+    telegram_file_id = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+# Notices sent to every Isnad user, with their progress (see broadcast.py)
+class Broadcast(Base):
+    __tablename__ = 'broadcasts'
+
+    id = Column(Integer, primary_key=True)
+    message = Column(String)
+    status = Column(String, index=True)
+    total = Column(Integer)
+    sent = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    blocked = Column(Integer, default=0)
+    # Checkpoint: the id of the last isnad_users row reached
+    last_user_id = Column(Integer)
+    error = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
 
 
 class IsnadUsers(Base):
@@ -135,6 +277,31 @@ class IsnadUsers(Base):
     telegram_user_id = Column(Integer, unique=True)
     isnad_id = Column(String, unique=True)
 
+
+class ApiKey(Base):
+    __tablename__ = 'api_keys'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, index=True)
+    # Only the SHA-256 digest of a key is stored
+    key_digest = Column(String, unique=True, index=True)
+    # Comma separated, "user" and/or "service"
+    scopes = Column(String)
+    is_active = Column(Boolean, default=true(), index=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class RateLimit(Base):
+    __tablename__ = 'rate_limits'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, index=True)
+    # An endpoint path such as "/check-membership/", or "*" for all endpoints
+    endpoint = Column(String, default=rate_limit.ALL_ENDPOINTS)
+    max_requests = Column(Integer)
+    window_seconds = Column(Integer, default=rate_limit.DEFAULT_WINDOW_SECONDS)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
 # Define a Task class to represent the tasks table in the database
 class Task(Base):
     __tablename__ = 'tasks'
@@ -146,6 +313,87 @@ class Task(Base):
 
 Base.metadata.create_all(bind=engine)
 
+
+def add_missing_columns():
+    """create_all only creates missing tables: add the columns declared since a table was created."""
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            added_columns = set()
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    # Existing rows get the server default, e.g. a served_count of 0
+                    default = f" DEFAULT {column.server_default.arg}" if column.server_default is not None else ""
+                    connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}{default}"))
+                    added_columns.add(column.name)
+            for index in table.indexes:
+                if added_columns & {column.name for column in index.columns}:
+                    index.create(connection)
+
+
+add_missing_columns()
+
+
+# The rotation counters change on every serve and are left out, so serving an account keeps its
+# cache entry and ETag
+def target_account_details(account):
+    return jsonable_encoder({
+        "account_name": account.account_name,
+        "account_id": account.account_id,
+        "account_link": account.account_link,
+        "account_status": account.account_status,
+        "twitter_status": account.twitter_status,
+        "account_category": account.account_category,
+        "account_type": account.account_type,
+        "publishing_level": account.publishing_level,
+        "access_level": account.access_level,
+        "is_used": account.is_used,
+        "created_at": account.created_at
+    })
+
+
+def load_target_account_details(account_names):
+    """Loader of the account details cache: one query for all the names missing from the cache."""
+    session = SessionLocal()
+    try:
+        details = {}
+        for account in session.query(TargetAccount).filter(TargetAccount.account_name.in_(account_names)):
+            # Like the single lookup, the first row wins when a name is duplicated
+            details.setdefault(account.account_name, target_account_details(account))
+        return details
+    finally:
+        session.close()
+
+
+account_details_cache = account_cache.AccountDetailsCache(load_target_account_details)
+# Serving an account only changes these, which the details leave out
+ACCOUNT_ROTATION_COLUMNS = ("served_count", "last_served_at")
+account_details_cache.watch(SessionLocal, TargetAccount, ignored=ACCOUNT_ROTATION_COLUMNS)
+
+
+def load_account_type_counts():
+    session = SessionLocal()
+    try:
+        return session.query(TargetAccount.account_type, func.count(TargetAccount.id)).group_by(
+            TargetAccount.account_type).all()
+    finally:
+        session.close()
+
+
+def load_searchable_accounts():
+    """Loader of the account search index."""
+    session = SessionLocal()
+    try:
+        return session.query(TargetAccount.account_name, TargetAccount.account_link,
+                             TargetAccount.account_category, TargetAccount.account_type).all()
+    finally:
+        session.close()
+
+
+account_search_index = search.AccountSearchIndex(load_searchable_accounts)
+
 # Define a dictionary to track tasks used by each user
 user_tasks = {}
 user_sessions = {}
@@ -153,8 +401,7 @@ user_sessions = {}
 
 # Function to add dummy tasks data for testing
 def add_dummy_tasks():
-    Session = sessionmaker(bind=engine)
-    session = Session()
+    session = SessionLocal()
     workbook = load_workbook('FINAL_IDs.xlsx')
     sheet = workbook.active
 
@@ -192,8 +439,7 @@ def add_dummy_tasks():
    
 
 def get_db():
-    Session = sessionmaker(bind=engine)
-    session = Session()
+    session = SessionLocal()
     try:
         yield session
     finally:
@@ -208,8 +454,7 @@ def is_database_empty():
 
     Returns a boolean indicating whether the accounts table is empty.
     """
-    Session = sessionmaker(bind=engine)
-    session = Session()
+    session = SessionLocal()
     return not session.query(TargetAccount).first()
 
 
@@ -235,8 +480,7 @@ def check_database_status():
 
 # Define a function to generate unique batch IDs
 def generate_batch_id():
-    Session = sessionmaker(bind=engine)
-    session = Session()
+    session = SessionLocal()
     # Get the maximum batch ID from the database and increment it
     max_batch_id = session.query(IsnadTasks.batch_id).order_by(IsnadTasks.batch_id.desc()).first()
     if max_batch_id is None:
@@ -279,8 +523,85 @@ services_api_key_map = {
 }
 
 
-# Dependency to get the userid based on the provided api_key
-async def get_service_api_key(api_key: str = Header(..., description="Services API key for authentication")):
+def seed_api_keys():
+    """Store the digests of the built-in key maps in the api_keys table, once."""
+    session = SessionLocal()
+    try:
+        known_digests = {digest for (digest,) in session.query(ApiKey.key_digest)}
+        built_in_keys = {}
+        for scope, key_map in ((api_keys.USER_SCOPE, user_api_key_map), (api_keys.SERVICE_SCOPE, services_api_key_map)):
+            for userid, key in key_map.items():
+                built_in_keys.setdefault(api_keys.digest_key(key), [userid, set()])[1].add(scope)
+        for digest, (userid, scopes) in built_in_keys.items():
+            if digest not in known_digests:
+                session.add(ApiKey(name=userid, key_digest=digest, scopes=",".join(sorted(scopes))))
+        session.commit()
+    finally:
+        session.close()
+
+
+def load_api_keys():
+    """Loader of the API key index: active keys of the api_keys table, plus the optional key file."""
+    session = SessionLocal()
+    try:
+        keys = [(name, digest, set(scopes.split(","))) for name, digest, scopes in
+                session.query(ApiKey.name, ApiKey.key_digest, ApiKey.scopes).filter(ApiKey.is_active == true())]
+    finally:
+        session.close()
+    return keys + api_keys.key_file_loader(os.getenv("ISNAD_API_KEYS_FILE"))
+
+
+seed_api_keys()
+api_key_index = api_keys.ApiKeyIndex(load_api_keys)
+
+
+def load_rate_limits():
+    """Loader of the rate limiter: the per-key limits of the rate_limits table."""
+    session = SessionLocal()
+    try:
+        return {(limit.name, limit.endpoint): (limit.max_requests, limit.window_seconds)
+                for limit in session.query(RateLimit).all()}
+    finally:
+        session.close()
+
+
+rate_limiter = rate_limit.RateLimiter(load_rate_limits)
+
+# One scheduler for every call to Twitter, so they all share the same 15-minute budgets
+twitter_request_scheduler = twitter_scheduler.RequestScheduler()
+twitter_resolver = graphql_resolver.GraphQLResolver(scheduler=twitter_request_scheduler)
+
+file_id_cache = media_cache.FileIdCache(SessionLocal, BatchMedia)
+
+# Minutes between two account status refreshes, 0 disables them
+STATUS_REFRESH_MINUTES = int(os.getenv("ISNAD_STATUS_REFRESH_MINUTES", status_refresh.INTERVAL_MINUTES))
+status_refresher = status_refresh.StatusRefresher(SessionLocal, TargetAccount, twitter_resolver,
+                                                  on_changed=account_details_cache.invalidate)
+
+
+def enforce_rate_limit(request: Request, response: Response, userid: str):
+    """Count the request against the budget of the userid for this endpoint, 429 once it is spent."""
+    route = request.scope.get("route")
+    endpoint = route.path if route else request.url.path
+    allowed, limit, remaining, retry_after = rate_limiter.hit(userid, endpoint)
+    if limit is None:
+        return
+    if not allowed:
+        logger.warning('Rate limit hit by UserID: ' + userid + ' on ' + endpoint)
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests, retry later",
+            headers={"Retry-After": str(retry_after), "X-RateLimit-Limit": str(limit),
+                     "X-RateLimit-Remaining": "0"},
+        )
+    response.headers["X-RateLimit-Limit"] = str(limit)
+    response.headers["X-RateLimit-Remaining"] = str(remaining)
+
+
+# Dependency to get the userid based on the provided api_key; sync, so the key and rate limit
+# reloads run on the thread pool instead of blocking the event loop
+def get_service_api_key(request: Request, response: Response,
+                        api_key: str = Header(..., description="Services API key for authentication")):
     """
     Get User ID
 
@@ -288,19 +609,21 @@ async def get_service_api_key(api_key: str = Header(..., description="Services A
 
     - **api_key**: API key for authentication.
 
-    Returns the corresponding userid.
+    Returns the corresponding userid, once the request is counted against its rate limit.
     """
-    for userid, key in services_api_key_map.items():
-        if key == api_key:
-            return userid
+    userid = api_key_index.resolve(api_key, api_keys.SERVICE_SCOPE)
+    if userid:
+        enforce_rate_limit(request, response, userid)
+        return userid
     raise HTTPException(
         status_code=401,
         detail="Invalid API key",
         headers={"WWW-Authenticate": "Bearer"},
     )
 
-# Dependency to get the userid based on the provided api_key
-async def get_api_key(api_key: str = Header(..., description="API key for authentication")):
+# Dependency to get the userid based on the provided api_key, sync for the same reason
+def get_api_key(request: Request, response: Response,
+                api_key: str = Header(..., description="API key for authentication")):
     """
     Get User ID
 
@@ -308,11 +631,12 @@ async def get_api_key(api_key: str = Header(..., description="API key for authen
 
     - **api_key**: API key for authentication.
 
-    Returns the corresponding userid.
+    Returns the corresponding userid, once the request is counted against its rate limit.
     """
-    for userid, key in user_api_key_map.items():
-        if key == api_key:
-            return userid
+    userid = api_key_index.resolve(api_key, api_keys.USER_SCOPE)
+    if userid:
+        enforce_rate_limit(request, response, userid)
+        return userid
     raise HTTPException(
         status_code=401,
         detail="Invalid API key",
@@ -364,11 +688,40 @@ def is_excel_file(file: UploadFile):
     return file
 
 
+# Sheet headers of the uploads and exports, and the attributes they map to
+TARGET_ACCOUNT_SHEET_COLUMNS = {
+    "ACCOUNT_NAME": "account_name",
+    "ACCOUNT_ID": "account_id",
+    "ACCOUNT_LINK": "account_link",
+    "ACCOUNT_STATUS": "account_status",
+    "ACCOUNT_CATEGORY": "account_category",
+    "ACCOUNT_TYPE": "account_type",
+    "PUBLISHING_LEVEL": "publishing_level",
+    "ACCESS_LEVEL": "access_level",
+}
+TARGET_ACCOUNT_COLUMNS = {
+    **TARGET_ACCOUNT_SHEET_COLUMNS,
+    "IS_USED": "is_used",
+    "CREATED_AT": "created_at",
+}
+ISNAD_TASK_COLUMNS = {
+    "TASK_URL": "link",
+    "TASK_TARGET_TYPE": "task_target_type",
+    "BATCH_ID": "batch_id",
+    "PRIORITY": "priority",
+    "IS_USED": "is_used",
+    "CREATED_AT": "created_at",
+}
+
+
 # Endpoint to upload Excel file and add data to DB
 @app.post("/upload-target-accounts/")
 async def upload_target_accounts(
     api_key: str = Depends(get_api_key),
     file: UploadFile = Depends(is_excel_file),
+    mode: str = Query("full", regex="^(full|delta)$",
+                      description="`full` rewrites every row, `delta` writes only new and changed rows."),
+    remove_missing: bool = Query(False, description="In `delta` mode, also delete the accounts missing from the file."),
     db: Session = Depends(get_db)
 ):
     """
@@ -377,10 +730,14 @@ async def upload_target_accounts(
     Allows the application to upload an Excel file, extract data, and add or update it in the database.
 
     - **file**: Upload an Excel file.
+    - **mode**: `full` (default) or `delta`. A delta upload compares a hash of every row with the
+      stored one and only writes the accounts that are new, changed or (with **remove_missing**) removed.
     - **db**: Database session.
 
-    Returns a confirmation message.
+    Returns a confirmation message, with a summary of the changes in `delta` mode.
     """
+    if mode == "delta":
+        return await upload_target_accounts_delta(api_key, file, remove_missing, db)
     try:
         # Load Excel file and extract data
         workbook = load_workbook(file.file)
@@ -410,12 +767,16 @@ async def upload_target_accounts(
                 # Update existing record with new values
                 for key, value in account_data.items():
                     setattr(existing_record, key, value)
+                # The next delta upload hashes the row again from its stored values
+                existing_record.row_hash = None
             else:
                 # Create a new record and add it to the database
                 db_account = TargetAccount(**account_data)
                 db.add(db_account)
 
         db.commit()
+        account_search_index.mark_stale()
+        target_account_stripes.invalidate()
         logger.info('Request from UserID: ' +
                     api_key+' - Target Accounts, Data added or updated in the database successfully')
         return JSONResponse(content={"message": "Target Accounts, Data added or updated in the database successfully."}, status_code=200)
@@ -423,11 +784,33 @@ async def upload_target_accounts(
         raise HTTPException(status_code=500, detail=f"Error processing Target Accounts Excel file: {str(e)}")
 
 
+async def upload_target_accounts_delta(api_key, file, remove_missing, db):
+    try:
+        frame = await run_in_threadpool(delta_sync.read_sheet, file.file, TARGET_ACCOUNT_SHEET_COLUMNS)
+        summary, account_names = delta_sync.sync_sheet(db, TargetAccount, frame, "account_id", remove_missing,
+                                                       name_attribute="account_name")
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Error processing Target Accounts Excel file: {str(e)}")
+
+    # Bulk writes bypass the session events the account cache listens to
+    account_details_cache.invalidate(account_names)
+    if summary["inserted"] or summary["updated"] or summary["removed"]:
+        account_search_index.mark_stale()
+        target_account_stripes.invalidate()
+    logger.info('Request from UserID: ' + api_key + ' - Target Accounts, delta upload: ' +
+                ', '.join(f'{count} {change}' for change, count in summary.items()))
+    return JSONResponse(content={"message": "Target Accounts, Data synchronized with the database successfully.",
+                                 **summary}, status_code=200)
+
+
 # Endpoint to upload Excel file and add data to DB
 @app.post("/upload-isnad-tasks/")
 async def upload_isnad_tasks(
     api_key: str = Depends(get_api_key),
     file: UploadFile = Depends(is_excel_file),
+    allow_repeats: bool = Query(False, description="Keep the tweets already uploaded in an earlier batch."),
     db: Session = Depends(get_db)
 ):
     """
@@ -435,15 +818,29 @@ async def upload_isnad_tasks(
 
     Allows the application to upload an Excel file, extract data, and add or update it in the database.
 
+    Tweet links are stored as tweet ids, whatever their form (x.com or twitter.com, tracking
+    parameters, `/photo/1`...). Rows with a blank TASK_URL, or a link that is not a tweet, are
+    skipped and reported apart (`missing_task_urls`, `not_tweet_links` with their row numbers
+    in `not_tweet_link_rows`); empty rows are ignored. A tweet listed twice in the file, or already uploaded in an
+    earlier batch, is only kept once, unless **allow_repeats** is set. The batch being replaced
+    does not count as an earlier one: uploading the same sheet again (e.g. after fixing a typo)
+    keeps all of its tweets.
+
+    An optional PRIORITY column weighs the tasks: a task of priority 3 is handed out about
+    three times as often as a task of priority 1 (the default).
+
     - **api_key**: API key for authentication.
     - **file**: Upload an Excel file.
+    - **allow_repeats**: Keep the tweets of earlier batches.
 
-    Returns a confirmation message.
+    Returns a confirmation message, with how many tasks were added and skipped.
     """
     try:
         # Load Excel file and extract data
         workbook = load_workbook(file.file)
         sheet = workbook.active
+        # The batches being replaced, their tweets are not repeats
+        replaced_batches = {batch for (batch,) in db.query(distinct(IsnadTasks.batch_id))}
         # Delete all current tasks
         db.query(IsnadTasks).delete()
         # Map column names to indices
@@ -451,30 +848,208 @@ async def upload_isnad_tasks(
         column_indices = {header[i].value: i for i in range(len(header))}
         # batch_id = generate_batch_id()
         batch_id = uuid.uuid4().hex.upper()[0:6]
+        summary = {"added": 0, "duplicates": 0, "repeated_from_earlier_batches": 0, "missing_task_urls": 0,
+                   "not_tweet_links": 0, "invalid_priorities": 0}
+        tasks, tweets_in_file, not_tweet_link_rows = [], set(), []
         # Extract data from the Excel sheet and add or update it in the database
-        for row in sheet.iter_rows(min_row=2, values_only=True):
-            account_data = {
-                "task_url": row[column_indices["TASK_URL"]],
+        for row_number, row in enumerate(sheet.iter_rows(min_row=2, values_only=True), start=2):
+            if all(value is None or str(value).strip() == "" for value in row):
+                # Formatted but empty rows at the end of the sheet
+                continue
+            task_url = row[column_indices["TASK_URL"]]
+            if task_url is None or str(task_url).strip() == "":
+                summary["missing_task_urls"] += 1
+                continue
+            tweet_id = tweet_urls.tweet_id(task_url)
+            if tweet_id is None:
+                summary["not_tweet_links"] += 1
+                not_tweet_link_rows.append(row_number)
+                continue
+            if tweet_id in tweets_in_file:
+                summary["duplicates"] += 1
+                continue
+            tweets_in_file.add(tweet_id)
+            # The PRIORITY column is optional, blank cells and values that are not whole numbers >= 1 count as 1
+            priority = row[column_indices["PRIORITY"]] if "PRIORITY" in column_indices else None
+            if priority is not None:
+                try:
+                    priority = int(priority)
+                except (TypeError, ValueError):
+                    priority = 0
+                if priority < 1:
+                    summary["invalid_priorities"] += 1
+                    priority = None
+            tasks.append({
+                "tweet_id": tweet_id,
                 "task_target_type": row[column_indices["TASK_TARGET_TYPE"]],
+                "priority": priority or task_sampler.DEFAULT_PRIORITY,
                 "batch_id": batch_id
-                }
-            db_account = IsnadTasks(**account_data)
-            db.add(db_account)
-
+                })
+
+        tweet_ids = [task["tweet_id"] for task in tasks]
+        recorded = {}
+        for start in range(0, len(tweet_ids), 500):
+            recorded.update(db.query(UploadedTweet.tweet_id, UploadedTweet.batch_id).filter(
+                UploadedTweet.tweet_id.in_(tweet_ids[start:start + 500])))
+        uploaded_before = {tweet_id for tweet_id, batch in recorded.items() if batch not in replaced_batches}
+        if not allow_repeats:
+            summary["repeated_from_earlier_batches"] = sum(task["tweet_id"] in uploaded_before for task in tasks)
+            tasks = [task for task in tasks if task["tweet_id"] not in uploaded_before]
+
+        db.bulk_insert_mappings(IsnadTasks, tasks)
+        db.bulk_insert_mappings(UploadedTweet, [{"tweet_id": tweet_id, "batch_id": batch_id}
+                                                for tweet_id in tweet_ids if tweet_id not in recorded])
+        # The tweets of the replaced batch that are uploaded again now belong to the new one
+        carried_over = [tweet_id for tweet_id in recorded if tweet_id not in uploaded_before]
+        for start in range(0, len(carried_over), 500):
+            db.query(UploadedTweet).filter(UploadedTweet.tweet_id.in_(carried_over[start:start + 500])).update(
+                {UploadedTweet.batch_id: batch_id}, synchronize_session=False)
         db.commit()
+        task_rotation.invalidate()
+        remove_stale_media(db)
+        summary["added"] = len(tasks)
         logger.info('Request from UserID: ' +
-                    api_key+' - Isnad tasks, Data added or updated in the database successfully')
-        return JSONResponse(content={"message": "Isnad tasks , Data added or updated in the database successfully."}, status_code=200)
+                    api_key+' - Isnad tasks, Data added or updated in the database successfully: ' +
+                    ', '.join(f'{count} {outcome}' for outcome, count in summary.items()))
+        return JSONResponse(content={"message": "Isnad tasks , Data added or updated in the database successfully.",
+                                     **summary, "not_tweet_link_rows": not_tweet_link_rows}, status_code=200)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing Isnad Tasks Excel file: {str(e)}")
 
 
+def current_batch_id(db):
+    batch = db.query(IsnadTasks.batch_id).first()
+    # An all-digit batch id comes back as an int, media are kept by string batch id
+    return str(batch[0]) if batch else None
+
+
+def remove_stale_media(db):
+    """Delete the media of the batches that no longer have tasks, and their files once unused."""
+    task_batches = [str(batch_id) for (batch_id,) in db.query(distinct(IsnadTasks.batch_id))]
+    stale = db.query(BatchMedia).filter(BatchMedia.batch_id.notin_(task_batches)).all()
+    if not stale:
+        return
+    batch_ids, paths = {media.batch_id for media in stale}, {media.path for media in stale}
+    for media in stale:
+        db.delete(media)
+    db.commit()
+    file_id_cache.invalidate(batch_ids)
+    for path in paths:
+        if not db.query(BatchMedia.id).filter(BatchMedia.path == path).first() and os.path.exists(path):
+            os.remove(path)
+
+
+def batch_media_details(media):
+    return {"id": media.id, "batch_id": media.batch_id, "kind": media.kind, "filename": media.filename,
+            "size": media.size, "sent_to_telegram": media.telegram_file_id is not None,
+            "created_at": jsonable_encoder(media.created_at)}
+
+
+# Endpoint to attach an image or a video to the tasks of a batch
+@app.post("/batch-media/")
+async def upload_batch_media(
+    api_key: str = Depends(get_api_key),
+    file: UploadFile = File(..., description="An image (jpg, png, webp), a GIF or a video (mp4, mov)."),
+    batch_id: str = Query(None, description="The batch to attach the media to, the current batch by default."),
+    db: Session = Depends(get_db)
+):
+    """
+    Attach Media to a Batch
+
+    Sends the file along with every task of the batch. The file is uploaded to Telegram
+    once, the first time it is sent, and reused by `file_id` after that.
+
+    - **api_key**: API key for authentication.
+    - **file**: Images up to 5 MB, GIFs up to 15 MB, videos up to 50 MB.
+    - **batch_id**: The batch, the one of the last uploaded tasks by default.
+
+    Returns the stored media.
+    """
+    batch_id = batch_id or current_batch_id(db)
+    if batch_id is None:
+        raise HTTPException(status_code=400, detail="No batch of tasks to attach the media to")
+    try:
+        kind = media_cache.media_kind(file.filename, file.content_type)
+        path, size, sha256 = await media_cache.save_upload(file, kind)
+    except media_cache.MediaError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # The same file attached twice to a batch is sent once
+    media = db.query(BatchMedia).filter_by(batch_id=batch_id, sha256=sha256).first()
+    if media is None:
+        # Telegram already has this file if it was sent for another batch
+        sent_before = db.query(BatchMedia.telegram_file_id).filter(
+            BatchMedia.sha256 == sha256, BatchMedia.kind == kind, BatchMedia.telegram_file_id.isnot(None)).first()
+        media = BatchMedia(batch_id=batch_id, kind=kind, filename=file.filename, path=path, size=size,
+                           sha256=sha256, telegram_file_id=sent_before[0] if sent_before else None)
+        db.add(media)
+        db.commit()
+        file_id_cache.invalidate([batch_id])
+    logger.info('Request from UserID: ' + api_key + ' - Batch media attached: ' + str(file.filename) +
+                ' to batch ' + str(batch_id))
+    return batch_media_details(media)
+
+
+# Endpoint to list the media of a batch
+@app.get("/batch-media/")
+async def list_batch_media(
+    api_key: str = Depends(get_api_key),
+    batch_id: str = Query(None, description="The batch, the current batch by default."),
+    db: Session = Depends(get_db)
+):
+    """
+    List Batch Media
+
+    - **api_key**: API key for authentication.
+    - **batch_id**: The batch, the one of the last uploaded tasks by default.
+    """
+    batch_id = batch_id or current_batch_id(db)
+    media = db.query(BatchMedia).filter(BatchMedia.batch_id == batch_id).order_by(BatchMedia.id).all()
+    return {"batch_id": batch_id, "media": [batch_media_details(item) for item in media]}
+
+
+# Endpoint to detach a media from its batch
+@app.delete("/batch-media/{media_id}")
+async def delete_batch_media(
+    media_id: int = Path(..., description="The id of the media."),
+    api_key: str = Depends(get_api_key),
+    db: Session = Depends(get_db)
+):
+    """
+    Delete Batch Media
+
+    - **media_id**: The id of the media, as listed by `/batch-media/`.
+    - **api_key**: API key for authentication.
+    """
+    media = db.get(BatchMedia, media_id)
+    if media is None:
+        raise HTTPException(status_code=404, detail="Media not found")
+    batch_id, path = media.batch_id, media.path
+    db.delete(media)
+    db.commit()
+    file_id_cache.invalidate([batch_id])
+    if not db.query(BatchMedia.id).filter(BatchMedia.path == path).first() and os.path.exists(path):
+        os.remove(path)
+    return {"id": media_id, "deleted": True}
+
+
+MAX_BATCH_ACCOUNT_NAMES = 100
+
+
+def etagged_response(content, if_none_match):
+    """JSON response carrying an ETag, or an empty 304 if the client already has this content."""
+    tag = account_cache.etag(content)
+    if if_none_match and tag in [value.strip() for value in if_none_match.split(",")]:
+        return Response(status_code=304, headers={"ETag": tag})
+    return JSONResponse(content=content, headers={"ETag": tag})
+
+
 # Endpoint to get account details by ACCOUNT_NAME
 @app.get("/get-target-account-details/")
 async def get_account(
         api_key: str = Depends(get_api_key),
         account_name: str = Query(..., title="Account Id", description="The ACCOUNT_NAME to retrieve details for."),
-        db: Session = Depends(get_db)):
+        if_none_match: str = Header(None, description="ETag of a previous response for the same account.")):
     """
     Get Target Account Details by ACCOUNT_NAME
 
@@ -482,12 +1057,12 @@ async def get_account(
 
     - **api_key**: API key for authentication.
     - **account_name**: The ACCOUNT_NAME to retrieve details for.
-    
+    - **if_none_match**: Optional ETag of a previous response; `304 Not Modified` is returned if it still matches.
 
     Returns account details.
     """
     
-    account = db.query(TargetAccount).filter(TargetAccount.account_name == account_name).first()
+    account = account_details_cache.get(account_name)
 
     if not account:
         raise HTTPException(
@@ -498,20 +1073,198 @@ async def get_account(
     logger.info('Request from UserID: '+api_key +
                 ' - Search for ACCOUNT_NAME: '+account_name+' .')
 
-    return {
-        "account_name": account.account_name,
-        "account_id": account.account_id,
-        "account_link": account.account_link,
-        "account_status": account.account_status,
-        "account_category": account.account_category,
-        "account_type": account.account_type,
-        "publishing_level": account.publishing_level,
-        "access_level": account.access_level,
-        "is_used": account.is_used,
-        "created_at": account.created_at
-    }
+    return etagged_response(account, if_none_match)
+
+
+# Endpoint to get the details of many accounts at once
+@app.get("/get-target-account-details/batch/")
+async def get_accounts(
+        api_key: str = Depends(get_api_key),
+        account_names: List[str] = Query(..., description="The ACCOUNT_NAMEs to retrieve details for, "
+                                                          f"up to {MAX_BATCH_ACCOUNT_NAMES}."),
+        if_none_match: str = Header(None, description="ETag of a previous response for the same names.")):
+    """
+    Get Target Account Details of many ACCOUNT_NAMEs
+
+    Retrieves the details of every given ACCOUNT_NAME in one request.
+
+    - **api_key**: API key for authentication.
+    - **account_names**: The ACCOUNT_NAMEs, one `account_names` query parameter per name.
+    - **if_none_match**: Optional ETag of a previous response; `304 Not Modified` is returned if it still matches.
+
+    Returns the details of the accounts found, by ACCOUNT_NAME, and the names not found.
+    """
+    account_names = list(dict.fromkeys(account_names))
+    if len(account_names) > MAX_BATCH_ACCOUNT_NAMES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_BATCH_ACCOUNT_NAMES} account names per request",
+        )
+
+    accounts = account_details_cache.get_many(account_names)
+
+    logger.info('Request from UserID: '+api_key +
+                ' - Search for '+str(len(account_names))+' ACCOUNT_NAMEs .')
+
+    return etagged_response({
+        "accounts": accounts,
+        "not_found": [name for name in account_names if name not in accounts],
+    }, if_none_match)
+
+
+# Endpoint to search target accounts by part of their name or link
+@app.get("/search-target-accounts/")
+async def search_accounts(
+        api_key: str = Depends(get_api_key),
+        q: str = Query(..., min_length=1, description="Part of an ACCOUNT_NAME or of the handle in an ACCOUNT_LINK."),
+        account_category: str = Query(None, description="Only accounts of this ACCOUNT_CATEGORY."),
+        account_type: str = Query(None, description="Only accounts of this ACCOUNT_TYPE."),
+        max_typos: int = Query(None, ge=0, le=2, description="Typos tolerated, by default 0 to 2 depending on the length of q."),
+        limit: int = Query(search.DEFAULT_LIMIT, ge=1, le=100)):
+    """
+    Search Target Accounts
+
+    Finds target accounts whose name or link handle matches q: exactly, as a prefix,
+    anywhere in it, or with a few typos. Matching ignores case and a leading `@`.
+
+    - **api_key**: API key for authentication.
+    - **q**: The text to search for.
+    - **account_category**, **account_type**: Optional filters.
+
+    Returns the matching accounts, best first, each with the kind of match.
+    """
+    results = account_search_index.search(q, limit, account_category, account_type, max_typos)
+    logger.info('Request from UserID: '+api_key +
+                ' - Search target accounts for: '+q+' .')
+    return {"results": results}
+
+
+def target_account_filters(
+        account_category: str = Query(None, description="Only accounts of this ACCOUNT_CATEGORY."),
+        account_type: str = Query(None, description="Only accounts of this ACCOUNT_TYPE."),
+        publishing_level: str = Query(None, description="Only accounts of this PUBLISHING_LEVEL."),
+        access_level: str = Query(None, description="Only accounts of this ACCESS_LEVEL."),
+        is_used: bool = Query(None, description="Only accounts served at least once, or never served.")):
+    filters = {"account_category": account_category, "account_type": account_type,
+               "publishing_level": publishing_level, "access_level": access_level, "is_used": is_used}
+    return [getattr(TargetAccount, column) == value for column, value in filters.items() if value is not None]
+
+
+def isnad_task_filters(
+        task_target_type: str = Query(None, description="Only tasks of this TASK_TARGET_TYPE."),
+        batch_id: str = Query(None, description="Only tasks of this batch."),
+        is_used: bool = Query(None, description="Only tasks served at least once, or never served.")):
+    filters = {"task_target_type": task_target_type, "batch_id": batch_id, "is_used": is_used}
+    return [getattr(IsnadTasks, column) == value for column, value in filters.items() if value is not None]
+
 
-updater = Updater("6930798784:AAHROEkjE7aInOS4ZdaA94Ib5JmhuCCW_no")
+def row_values(columns):
+    return lambda instance: [getattr(instance, attribute) for attribute in columns.values()]
+
+
+def list_page(db, model, columns, filters, after_id, limit):
+    rows, next_after_id = exports.keyset_page(db, model, filters, after_id, limit)
+    items = [{"id": row.id, **{header.lower(): getattr(row, attribute) for header, attribute in columns.items()}}
+             for row in rows]
+    return {"items": jsonable_encoder(items), "next_after_id": next_after_id}
+
+
+async def export_response(model, columns, filters, export_format, name):
+    """Stream the matching rows as CSV, or as an xlsx file built off the event loop."""
+    rows = exports.iter_rows(SessionLocal, model, filters, row_values(columns))
+    if export_format == "csv":
+        return StreamingResponse(exports.csv_chunks(list(columns), rows), media_type="text/csv",
+                                 headers={"Content-Disposition": f'attachment; filename="{name}.csv"'})
+    path = await run_in_threadpool(exports.write_xlsx, list(columns), rows)
+    return StreamingResponse(exports.file_chunks(path), media_type=exports.XLSX_MEDIA_TYPE,
+                             headers={"Content-Disposition": f'attachment; filename="{name}.xlsx"'},
+                             background=BackgroundTask(os.remove, path))
+
+
+# Endpoint to list target accounts
+@app.get("/target-accounts/")
+async def list_target_accounts(
+        api_key: str = Depends(get_api_key),
+        filters: list = Depends(target_account_filters),
+        after_id: int = Query(None, description="The next_after_id of the previous page."),
+        limit: int = Query(100, ge=1, le=1000),
+        db: Session = Depends(get_db)):
+    """
+    List Target Accounts
+
+    Lists target accounts in id order, one page at a time.
+
+    - **api_key**: API key for authentication.
+    - **after_id**: Omit for the first page, then pass the `next_after_id` of the previous page.
+    - **limit**: Accounts per page.
+
+    Returns the accounts of the page and `next_after_id`, which is null on the last page.
+    """
+    return list_page(db, TargetAccount, TARGET_ACCOUNT_COLUMNS, filters, after_id, limit)
+
+
+# Endpoint to list Isnad tasks
+@app.get("/isnad-tasks/")
+async def list_isnad_tasks(
+        api_key: str = Depends(get_api_key),
+        filters: list = Depends(isnad_task_filters),
+        after_id: int = Query(None, description="The next_after_id of the previous page."),
+        limit: int = Query(100, ge=1, le=1000),
+        db: Session = Depends(get_db)):
+    """
+    List Isnad Tasks
+
+    Lists Isnad tasks in id order, one page at a time.
+
+    - **api_key**: API key for authentication.
+    - **after_id**: Omit for the first page, then pass the `next_after_id` of the previous page.
+    - **limit**: Tasks per page.
+
+    Returns the tasks of the page and `next_after_id`, which is null on the last page.
+    """
+    return list_page(db, IsnadTasks, ISNAD_TASK_COLUMNS, filters, after_id, limit)
+
+
+# Endpoint to export target accounts
+@app.get("/target-accounts/export/")
+async def export_target_accounts(
+        api_key: str = Depends(get_api_key),
+        filters: list = Depends(target_account_filters),
+        format: str = Query("csv", regex="^(csv|xlsx)$", description="`csv` or `xlsx`.")):
+    """
+    Export Target Accounts
+
+    Downloads the matching target accounts as a CSV or Excel file, with the columns of the upload sheet.
+
+    - **api_key**: API key for authentication.
+    - **format**: `csv` or `xlsx`.
+    """
+    logger.info('Request from UserID: '+api_key+' - Export target accounts as '+format+' .')
+    return await export_response(TargetAccount, TARGET_ACCOUNT_COLUMNS, filters, format, "target_accounts")
+
+
+# Endpoint to export Isnad tasks
+@app.get("/isnad-tasks/export/")
+async def export_isnad_tasks(
+        api_key: str = Depends(get_api_key),
+        filters: list = Depends(isnad_task_filters),
+        format: str = Query("csv", regex="^(csv|xlsx)$", description="`csv` or `xlsx`.")):
+    """
+    Export Isnad Tasks
+
+    Downloads the matching Isnad tasks as a CSV or Excel file, with the columns of the upload sheet.
+
+    - **api_key**: API key for authentication.
+    - **format**: `csv` or `xlsx`.
+    """
+    logger.info('Request from UserID: '+api_key+' - Export Isnad tasks as '+format+' .')
+    return await export_response(IsnadTasks, ISNAD_TASK_COLUMNS, filters, format, "isnad_tasks")
+
+
+# Every message the bot sends is counted in one budget; the broadcasts get what the replies leave
+bot_send_budget = send_budget.SendBudget()
+updater = Updater(bot=send_budget.BudgetedBot("6930798784:AAHROEkjE7aInOS4ZdaA94Ib5JmhuCCW_no", bot_send_budget,
+                                              request=telegram.utils.request.Request(con_pool_size=8)))
 
 # Endpoint to check if a user is a member of Isnad group
 @app.post("/check-membership/")
@@ -526,6 +1279,9 @@ async def check_membership(
 
     Check if a user with the provided generated Isnad ID is a member of Isnad group.
 
+    Signed Isnad codes (starting with `I1`) are verified and decoded without a database
+    lookup; codes of the old format are still looked up.
+
     - **api_key**: API key for authentication.
     - **isnad_code**: A JSON object of the users' isnad_code.
     
@@ -541,18 +1297,21 @@ async def check_membership(
     # Extract the user_id from the request body
     isnad_code = request_data.isnad_code
 
-    # Check if the generated ID exists in the database
-    user = db.query(IsnadUsers).filter_by(isnad_id=isnad_code).first()
+    # Signed codes carry the user id, only the codes of the old format are looked up
+    telegram_user_id = isnad_codes.user_id(isnad_code)
+    if telegram_user_id is None and not isnad_codes.is_signed(isnad_code):
+        user = db.query(IsnadUsers).filter_by(isnad_id=isnad_code).first()
+        telegram_user_id = user.telegram_user_id if user else None
 
-    if user:
+    if telegram_user_id is not None:
         # Check if the user is still a member of the group
-        is_member = updater.bot.get_chat_member(ISNAD_GROUP_ID, user.telegram_user_id)
+        is_member = updater.bot.get_chat_member(ISNAD_GROUP_ID, telegram_user_id)
 
         if is_member.status in ['member', 'administrator', 'creator']:
             return {"status": "success", "code": "MEMBER_FOUND", "message": "User is a member of the group."}
         elif is_member.status == 'left':
             # If the user left the group, remove their record from the database
-            db.delete(user)
+            db.query(IsnadUsers).filter_by(telegram_user_id=telegram_user_id).delete()
             db.commit()
             raise HTTPException(status_code=404, detail={"status": "error", "code": "MEMBER_LEFT", "message": "User is no longer a member of the group."})
         else:
@@ -562,6 +1321,277 @@ async def check_membership(
     
 
 
+# Endpoint to issue a new API key
+@app.post("/api-keys/")
+async def create_api_key(
+    request_data: CreateApiKeyRequest,
+    api_key: str = Depends(get_admin_api_key),
+    db: Session = Depends(get_db)
+):
+    """
+    Create API Key
+
+    Issues a new API key, usable right away without a restart.
+
+    - **name**: The userid the key is issued to.
+    - **scopes**: `user` (upload and lookup endpoints) and/or `service` (membership check).
+
+    Returns the new API key. It is shown only once, just its digest is stored.
+    """
+    scopes = set(request_data.scopes)
+    if not scopes or not scopes <= {api_keys.USER_SCOPE, api_keys.SERVICE_SCOPE}:
+        raise HTTPException(status_code=400, detail="Scopes must be 'user' and/or 'service'")
+
+    new_key = api_keys.generate_key()
+    db.add(ApiKey(name=request_data.name, key_digest=api_keys.digest_key(new_key), scopes=",".join(sorted(scopes))))
+    db.commit()
+    api_key_index.reload()
+    logger.info('API key issued for UserID: ' + request_data.name)
+    return {"name": request_data.name, "scopes": sorted(scopes), "api_key": new_key}
+
+
+# Endpoint to list the API keys
+@app.get("/api-keys/")
+async def list_api_keys(api_key: str = Depends(get_admin_api_key)):
+    """
+    List API Keys
+
+    Lists the userids and scopes of the active API keys (the keys themselves are never stored).
+    """
+    return [{"name": name, "scopes": scopes} for name, scopes in api_key_index.names()]
+
+
+# Endpoint to revoke the API keys of a userid
+@app.delete("/api-keys/{name}")
+async def revoke_api_keys(
+    name: str = Path(..., description="The userid whose keys are revoked."),
+    api_key: str = Depends(get_admin_api_key),
+    db: Session = Depends(get_db)
+):
+    """
+    Revoke API Keys
+
+    Revokes every active API key of the given userid, effective right away.
+    """
+    revoked = db.query(ApiKey).filter(ApiKey.name == name, ApiKey.is_active == true()).update(
+        {ApiKey.is_active: false()})
+    db.commit()
+    if not revoked:
+        raise HTTPException(status_code=404, detail="No active API key found")
+    api_key_index.reload()
+    logger.info('API keys revoked for UserID: ' + name)
+    return {"name": name, "revoked": revoked}
+
+
+# Endpoint to set the rate limit of a userid
+@app.put("/rate-limits/")
+async def set_rate_limit(
+    request_data: SetRateLimitRequest,
+    api_key: str = Depends(get_admin_api_key),
+    db: Session = Depends(get_db)
+):
+    """
+    Set Rate Limit
+
+    Sets how many requests a userid may make per window, effective right away.
+
+    - **name**: The userid the limit applies to.
+    - **endpoint**: The endpoint path, e.g. `/check-membership/`, or `*` for every endpoint.
+    - **max_requests**: Requests allowed per window.
+    - **window_seconds**: The window, 900 seconds (15 minutes) by default.
+    """
+    if request_data.max_requests < 1 or request_data.window_seconds < 1:
+        raise HTTPException(status_code=400, detail="max_requests and window_seconds must be positive")
+
+    limit = db.query(RateLimit).filter_by(name=request_data.name, endpoint=request_data.endpoint).first()
+    if limit is None:
+        limit = RateLimit(name=request_data.name, endpoint=request_data.endpoint)
+        db.add(limit)
+    limit.max_requests = request_data.max_requests
+    limit.window_seconds = request_data.window_seconds
+    db.commit()
+    rate_limiter.reload()
+    logger.info('Rate limit set for UserID: ' + request_data.name + ' on ' + request_data.endpoint)
+    return {"name": limit.name, "endpoint": limit.endpoint, "max_requests": limit.max_requests,
+            "window_seconds": limit.window_seconds}
+
+
+# Endpoint to read the request counters
+@app.get("/usage/")
+async def read_usage(api_key: str = Header(..., description="API key for authentication")):
+    """
+    API Usage
+
+    Shows, per endpoint, the requests allowed and rate limited since the server started,
+    the current limit and the requests remaining right now.
+
+    - **api_key**: API key for authentication. The admin API key shows the usage of every userid.
+    """
+    if api_key == API_KEY_ADMIN:
+        return rate_limiter.usage()
+    userid = (api_key_index.resolve(api_key, api_keys.USER_SCOPE)
+              or api_key_index.resolve(api_key, api_keys.SERVICE_SCOPE))
+    if not userid:
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid API key",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return rate_limiter.usage(userid).get(userid, {})
+
+
+DEFAULT_BROADCAST_MESSAGE = "🔻 *مهمات جديدة متاحة الآن* 🔻\n\nتمت إضافة {task_count} مهمة جديدة, برجاء الضغط علي الإختيار التالي لبدء المهمات."
+
+
+def render_broadcast_message(template, db):
+    """Fill the `{batch_id}` and `{task_count}` placeholders of a broadcast template."""
+    batch_id = current_batch_id(db)
+    task_count = db.query(IsnadTasks).filter(IsnadTasks.batch_id == batch_id).count() if batch_id else 0
+    try:
+        return template.format(batch_id=batch_id, task_count=task_count)
+    except (KeyError, IndexError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid message template: {e}")
+
+
+# Endpoint to send a notice to every Isnad user
+@app.post("/broadcasts/")
+async def create_broadcast(
+    request_data: CreateBroadcastRequest,
+    api_key: str = Depends(get_admin_api_key),
+    db: Session = Depends(get_db)
+):
+    """
+    Broadcast a Notice
+
+    Sends a notice, with the start task button, to every Isnad user, in the background. The
+    notice goes out as fast as Telegram allows while leaving room for the bot's replies, and
+    a restart resumes it where it stopped. A notice that is not valid Markdown is refused
+    with a 400.
+
+    - **message**: The notice, in Telegram Markdown. `{task_count}` and `{batch_id}` are replaced
+      with the number of tasks and the id of the current batch. Announces the new batch by default.
+
+    Returns the broadcast, see `/broadcasts/{broadcast_id}` for its progress.
+    """
+    message = render_broadcast_message(request_data.message or DEFAULT_BROADCAST_MESSAGE, db)
+    try:
+        broadcast_id = await run_in_threadpool(broadcaster.create, message)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    logger.info('Broadcast ' + str(broadcast_id) + ' started')
+    return broadcaster.details(db.get(Broadcast, broadcast_id))
+
+
+# Endpoint to list the broadcasts
+@app.get("/broadcasts/")
+async def list_broadcasts(api_key: str = Depends(get_admin_api_key), db: Session = Depends(get_db)):
+    """
+    List Broadcasts
+
+    Lists the last 50 broadcasts, with their progress.
+    """
+    broadcasts = db.query(Broadcast).order_by(Broadcast.id.desc()).limit(50).all()
+    return [broadcaster.details(item) for item in broadcasts]
+
+
+# Endpoint to follow a broadcast
+@app.get("/broadcasts/{broadcast_id}")
+async def read_broadcast(
+    broadcast_id: int = Path(..., description="The id of the broadcast."),
+    api_key: str = Depends(get_admin_api_key),
+    db: Session = Depends(get_db)
+):
+    """
+    Broadcast Progress
+
+    Shows the users reached so far (sent, blocked the bot, failed), the current send rate
+    per second and the estimated seconds left.
+    """
+    item = db.get(Broadcast, broadcast_id)
+    if item is None:
+        raise HTTPException(status_code=404, detail="Broadcast not found")
+    return broadcaster.details(item)
+
+
+# Endpoint to stop a broadcast
+@app.delete("/broadcasts/{broadcast_id}")
+async def cancel_broadcast(
+    broadcast_id: int = Path(..., description="The id of the broadcast."),
+    api_key: str = Depends(get_admin_api_key)
+):
+    """
+    Cancel Broadcast
+
+    Stops a broadcast; the users already reached are kept in its counters.
+    """
+    if not broadcaster.cancel(broadcast_id):
+        raise HTTPException(status_code=404, detail="No running broadcast found")
+    logger.info('Broadcast ' + str(broadcast_id) + ' cancelled')
+    return {"id": broadcast_id, "cancelled": True}
+
+
+# Endpoint to read the Twitter request budgets
+@app.get("/twitter-budget/")
+async def read_twitter_budget(api_key: str = Depends(get_admin_api_key)):
+    """
+    Twitter Request Budget
+
+    Shows, per Twitter operation, the requests sent in the current 15-minute window,
+    the requests remaining, the requests queued (interactive and background) and the
+    seconds until the queued requests have all been sent.
+    """
+    return twitter_request_scheduler.status()
+
+
+# Endpoint to read the account status refresh metrics
+@app.get("/account-status-refresh/")
+async def read_status_refresh(api_key: str = Depends(get_admin_api_key)):
+    """
+    Account Status Refresh
+
+    Shows how fresh the target account statuses are: the refresh lag (age of the stalest
+    status, in seconds), the accounts never checked, the suspended or deleted accounts
+    skipped by the rotation, the ones found dead once and waiting for a second check,
+    whether the refresh is scheduled at all (it needs Twitter credentials), and the
+    summary of the last refresh.
+    """
+    return await run_in_threadpool(status_refresher.stats)
+
+
+# Endpoint to read how evenly target accounts and tasks are served
+@app.get("/exposure-stats/")
+async def read_exposure_stats(api_key: str = Depends(get_api_key), db: Session = Depends(get_db)):
+    """
+    Exposure Statistics
+
+    Shows, per account category and per task batch, how many times the accounts (or tasks)
+    were served: in total, the least and most served, the mean and standard deviation, and
+    how many were never served yet.
+
+    - **api_key**: API key for authentication.
+    """
+    def stats():
+        return {"target_accounts": exposure.exposure_stats(db, TargetAccount, TargetAccount.account_category),
+                "isnad_tasks": exposure.exposure_stats(db, IsnadTasks, IsnadTasks.batch_id)}
+    return jsonable_encoder(await run_in_threadpool(stats))
+
+
+# Endpoint to read the load of the update workers
+@app.get("/bot-dispatcher/")
+async def read_bot_dispatcher(api_key: str = Depends(get_admin_api_key)):
+    """
+    Bot Dispatcher
+
+    Shows how the Telegram updates are being handled: the workers and how busy they were
+    over the last minute, the updates waiting for a worker and for how long the oldest one
+    has been waiting, and the recent queue waits.
+
+    Under `load_shedding`, the current degradation level and the taps and sends shed so far;
+    under `send_budget`, the bot-wide send budget the replies and the broadcasts share.
+    """
+    return {**update_executor.stats(), "load_shedding": load_shedder.stats(), "send_budget": bot_send_budget.stats()}
+
+
 # Log viewer
 @app.get("/logs", response_class=PlainTextResponse)
 async def read_logs(api_key: str = Depends(get_api_key)):
@@ -593,9 +1623,18 @@ ISNAD_GROUP_ID = -1002110233698# Replace with your private group ID
 # Define your welcome message and options
 welcome_message = "أهلا بك في بوت مهمات *إسناد.*\n\n لبدأ المهمات, برجاء الضغط علي الإختيار التالي  . .\n\n"
 
+def start_task_keyboard():
+    return InlineKeyboardMarkup([[InlineKeyboardButton("💥 ابدأ مهمة", callback_data='option1')]])
+
+
+broadcaster = broadcast.Broadcaster(SessionLocal, Broadcast, IsnadUsers, lambda: updater.bot,
+                                    reply_markup=start_task_keyboard, budget=bot_send_budget)
+
 def has_completed_batch(user_id: int, batch_id: int, db: Session) -> bool:
     return db.query(IsnadTasks).filter(IsnadTasks.batch_id == batch_id, IsnadTasks.is_used == true()).count() == db.query(IsnadTasks).filter(IsnadTasks.batch_id == batch_id).count()
 
+# Old format of the Isnad codes, still accepted by /check-membership/ until the user's next /start, which
+# replaces it with an isnad_codes.sign code
 def generate_custom_id(chat_id):
     # Define the mapping for each digit to characters
     digit_mapping = {
@@ -620,14 +1659,15 @@ def generate_custom_id(chat_id):
     return custom_id
 
 # Define a function to handle the /start command
+@tracing.traced_handler
 def start(update: Update, context: CallbackContext) -> None:
     """Send a welcome message with options when the command /start is issued."""
     # Get the user ID of the user who triggered the command
     telegram_user_id = update.effective_user.id
-    Session = sessionmaker(bind=engine)
-    session = Session()
+    session = SessionLocal()
     # Check if the user is a member of the private group
-    is_member = context.bot.get_chat_member(ISNAD_GROUP_ID, telegram_user_id)
+    with tracing.span("bot.get_chat_member"):
+        is_member = context.bot.get_chat_member(ISNAD_GROUP_ID, telegram_user_id)
     if is_member.status in ['member', 'administrator', 'creator']:
         # If the user is a member of the private group
         # Check if the user exists in the database
@@ -636,25 +1676,35 @@ def start(update: Update, context: CallbackContext) -> None:
         if not user:
             # Generate a unique ID for the user
             # isnad_id = str(uuid.uuid4())
-            isnad_id = generate_custom_id(telegram_user_id)
+            isnad_id = isnad_codes.sign(telegram_user_id)
             
             # Save the user and generated ID in the database
             new_user = IsnadUsers(telegram_user_id=telegram_user_id, isnad_id=isnad_id)
             session.add(new_user)
             session.commit()
-            update.message.reply_text(f"كود إسناد الخاص بك:")
-            update.message.reply_text(f"{isnad_id}")
-            update.message.reply_text(f"يرجي الإحتفاظ به للأهمية.")
+            with tracing.span("send.isnad_code"):
+                update.message.reply_text(f"كود إسناد الخاص بك:")
+                update.message.reply_text(f"{isnad_id}")
+                update.message.reply_text(f"يرجي الإحتفاظ به للأهمية.")
         else:
+            if isnad_codes.user_id(user.isnad_id) != telegram_user_id:
+                # A code of the old format (or signed with a former key): replaced with a signed one,
+                # the old code stops working
+                user.isnad_id = isnad_codes.sign(telegram_user_id)
+                session.commit()
+                logger.info(f"Isnad code of user {telegram_user_id} re-issued")
+                with tracing.span("send.isnad_code"):
+                    update.message.reply_text(f"تم تحديث كود إسناد الخاص بك, الكود السابق لم يعد صالحاً.")
             # If the user is a member of the private group, send a welcome message
-            update.message.reply_text(f"كود إسناد الخاص بك:")
-            update.message.reply_text(f"{user.isnad_id}")
-            update.message.reply_text(f"يرجي الإحتفاظ به للأهمية.")
+            with tracing.span("send.isnad_code"):
+                update.message.reply_text(f"كود إسناد الخاص بك:")
+                update.message.reply_text(f"{user.isnad_id}")
+                update.message.reply_text(f"يرجي الإحتفاظ به للأهمية.")
             
         # update.message.reply_text("Welcome! You are authorized to use this bot.")
-        keyboard = [[InlineKeyboardButton("💥 ابدأ مهمة", callback_data='option1')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        context.bot.send_message(chat_id=update.effective_chat.id,text=welcome_message, reply_markup=reply_markup,  parse_mode= 'Markdown')
+        reply_markup = start_task_keyboard()
+        with tracing.span("send.welcome"):
+            context.bot.send_message(chat_id=update.effective_chat.id,text=welcome_message, reply_markup=reply_markup,  parse_mode= 'Markdown')
 
     elif is_member.status == 'left':
         # If the user is not a member of the private group
@@ -670,58 +1720,82 @@ def start(update: Update, context: CallbackContext) -> None:
         update.message.reply_text("عذراً ،، غير مصرح لغير أعضاء حملة اسناد باستخدام هذا البوت")
 
     
-# Function to fetch the next task for a user
-def get_next_task(user_id):
-    Session = sessionmaker(bind=engine)
-    session = Session()
+def load_batch_tasks(batch_id):
+    """Loader of the task sampler: the tasks of a batch with their priority and times served."""
+    session = SessionLocal()
+    try:
+        return session.query(IsnadTasks.id, IsnadTasks.priority, IsnadTasks.served_count).filter(
+            IsnadTasks.batch_id == batch_id).order_by(IsnadTasks.id).all()
+    finally:
+        session.close()
+
+
+task_rotation = task_sampler.TaskSampler(load_batch_tasks)
 
+
+# Function to fetch the next task for a user
+def choose_next_task(session, user_id):
+    """
+    Pick the next task of `user_id` without handing it out yet: a task of the user's batch they
+    have not done yet, drawn by priority (see task_sampler.py), or None once they have done the
+    whole current batch.
+    """
     # Get the current batch_id from the IsnadTasks table
     current_batch_ids = session.query(distinct(IsnadTasks.batch_id)).all()
     # Extract the batch_id from the result
     current_batch_id = current_batch_ids[0][0] if current_batch_ids else None
-    # Fetch all tasks
-    all_tasks = session.query(IsnadTasks).all()
 
     # Fetch tasks used by the user
     user_used_tasks = user_tasks.get(user_id, [])
-    # Initialize next_task outside the conditional block
-    next_task = None
 
+    task_id = None
     # Check if user has any used tasks
     if user_used_tasks:
         # Get the batch_id of the last task used by the user
         last_batch_id = user_used_tasks[-1][1]
-        # Extract list of used task IDs from user_used_tasks
-        used_task_ids = [task_id for task_id, _ in user_used_tasks]
-        # Determine unused tasks not used by the user
-        available_tasks = [task for task in all_tasks if not task.is_used and task.id not in used_task_ids and task.batch_id == last_batch_id]
-
-        # Check if there are any available tasks in the same batch
-        if available_tasks:
-            next_task = random.choice(available_tasks)
-
-    # If no next_task is found for the same batch, find a new one
-    if not next_task:
-        if user_used_tasks and current_batch_id==last_batch_id:
+        # The tasks of the same batch not done by the user (the sampler keeps track of them)
+        task_id = task_rotation.pick(last_batch_id, user_id)
+        # The user has done the whole batch
+        if task_id is None and current_batch_id == last_batch_id:
             return None
-        else:
-            # Determine unused tasks not used by the user
-            available_tasks = [task for task in all_tasks if not task.is_used]
 
-            if available_tasks:
-                # Select a random task from available tasks
-                next_task = random.choice(available_tasks)
-            else:
-                # Reset used flag for all tasks
-                session.query(IsnadTasks).update({IsnadTasks.is_used: False})
-                session.commit()
-                # Select a random task
-                next_task = random.choice(all_tasks)
+    # New user, or new batch
+    if task_id is None and current_batch_id is not None:
+        task_id = task_rotation.pick(current_batch_id)
+    # None if the tasks were uploaded again in the meantime
+    return session.get(IsnadTasks, task_id) if task_id is not None else None
 
-            # Mark the task as used
-            next_task.is_used = True
-            session.commit()
 
+def user_task_state(user_id):
+    """What the choice of the next task depends on, to tell whether a prefetched choice still holds."""
+    user_used_tasks = user_tasks.get(user_id, [])
+    return len(user_used_tasks), user_used_tasks[-1] if user_used_tasks else None
+
+
+def get_next_task(user_id, bundle=None):
+    """
+    The next task of `user_id`, taken from a prefetched `bundle` when its task is still
+    there, counted as served and recorded as used by the user.
+    """
+    session = SessionLocal()
+
+    next_task = None
+    if bundle and bundle["task_id"] is not None and bundle["task_state"] == user_task_state(user_id):
+        # Still fine if other users were served it since, it was drawn a moment ago
+        next_task = session.get(IsnadTasks, bundle["task_id"])
+    if next_task is None:
+        next_task = choose_next_task(session, user_id)
+        if next_task is None:
+            return None
+
+    # Count the serve, in SQL so concurrent serves of the same task all count
+    next_task.served_count = IsnadTasks.served_count + 1
+    next_task.last_served_at = datetime.utcnow()
+    next_task.is_used = True
+    session.commit()
+    task_rotation.record_serve(next_task.batch_id, next_task.id, user_id)
+
+    user_used_tasks = user_tasks.get(user_id, [])
     # Check if the user has used tasks from a previous batch
     if user_used_tasks and user_used_tasks[-1][1] != next_task.batch_id:
         # Clear the dictionary for the user and insert a new one for the new batch id
@@ -734,114 +1808,278 @@ def get_next_task(user_id):
 
 
 
+# Accounts the rotation may hand out
+live_account = or_(TargetAccount.twitter_status.is_(None),
+                   TargetAccount.twitter_status.notin_(status_refresh.DEAD_STATUSES))
+
+
+# Accounts read at first when looking for free ones, 4 times as many on each next read
+ACCOUNT_PAGE_SIZE = 16
+
+
+def select_target_accounts(session, target_type, fallback_to_any_type=False, user_id=None,
+                           hold_seconds=prefetch.SEND_HOLD_SECONDS, prefetching=False):
+    """
+    Get the 4 least served target accounts of `target_type`, then by publishing and access level,
+    from the stripe of the pool of `user_id` first (see account_stripes.py and exposure.py); when
+    the stripe has fewer than 4 to hand out, the rest come from the other stripes.
+    Accounts found suspended or deleted by the status refresh are skipped, and so are the accounts
+    held for other users; the selected ones are held for `user_id` until they are sent.
+
+    A click that still has fewer than 4 accounts takes over the accounts only held by the prefetch
+    of other users, least served first. A prefetch (`prefetching`) takes none of those, nor the
+    accounts held for the user's own click.
+
+    When there is no account of `target_type` to hand out, accounts of any type are selected
+    instead if `fallback_to_any_type`.
+    """
+
+    def in_stripe(account_type):
+        stripe_count = target_account_stripes.stripe_count(account_type)
+        if stripe_count == 1:
+            return []
+        return [TargetAccount.id % stripe_count == target_account_stripes.stripe_of(user_id, stripe_count)]
+
+    def next_accounts(conditions, limit, claimed, take_prefetched):
+        # The held accounts are skipped here rather than in SQL, where every held id would be a
+        # parameter of every query: read the least served a page at a time until enough are free
+        claimed_ids = {account.id for account in claimed}
+        ordering = (TargetAccount.served_count.asc(), TargetAccount.publishing_level.asc(),
+                    TargetAccount.access_level.asc(), TargetAccount.id.asc())
+        query = session.query(TargetAccount.id).filter(live_account, *conditions).order_by(*ordering)
+        account_ids, offset, page = [], 0, ACCOUNT_PAGE_SIZE
+        while len(account_ids) < limit:
+            page_ids = [account_id for (account_id,) in query.offset(offset).limit(page)]
+            ids = [account_id for account_id in page_ids if account_id not in claimed_ids]
+            account_ids += account_reservations.free(ids, None if prefetching else user_id, take_prefetched)
+            if len(page_ids) < page:
+                break
+            offset += page
+            page *= 4
+        if not account_ids:
+            return []
+        return session.query(TargetAccount).filter(TargetAccount.id.in_(account_ids[:limit])).order_by(
+            *ordering).all()
+
+    def claim(conditions, claimed, take_prefetched=False):
+        # No lock: a concurrent click of the same stripe may pick the same accounts, only one of
+        # them gets to hold each, and the other one takes the next accounts
+        for _ in range(3):
+            if len(claimed) >= 4:
+                break
+            accounts = next_accounts(conditions, 4 - len(claimed), claimed, take_prefetched)
+            held = set(account_reservations.hold([account.id for account in accounts], user_id, hold_seconds,
+                                                 prefetched=prefetching, take_prefetched=take_prefetched))
+            claimed += [account for account in accounts if account.id in held]
+            if len(held) == len(accounts):
+                break
+        return claimed
+
+    def claim_of_type(of_target_type):
+        account_type = target_type if of_target_type else account_stripes.ANY_TYPE
+        of_type = [TargetAccount.account_type == target_type] if of_target_type else []
+        claimed = claim(of_type + in_stripe(account_type), [])
+        if len(claimed) < 4:
+            # The stripe is only where to look first, the other stripes make up the rest
+            claimed = claim(of_type, claimed)
+        if len(claimed) < 4 and not prefetching:
+            # Prefetch holds are only a head start, the click comes first
+            claimed = claim(of_type, claimed, take_prefetched=True)
+        return claimed
+
+    target_accounts = claim_of_type(of_target_type=True)
+    if not target_accounts and fallback_to_any_type:
+        target_accounts = claim_of_type(of_target_type=False)
+    return target_accounts
+
+
+def prefetched_target_accounts(session, bundle, target_type):
+    """The target accounts held in a prefetched `bundle`, if they were selected for `target_type`."""
+    if not bundle or not bundle["account_ids"] or bundle["target_type"] != target_type:
+        return []
+    # Held for the click from now on, so no other click takes them over; if one already did,
+    # select them again
+    held = account_reservations.hold(bundle["account_ids"], bundle["user_id"], prefetch.SEND_HOLD_SECONDS)
+    if len(held) < len(bundle["account_ids"]):
+        return []
+    accounts = session.query(TargetAccount).filter(TargetAccount.id.in_(bundle["account_ids"])).order_by(
+        TargetAccount.served_count.asc(), TargetAccount.publishing_level.asc(),
+        TargetAccount.access_level.asc()).all()
+    # Served since: select them again
+    served_counts = dict(zip(bundle["account_ids"], bundle["served_counts"]))
+    if any(account.served_count != served_counts[account.id] for account in accounts):
+        return []
+    return accounts
+
+
+def prepare_next_bundle(user_id):
+    """
+    Prefetch stage: the next task of `user_id` and 4 target accounts for it, held for the user.
+    Nothing is counted as served here, that waits until the bundle is used.
+    """
+    session = SessionLocal()
+    try:
+        task_state = user_task_state(user_id)
+        next_task = choose_next_task(session, user_id)
+        target_type = next_task.task_target_type if next_task else user_sessions.get(user_id, {}).get(
+            "task_target_type")
+        target_accounts = []
+        # Prefetch holds take a small share of the pool at most, so the clicks never run short
+        if target_type and account_reservations.prefetched_count() + 4 <= (
+                prefetch.PREFETCH_HOLD_SHARE * target_account_stripes.pool_size(target_type)):
+            fallback_to_any_type = not (target_type and int(target_type) < 1)
+            target_accounts = select_target_accounts(
+                session, target_type, fallback_to_any_type, user_id=user_id,
+                hold_seconds=min(task_prefetcher.ttl, prefetch.PREFETCH_HOLD_SECONDS), prefetching=True)
+        return {"user_id": user_id, "task_id": next_task.id if next_task else None, "task_state": task_state,
+                "target_type": target_type, "account_ids": [account.id for account in target_accounts],
+                "served_counts": [account.served_count for account in target_accounts]}
+    finally:
+        session.close()
+
+
+def release_bundle(bundle):
+    # Only what is still held for the user, the accounts may have been taken over since
+    account_reservations.release(bundle["account_ids"], bundle["user_id"])
+
+
+account_reservations = prefetch.Reservations()
+target_account_stripes = account_stripes.AccountStripes(load_account_type_counts)
+task_prefetcher = prefetch.Prefetcher(prepare_next_bundle, release_bundle)
+
+
+def send_target_accounts(query, session, target_accounts):
+    """
+    Send the target account links followed by the task options keyboard, counting the accounts as
+    served. The keyboard goes out even without accounts, so the user can always ask again.
+    """
+    with tracing.span("send.target_accounts", count=len(target_accounts)):
+        if not target_accounts:
+            query.message.reply_text("⚠️ لا توجد حسابات مستهدفة متاحة حالياً، برجاء طلب حسابات جديدة بعد قليل")
+        # Only a header, left out when the bot is overloaded
+        elif load_shedder.allows("target_accounts_header"):
+            query.message.reply_text(text= "<b>الحسابات المستهدفة</b>",  
+                                     parse_mode= 'HTML',disable_web_page_preview=True)
+        for target_account in target_accounts:
+            if target_account.account_id:
+                query.message.reply_text(text=f"{target_account.account_link}",  
+                                         parse_mode= 'HTML',disable_web_page_preview=True)
+                # In SQL, so concurrent serves of the same account all count
+                target_account.served_count = TargetAccount.served_count + 1
+                target_account.last_served_at = datetime.utcnow()
+                target_account.is_used = True
+                # Commit changes to the database
+            session.commit()
+
+    keyboard = [
+        [InlineKeyboardButton("🔄 مهمة جديدة",  callback_data='option1')],
+        [InlineKeyboardButton("🔻اكونتات مستهدفة جديدة🔻", callback_data='option2')]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    with tracing.span("send.keyboard"):
+        query.message.reply_text(' يرجي إختيار أحد الخيارات التالية: ', reply_markup=reply_markup) 
+    # Sent now, no need to hold them any more; not before the click is done, so no other click
+    # gets them while this one is still going
+    account_reservations.release([target_account.id for target_account in target_accounts], query.from_user.id)
+
+
+# Answers repeated taps at admission (see callback_guard.py and register_handlers)
+double_tap_guard = callback_guard.CallbackGuard(notices={
+    callback_guard.PENDING: "⏳ جاري تجهيز طلبك، برجاء الانتظار",
+    callback_guard.DONE: "✅ تم إرسال طلبك بالأعلى",
+})
+# What a repeated tap is answered with, by what the click sent
+TASK_SENT_ANSWER = "✅ تم إرسال المهمة والحسابات المستهدفة بالأعلى"
+ACCOUNTS_SENT_ANSWER = "✅ تم إرسال الحسابات المستهدفة بالأعلى"
+NO_ACCOUNTS_ANSWER = "⚠️ لا توجد حسابات مستهدفة متاحة حالياً"
+ALL_TASKS_DONE_ANSWER = "🔻 لقد قمت بتنفيذ المهمة كاملة، برجاء إنتظار مهمات جديدة"
+
+
 # Define a function to handle button clicks
-def button_click(update: Update, context: CallbackContext) -> None:
-    """Respond to button clicks."""
+@tracing.traced_handler
+def button_click(update: Update, context: CallbackContext):
+    """Respond to button clicks; returns what a repeated tap of the same button is answered with."""
     query = update.callback_query
-    query.answer()
+    with tracing.span("bot.answer_callback_query"):
+        query.answer()
     option = query.data
-    Session = sessionmaker(bind=engine)
-    session = Session()
+    session = SessionLocal()
+
+    user_id = update.callback_query.from_user.id
+    # The bundle prefetched after the previous click, if any
+    bundle = task_prefetcher.take(user_id)
+    answer = None
 
     if option == 'option1':
-        next_task = get_next_task(update.callback_query.from_user.id)
+        with tracing.span("get_next_task", prefetched=bundle is not None):
+            next_task = get_next_task(user_id, bundle)
         if next_task:
 
-            user_sessions[update.callback_query.from_user.id] = {"task_target_type": next_task.task_target_type}
-            print(f"Next task for user {update.callback_query.from_user.id}: {next_task.id}")
-            query.message.reply_text(text=f"<b>لينك المهمة</b>: \n\n {next_task.task_url}",  
-                                parse_mode= 'HTML',disable_web_page_preview=True)
+            user_sessions[user_id] = {"task_target_type": next_task.task_target_type}
+            tracing.annotate(task_id=next_task.id, batch_id=next_task.batch_id)
+            logger.debug(f"Next task for user {user_id}: {next_task.id}")
+            with tracing.span("send.task_link"):
+                query.message.reply_text(text=f"<b>لينك المهمة</b>: \n\n {next_task.link}",  
+                                    parse_mode= 'HTML',disable_web_page_preview=True)
+            if file_id_cache.media_for_batch(next_task.batch_id) and load_shedder.allows("task_media"):
+                with tracing.span("send.task_media"):
+                    try:
+                        file_id_cache.send_batch(context.bot, query.message.chat_id, next_task.batch_id)
+                    except Exception as e:
+                        # The task is already served: the accounts and the keyboard still have to go out
+                        logger.error(f"Could not send the media of batch {next_task.batch_id} to user "
+                                     f"{user_id}: {e}")
 
             target_type = next_task.task_target_type
-            if target_type and int(target_type) < 1:
-                target_accounts = session.query(TargetAccount).filter(
-                TargetAccount.account_type == next_task.task_target_type, TargetAccount.is_used == false()).order_by(
-                    TargetAccount.publishing_level.asc(), TargetAccount.access_level.asc()).limit(4).all()
-            else:
-                target_accounts = session.query(TargetAccount).filter(
-                    TargetAccount.account_type == next_task.task_target_type, TargetAccount.is_used == false()).order_by(
-                        TargetAccount.publishing_level.asc(), TargetAccount.access_level.asc()).limit(4).all()
-                # Check if the query returned no unused accounts
-            if not target_accounts:
-                # Reset is_used for all accounts to False and retry the query
-                if target_type and int(target_type) < 1:
-                    session.query(TargetAccount).filter(
-                        TargetAccount.account_type == next_task.task_target_type).update({TargetAccount.is_used: false()})
-                else:
-                    session.query(TargetAccount).update({TargetAccount.is_used: false()})
-                session.commit()
-
-                if target_type and int(target_type) < 1:
-                    target_accounts = session.query(TargetAccount).filter(
-                        TargetAccount.account_type == next_task.task_target_type,
-                        TargetAccount.is_used == false()).order_by(TargetAccount.publishing_level.asc(),
-                                                            TargetAccount.access_level.asc()).limit(4).all()
-                else:
-                    target_accounts = session.query(TargetAccount).filter(TargetAccount.is_used == false()).order_by(TargetAccount.publishing_level.asc(),
-                                                            TargetAccount.access_level.asc()).limit(4).all()
-            if target_accounts:
-                query.message.reply_text(text= "<b>الحسابات المستهدفة</b>",  
-                                                parse_mode= 'HTML',disable_web_page_preview=True)
-                for target_account in target_accounts:
-                    if target_account.account_id:
-                        # Check the stop flag before processing each account
-                        query.message.reply_text(text=f"{target_account.account_link}",  
-                                                parse_mode= 'HTML',disable_web_page_preview=True)
-                        target_account.is_used = True
-                        # Commit changes to the database
-                    session.commit()
-                    
-                keyboard = [
-                [InlineKeyboardButton("🔄 مهمة جديدة",  callback_data='option1')],
-                [InlineKeyboardButton("🔻اكونتات مستهدفة جديدة🔻", callback_data='option2')]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-
-                query.message.reply_text(' يرجي إختيار أحد الخيارات التالية: ', reply_markup=reply_markup) 
+            # Tasks of a "< 1" target type only ever use accounts of that type,
+            # the others fall back to the whole pool when their type has none to hand out
+            fallback_to_any_type = not (target_type and int(target_type) < 1)
+            with tracing.span("select_target_accounts"):
+                target_accounts = (prefetched_target_accounts(session, bundle, target_type)
+                                   or select_target_accounts(session, target_type, fallback_to_any_type, user_id))
+            send_target_accounts(query, session, target_accounts)
+            answer = TASK_SENT_ANSWER
         else:
             keyboard = [
                 [InlineKeyboardButton("🔄 مهمة جديدة",  callback_data='option1')]]
             reply_markup = InlineKeyboardMarkup(keyboard)
             query.message.reply_text('🔻شكراً لحماسك, لقد قمت بتنفيذ المهمة كاملة. برجاء إنتظار مهمات جديدة قادمة ',reply_markup=reply_markup) 
+            answer = ALL_TASKS_DONE_ANSWER
     if option == 'option2':
-        task_target_type = user_sessions.get(update.callback_query.from_user.id, {}).get("task_target_type")
+        task_target_type = user_sessions.get(user_id, {}).get("task_target_type")
         if task_target_type:
-            target_accounts = session.query(TargetAccount).filter(
-                TargetAccount.account_type == task_target_type, TargetAccount.is_used == false()).order_by(
-                    TargetAccount.publishing_level.asc(), TargetAccount.access_level.asc()).limit(4).all()
-                # Check if the query returned no unused accounts
-            if not target_accounts:
-                # Reset is_used for all accounts to False and retry the query
-                session.query(TargetAccount).filter(
-                    TargetAccount.account_type == task_target_type).update({TargetAccount.is_used: false()})
-                session.commit()
-
-                target_accounts = session.query(TargetAccount).filter(
-                    TargetAccount.account_type == task_target_type,
-                    TargetAccount.is_used == false()).order_by(TargetAccount.publishing_level.asc(),
-                                                            TargetAccount.access_level.asc()).limit(4).all()
-            if target_accounts:
-                query.message.reply_text(text= "<b>الحسابات المستهدفة</b>",  
-                                            parse_mode= 'HTML',disable_web_page_preview=True)
-                for target_account in target_accounts:
-                    if target_account.account_id:
-                        # Check the stop flag before processing each account
-                        query.message.reply_text(text=f"{target_account.account_link}",  
-                                                parse_mode= 'HTML',disable_web_page_preview=True)
-                        target_account.is_used = True
-                        # Commit changes to the database
-                    session.commit()
-                    
-                keyboard = [
-                [InlineKeyboardButton("🔄 مهمة جديدة",  callback_data='option1')],
-                [InlineKeyboardButton("🔻اكونتات مستهدفة جديدة🔻", callback_data='option2')]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                query.message.reply_text(' يرجي إختيار أحد الخيارات التالية: ', reply_markup=reply_markup) 
-            else:
-                query.message.reply_text("You need to select a task first.")
+            with tracing.span("select_target_accounts"):
+                target_accounts = (prefetched_target_accounts(session, bundle, task_target_type)
+                                   or select_target_accounts(session, task_target_type, user_id=user_id))
+            send_target_accounts(query, session, target_accounts)
+            answer = ACCOUNTS_SENT_ANSWER if target_accounts else NO_ACCOUNTS_ANSWER
+        else:
+            query.message.reply_text("You need to select a task first.")
+
+    if bundle:
+        # Whatever this click did not use goes back to the pool
+        release_bundle(bundle)
+    # Get the next click ready while the user works on this one
+    task_prefetcher.schedule(user_id)
+    return answer
                    
 
+# Handlers run on a pool of workers, one user's updates at a time (see user_dispatch.py)
+update_executor = user_dispatch.UserOrderedExecutor()
+# Degrades the replies as the backlog of the update workers gets older (see load_shedding.py)
+load_shedder = load_shedding.LoadShedder(
+    update_executor, busy_notice="⏳ البوت مشغول حالياً بسبب كثرة الطلبات، برجاء المحاولة بعد قليل")
+
+
+def register_handlers(dispatcher, executor=None) -> None:
+    """Register the bot handlers on `dispatcher` (shared with the traffic replayer)."""
+    executor = executor or update_executor
+    dispatcher.add_handler(CommandHandler("start", executor.ordered(start)))
+    dispatcher.add_handler(CallbackQueryHandler(executor.ordered(button_click, guard=double_tap_guard)))
+    # Every time the back button is pressed, the main_menu fucntion is triggered and the user sees the previous menu
+    dispatcher.add_handler(CallbackQueryHandler(executor.ordered(button_click, guard=double_tap_guard), pattern='back'))
+
+
 def main() -> None:
 
     # Add dummy tasks data
@@ -852,16 +2090,27 @@ def main() -> None:
     global updater
     # Get the dispatcher to register handlers
     dispatcher = updater.dispatcher
+    # Time-stamp incoming updates so traces include the time spent waiting in the queue
+    updater.update_queue = dispatcher.update_queue = tracing.TimedQueue()
+    if recorder.RECORD_FILE:
+        # Opt-in: keep an anonymised copy of the incoming traffic for offline replay
+        update_recorder = recorder.UpdateRecorder(recorder.RECORD_FILE)
+        dispatcher.update_queue.listeners.append(update_recorder.record)
+        logger.info(f"Recording the incoming updates to {update_recorder.path}")
 
     # Register the handlers
-    dispatcher.add_handler(CommandHandler("start", start))
-    dispatcher.add_handler(CallbackQueryHandler(button_click))
-    # Every time the back button is pressed, the main_menu fucntion is triggered and the user sees the previous menu
-    dispatcher.add_handler(CallbackQueryHandler(button_click, pattern='back'))
+    register_handlers(dispatcher)
 
     # Start the Bot
     updater.start_polling()
 
+    if STATUS_REFRESH_MINUTES > 0 and twitter_resolver.has_credentials():
+        status_refresher.start(STATUS_REFRESH_MINUTES)
+    elif STATUS_REFRESH_MINUTES > 0:
+        logger.info("Account status refresh not started: no Twitter credentials (ISNAD_TWITTER_* variables)")
+    # Broadcasts interrupted by a restart carry on
+    broadcaster.resume()
+
     # Run the bot until you press Ctrl-C
     # updater.idle()
 
@@ -0,0 +1,150 @@
+"""
+Read-through cache of target account details, keyed by account name.
+
+Entries live at most `ttl` seconds and the least recently used ones are evicted
+once `maxsize` names are cached. Not-found names are cached too, so repeated
+lookups of an unknown name do not hit the database either.
+
+`watch()` keeps the cache exact: the names of the rows a session inserted,
+changed or deleted are invalidated once the session commits, and a bulk
+`query(...).update()`/`delete()` (the `is_used` resets) clears the whole cache.
+Columns left out of the details, such as the rotation counters bumped on every
+serve, can be `ignored`, so serving an account keeps its entry (and ETag).
+"""
+import hashlib
+import json
+import threading
+
+from cachetools import TTLCache
+from sqlalchemy import event, inspect
+
+CACHE_SIZE = 10_000
+CACHE_TTL = 300
+
+_NOT_FOUND = object()
+_CLEAR_ALL = "account_cache.clear_all"
+_CHANGED_NAMES = "account_cache.changed_names"
+
+
+def _as_stored(value):
+    # Sheet cells come in as ints while the columns are strings: 1 and "1" are the same value
+    return None if value is None else str(value)
+
+
+def _is_changed(instance, ignored=()):
+    """
+    Whether a flushed instance really changed, not just had its attributes set to equal values,
+    leaving out the `ignored` attributes.
+    """
+    for attribute in inspect(instance).attrs:
+        if attribute.key in ignored:
+            continue
+        history = attribute.history
+        if history.added and [_as_stored(v) for v in history.added] != [_as_stored(v) for v in history.deleted]:
+            return True
+    return False
+
+
+def etag(content):
+    """Weak ETag of a JSON-compatible response body."""
+    body = json.dumps(content, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return 'W/"' + hashlib.sha1(body.encode("utf-8")).hexdigest() + '"'
+
+
+class AccountDetailsCache:
+    """
+    - **loader**: callable taking a list of account names and returning `{account_name: details}`
+      for the ones that exist.
+    """
+
+    def __init__(self, loader, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.loader = loader
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        # Bumped by every invalidation, so a load racing with a commit is not cached
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, account_names):
+        """Return `{account_name: details}` for the names that exist, loading the uncached ones at once."""
+        found, missing = {}, []
+        with self._lock:
+            for name in account_names:
+                details = self._cache.get(name)
+                if details is None:
+                    missing.append(name)
+                elif details is not _NOT_FOUND:
+                    found[name] = details
+            self.hits += len(account_names) - len(missing)
+            self.misses += len(missing)
+            generation = self._generation
+        if missing:
+            loaded = self.loader(missing)
+            with self._lock:
+                if generation == self._generation:
+                    for name in missing:
+                        self._cache[name] = loaded.get(name, _NOT_FOUND)
+            found.update(loaded)
+        return found
+
+    def get(self, account_name):
+        return self.get_many([account_name]).get(account_name)
+
+    def invalidate(self, account_names):
+        with self._lock:
+            self._generation += 1
+            for name in account_names:
+                self._cache.pop(name, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._cache.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._cache), "hits": self.hits, "misses": self.misses}
+
+    def watch(self, session_factory, model, name_attribute="account_name", ignored=()):
+        """
+        Invalidate the cache from the commits of sessions made by `session_factory` that touch `model`,
+        except for changes to the `ignored` attributes only.
+        """
+
+        @event.listens_for(session_factory, "after_flush")
+        def collect_changed_names(session, flush_context):
+            changed = session.info.setdefault(_CHANGED_NAMES, set())
+            for instance in list(session.new) + list(session.deleted):
+                if isinstance(instance, model):
+                    changed.add(getattr(instance, name_attribute))
+            for instance in session.dirty:
+                if isinstance(instance, model) and _is_changed(instance, ignored):
+                    # A renamed account must be invalidated under its old name as well
+                    history = inspect(instance).attrs[name_attribute].history
+                    changed.update(history.added or ())
+                    changed.update(history.deleted or ())
+                    changed.update(history.unchanged or ())
+
+        @event.listens_for(session_factory, "after_bulk_update")
+        def collect_bulk_update(update_context):
+            if update_context.mapper.class_ is model:
+                update_context.session.info[_CLEAR_ALL] = True
+
+        @event.listens_for(session_factory, "after_bulk_delete")
+        def collect_bulk_delete(delete_context):
+            if delete_context.mapper.class_ is model:
+                delete_context.session.info[_CLEAR_ALL] = True
+
+        @event.listens_for(session_factory, "after_commit")
+        def invalidate_committed(session):
+            changed = session.info.pop(_CHANGED_NAMES, None)
+            if session.info.pop(_CLEAR_ALL, False):
+                self.clear()
+            elif changed:
+                self.invalidate(changed)
+
+        @event.listens_for(session_factory, "after_rollback")
+        def discard_rolled_back(session):
+            session.info.pop(_CHANGED_NAMES, None)
+            session.info.pop(_CLEAR_ALL, None)
@@ -0,0 +1,65 @@
+"""
+Striped allocation of target accounts.
+
+The accounts of every `account_type` are split into stripes by id
+(`id % stripes`), and every user draws from the stripe their Telegram id falls
+in. Concurrent clicks of different users then look at different rows, instead
+of all asking for the same 4 least served accounts, and each stripe goes through
+its own accounts, so every account gets about the same exposure. The stripe is
+only where a user looks first: when it has fewer accounts to hand out than a
+click needs, the rest come from the other stripes.
+
+Small pools get fewer stripes, so a stripe always holds at least
+`MIN_STRIPE_SIZE` accounts; the number of accounts per type is cached for
+`ttl` seconds, and dropped when the accounts are uploaded.
+"""
+import os
+import threading
+import time
+
+STRIPES = int(os.getenv("ISNAD_ACCOUNT_STRIPES", "8"))
+MIN_STRIPE_SIZE = 25
+COUNTS_TTL = 60
+# Key of the whole pool, for the selections of any account type
+ANY_TYPE = None
+
+
+class AccountStripes:
+    """
+    - **count_loader**: returns `{account_type: number of accounts}`.
+    """
+
+    def __init__(self, count_loader, stripes=STRIPES, min_stripe_size=MIN_STRIPE_SIZE, ttl=COUNTS_TTL):
+        self.count_loader = count_loader
+        self.stripes = max(stripes, 1)
+        self.min_stripe_size = min_stripe_size
+        self.ttl = ttl
+        self._counts = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._counts is None or time.monotonic() - self._loaded_at > self.ttl:
+                counts = dict(self.count_loader())
+                counts[ANY_TYPE] = sum(counts.values())
+                self._counts, self._loaded_at = counts, time.monotonic()
+            return self._counts
+
+    def stripe_count(self, account_type=ANY_TYPE):
+        """How many stripes the pool of `account_type` is split into."""
+        count = self._load().get(account_type, 0)
+        return max(1, min(self.stripes, count // self.min_stripe_size))
+
+    def pool_size(self, account_type=ANY_TYPE):
+        """How many accounts of `account_type` there are."""
+        return self._load().get(account_type, 0)
+
+    def stripe_of(self, user_id, stripe_count):
+        if not user_id or stripe_count == 1:
+            return 0
+        return user_id % stripe_count
+
+    def invalidate(self):
+        with self._lock:
+            self._counts = None
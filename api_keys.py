@@ -0,0 +1,118 @@
+"""
+API key authentication backed by a digest-keyed index.
+
+Keys are never compared one by one: the SHA-256 digest of the presented key is
+looked up in a dict, so the cost of authenticating stays flat however many
+partners are onboarded. Only digests are kept, and how long a lookup takes says
+nothing about the key it would take to match one.
+
+The index is filled by a `loader` (the `api_keys` table, plus an optional JSON
+file) and reloaded every `reload_interval` seconds, or right away with
+`reload()`, so keys can be added or revoked without a restart. Resolved keys are
+cached for `cache_ttl` seconds. Reloads read the database: call `resolve` from a
+sync FastAPI dependency, which runs on the thread pool, not on the event loop.
+"""
+import hashlib
+import json
+import os
+import secrets
+import threading
+import time
+
+from cachetools import TTLCache
+
+RELOAD_INTERVAL = 30
+IDENTITY_CACHE_TTL = 10
+IDENTITY_CACHE_SIZE = 10_000
+
+USER_SCOPE = "user"
+SERVICE_SCOPE = "service"
+
+
+def digest_key(api_key):
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+def generate_key():
+    return secrets.token_urlsafe(48)
+
+
+def load_key_file(path):
+    """
+    Read keys from a JSON file of the form
+    `[{"name": "service7", "key_sha256": "<hex digest>", "scopes": ["service"]}, ...]`.
+    A plain `"key"` may be given instead of `"key_sha256"`.
+    """
+    with open(path, "r", encoding="utf-8") as file:
+        entries = json.load(file)
+    for entry in entries:
+        digest = entry.get("key_sha256") or digest_key(entry["key"])
+        yield entry["name"], digest, set(entry.get("scopes", [USER_SCOPE]))
+
+
+class ApiKeyIndex:
+    """
+    Index of API keys by digest.
+
+    - **loader**: callable returning an iterable of `(name, key digest, scopes)`.
+    """
+
+    def __init__(self, loader, reload_interval=RELOAD_INTERVAL, cache_ttl=IDENTITY_CACHE_TTL,
+                 cache_size=IDENTITY_CACHE_SIZE):
+        self.loader = loader
+        self.reload_interval = reload_interval
+        self._index = {}
+        self._loaded_at = None
+        self._reload_lock = threading.Lock()
+        self._cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self._cache_lock = threading.Lock()
+
+    def reload(self):
+        names, scopes = {}, {}
+        for name, digest, key_scopes in self.loader():
+            # The same key listed twice (e.g. the admin key) gets the union of the scopes
+            names.setdefault(digest, name)
+            scopes.setdefault(digest, set()).update(key_scopes)
+        self._index = {digest: (names[digest], frozenset(scopes[digest])) for digest in names}
+        self._loaded_at = time.monotonic()
+        with self._cache_lock:
+            # A revoked key must stop working with the reload, not when its cache entry expires
+            self._cache.clear()
+
+    def _reload_if_stale(self):
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.reload_interval:
+            return
+        # Only one request pays for the reload, the others keep using the current index
+        if self._reload_lock.acquire(blocking=self._loaded_at is None):
+            try:
+                self.reload()
+            finally:
+                self._reload_lock.release()
+
+    def resolve(self, api_key, scope):
+        """Return the name the key belongs to if it is valid for `scope`, otherwise None."""
+        if not api_key:
+            return None
+        with self._cache_lock:
+            cached = self._cache.get((api_key, scope))
+        if cached is not None:
+            return cached
+
+        self._reload_if_stale()
+        name, scopes = self._index.get(digest_key(api_key), (None, ()))
+        if scope not in scopes:
+            return None
+        with self._cache_lock:
+            self._cache[(api_key, scope)] = name
+        return name
+
+    def names(self):
+        self._reload_if_stale()
+        return sorted((name, sorted(scopes)) for name, scopes in self._index.values())
+
+
+def key_file_loader(path):
+    """Loader for `ApiKeyIndex` reading the JSON key file, if it exists."""
+    if path and os.path.exists(path):
+        return list(load_key_file(path))
+    return []
@@ -0,0 +1,187 @@
+"""
+HTTP load test for the REST API.
+
+The FastAPI app runs in-process (through httpx's ASGI transport, so the startup
+hook that starts the Telegram bot is never run) against a temporary SQLite
+database, with a stub standing in for the Telegram bot. Each endpoint is hit by
+a number of concurrent clients for a fixed duration, using the keys of
+`user_api_key_map` / `services_api_key_map`.
+
+    python -m benchmarks.bench_api --profile default --output api.json [--compare baseline.json]
+    python -m benchmarks.bench_api --endpoints check-membership --concurrency 1,50 --duration 20
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+import httpx
+
+from benchmarks import datasets, fakes, harness, report
+
+PROFILES = {
+    "smoke": {"concurrency": [1, 4], "duration": 2.0},
+    "default": {"concurrency": [1, 10, 50], "duration": 10.0},
+    "stress": {"concurrency": [50, 200, 500], "duration": 30.0},
+}
+ENDPOINTS = ["check-membership", "account-details", "logs", "upload-accounts", "upload-tasks"]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="default")
+    parser.add_argument("--concurrency", help="comma separated client counts, overrides the profile")
+    parser.add_argument("--duration", type=float, help="seconds per scenario, overrides the profile")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help=f"comma separated, from {ENDPOINTS}")
+    parser.add_argument("--accounts", type=int, default=5000, help="target accounts to seed")
+    parser.add_argument("--tasks", type=int, default=500, help="Isnad tasks to seed")
+    parser.add_argument("--members", type=int, default=2000, help="Isnad users to seed")
+    parser.add_argument("--miss-ratio", type=float, default=0.1, help="share of lookups for unknown names/codes")
+    parser.add_argument("--upload-rows", type=int, default=200, help="rows per uploaded workbook")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="simulated Telegram round trip")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="keep the per-key rate limits on (429 responses are then expected)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report to this path")
+    parser.add_argument("--compare", help="previous JSON report to compare against")
+    return parser.parse_args(argv)
+
+
+def seed_members(bot, count):
+    """Insert `count` Isnad users and return their codes, half signed and half of the old format."""
+    session = bot.SessionLocal()
+    codes = []
+    for i in range(count):
+        telegram_user_id = 200_000_000 + i
+        isnad_id = bot.isnad_codes.sign(telegram_user_id) if i % 2 else bot.generate_custom_id(telegram_user_id)
+        session.add(bot.IsnadUsers(telegram_user_id=telegram_user_id, isnad_id=isnad_id))
+        codes.append(isnad_id)
+    session.commit()
+    session.close()
+    return codes
+
+
+class RequestFactory:
+    """Builds the request for one call of each endpoint."""
+
+    def __init__(self, bot, workdir, account_names, codes, miss_ratio, upload_rows, seed):
+        self.rng = random.Random(seed)
+        self.account_names = account_names
+        self.codes = codes
+        self.miss_ratio = miss_ratio
+        self.user_keys = itertools.cycle(list(bot.user_api_key_map.values()))
+        self.service_keys = itertools.cycle(list(bot.services_api_key_map.values()))
+        with open(datasets.write_target_accounts_workbook(os.path.join(workdir, "upload-accounts.xlsx"),
+                                                          upload_rows, seed + 1), "rb") as file:
+            self.accounts_workbook = file.read()
+        with open(datasets.write_isnad_tasks_workbook(os.path.join(workdir, "upload-tasks.xlsx"),
+                                                      upload_rows, seed + 1), "rb") as file:
+            self.tasks_workbook = file.read()
+
+    def _pick(self, values, missing):
+        return missing if self.rng.random() < self.miss_ratio else self.rng.choice(values)
+
+    def build(self, endpoint):
+        if endpoint == "check-membership":
+            return dict(method="POST", url="/check-membership/", headers={"api-key": next(self.service_keys)},
+                        json={"isnad_code": self._pick(self.codes, "not-a-member")})
+        if endpoint == "account-details":
+            return dict(method="GET", url="/get-target-account-details/", headers={"api-key": next(self.user_keys)},
+                        params={"account_name": self._pick(self.account_names, "unknown_account")})
+        if endpoint == "logs":
+            return dict(method="GET", url="/logs", headers={"api-key": next(self.user_keys)})
+        if endpoint == "upload-accounts":
+            return dict(method="POST", url="/upload-target-accounts/", headers={"api-key": next(self.user_keys)},
+                        files={"file": ("accounts.xlsx", self.accounts_workbook)})
+        if endpoint == "upload-tasks":
+            return dict(method="POST", url="/upload-isnad-tasks/", headers={"api-key": next(self.user_keys)},
+                        files={"file": ("tasks.xlsx", self.tasks_workbook)})
+        raise ValueError(f"Unknown endpoint {endpoint}")
+
+
+async def run_scenario(client, factory, endpoint, concurrency, duration):
+    latencies = []
+    statuses = Counter()
+    deadline = time.perf_counter() + duration
+
+    async def client_loop():
+        while time.perf_counter() < deadline:
+            request = factory.build(endpoint)
+            started = time.perf_counter()
+            try:
+                response = await client.request(**request)
+                statuses[response.status_code] += 1
+            except Exception as e:
+                statuses[type(e).__name__] += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    # 404s are expected answers for unknown names/codes; only 5xx and transport errors count as errors
+    errors = sum(count for status, count in statuses.items() if not isinstance(status, int) or status >= 500)
+    total = sum(statuses.values())
+    return {
+        "requests": total,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 2) if elapsed else 0,
+        "error_rate": round(errors / total, 4) if total else 0,
+        "status_codes": {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        "latency": report.latency_summary(latencies),
+        "histogram": report.histogram(latencies),
+    }
+
+
+async def run_all(app, factory, endpoints, concurrency_levels, duration):
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://isnad.bench", timeout=None) as client:
+        for endpoint in endpoints:
+            for concurrency in concurrency_levels:
+                print(f"  {endpoint} x{concurrency} for {duration}s ...")
+                results[f"{endpoint}@{concurrency}"] = await run_scenario(client, factory, endpoint, concurrency,
+                                                                          duration)
+    return results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    profile = PROFILES[args.profile]
+    concurrency_levels = [int(c) for c in args.concurrency.split(",")] if args.concurrency else profile["concurrency"]
+    duration = args.duration or profile["duration"]
+    endpoints = [endpoint.strip() for endpoint in args.endpoints.split(",") if endpoint.strip()]
+
+    bot, workdir = harness.load_bot(rate_limits=args.rate_limits)
+    # httpx logs every request at INFO level, which would drown the report
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    print(f"Seeding {args.accounts} target accounts, {args.tasks} tasks and {args.members} members in {workdir} ...")
+    harness.seed_database(bot, workdir, args.accounts, args.tasks, args.seed)
+    codes = seed_members(bot, args.members)
+    session = bot.SessionLocal()
+    account_names = [name for (name,) in session.query(bot.TargetAccount.account_name)]
+    session.close()
+
+    # /check-membership/ asks Telegram through the global updater; point it at the stub
+    bot.updater = SimpleNamespace(bot=fakes.StubBot(latency=args.latency_ms / 1000, seed=args.seed))
+    factory = RequestFactory(bot, workdir, account_names, codes, args.miss_ratio, args.upload_rows, args.seed)
+
+    results = asyncio.run(run_all(bot.app, factory, endpoints, concurrency_levels, duration))
+
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "compare")}
+    config.update(concurrency=concurrency_levels, duration=duration)
+    result = report.build_report("api", config, results)
+    report.print_report(result)
+    if args.output:
+        report.write_report(result, args.output)
+    if args.compare:
+        report.compare(result, args.compare)
+    return result
+
+
+if __name__ == "__main__":
+    main()
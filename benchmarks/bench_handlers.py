@@ -0,0 +1,402 @@
+"""
+Synthetic load benchmark for the Telegram handlers (`start` and `button_click`).
+
+Simulated users send `/start` and then a stream of `option1`/`option2` clicks. The
+clicks of all users are interleaved over a pool of worker threads, while each
+user's own clicks stay in order. Handlers run for real against a temporary SQLite
+database seeded through the upload endpoints, with a stub bot standing in for the
+Bot API.
+
+    python -m benchmarks.bench_handlers --users 2000 --clicks 5 --workers 8 \\
+        --latency-ms 40 --think-ms 2000 --output handlers.json [--compare baseline.json]
+
+With `--think-ms`, a user's next click only comes that long after the reply to
+the previous one, like a volunteer reading the task: that is the time the
+prefetch stage (`ISNAD_PREFETCH_TTL`, 0 disables it) has to get it ready. The
+report counts the clicks that got a task but no target account
+(`clicks_without_accounts`), which prefetch holds must not cause, and those
+that got fewer than 4 (`clicks_short_of_accounts`).
+
+With `--double-tap-ratio`, that share of the clicks is tapped a second time
+`DOUBLE_TAP_GAP` seconds later, on the same button of the same message, as
+impatient users do; the report tells how many of those repeats still sent
+messages, and how many the guard answered while the first tap was pending or
+after it was done (`double_tap_guard`).
+
+With `--dispatch`, the updates of every user go through the bot's own update
+executor (`user_dispatch.py`) and load shedding (`load_shedding.py`), all at once
+like the backlog after an announcement, or at `--arrival-rate` updates a second;
+`--workers` is the number of workers of the executor, and think time is not
+used. The report then adds the response times, queue wait included, what was
+shed, and checks that every user's updates were handled in order:
+
+    python -m benchmarks.bench_handlers --dispatch --workers 1 --latency-ms 40 --output one.json
+    python -m benchmarks.bench_handlers --dispatch --workers 8 --latency-ms 40 --compare one.json
+    ISNAD_SHED_BUSY_AFTER=10 python -m benchmarks.bench_handlers --dispatch --workers 8 --arrival-rate 80
+"""
+import argparse
+import contextlib
+import heapq
+import os
+import random
+import threading
+import time
+from collections import Counter, defaultdict, deque
+
+from sqlalchemy import event
+from telegram import Update
+
+from benchmarks import fakes, harness, report
+
+TASK_LINK_PREFIX = "<b>لينك المهمة</b>"
+DOUBLE_TAP_GAP = 0.05
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000, help="number of simulated users")
+    parser.add_argument("--clicks", type=int, default=5, help="button clicks per user after /start")
+    parser.add_argument("--option2-ratio", type=float, default=0.3,
+                        help="share of clicks asking for new target accounts instead of a new task")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="handler threads (the bot itself runs handlers on a single dispatcher thread)")
+    parser.add_argument("--accounts", type=int, default=5000, help="target accounts to seed")
+    parser.add_argument("--tasks", type=int, default=500, help="Isnad tasks to seed")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="simulated Bot API round trip")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="random extra Bot API latency")
+    parser.add_argument("--think-ms", type=float, default=0.0,
+                        help="time between the reply to a click and the same user's next click")
+    parser.add_argument("--dispatch", action="store_true",
+                        help="put the updates through the bot's update executor, with --workers workers")
+    parser.add_argument("--arrival-rate", type=float, default=0.0,
+                        help="with --dispatch, updates coming in per second (0 for all at once)")
+    parser.add_argument("--double-tap-ratio", type=float, default=0.0,
+                        help="share of clicks tapped twice in a row")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace", action="store_true", help="also write spans to the trace file")
+    parser.add_argument("--output", help="write the JSON report to this path")
+    parser.add_argument("--compare", help="previous JSON report to compare against")
+    return parser.parse_args(argv)
+
+
+def build_workload(users, clicks, option2_ratio, seed, double_tap_ratio=0.0):
+    """Per-user ordered lists of (kind, raw update, raw update of the repeated tap or None)."""
+    rng = random.Random(seed)
+    update_ids = iter(range(1, 10 ** 9))
+    workload = []
+    for user_id in range(1, users + 1):
+        telegram_user_id = 100_000_000 + user_id
+        events = [("start", fakes.start_update_data(next(update_ids), telegram_user_id), None)]
+        for click in range(clicks):
+            kind = "option2" if click and rng.random() < option2_ratio else "option1"
+            # Every click is on the keyboard of the previous reply, a message of its own
+            message_id = click + 2
+            data = fakes.callback_update_data(next(update_ids), telegram_user_id, kind, message_id)
+            repeat = None
+            if rng.random() < double_tap_ratio:
+                repeat = fakes.callback_update_data(next(update_ids), telegram_user_id, kind, message_id)
+            events.append((kind, data, repeat))
+        workload.append(deque(events))
+    return workload
+
+
+class QueryCounter:
+    """Counts SQL statements per thread."""
+
+    def __init__(self, engine):
+        self._local = threading.local()
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args):
+        self._local.count = getattr(self._local, "count", 0) + 1
+
+    def reset(self):
+        self._local.count = 0
+
+    @property
+    def count(self):
+        return getattr(self._local, "count", 0)
+
+
+def run(bot, stub_bot, workload, workers, think=0.0):
+    """Drive the handlers with `workers` threads; returns one record per handled update."""
+    query_counter = QueryCounter(bot.engine)
+    context = fakes.FakeContext(stub_bot)
+    # (ready at, order, events of a user), the user's next event is due once ready
+    ready_users = [(0.0, order, user_events) for order, user_events in enumerate(workload)]
+    heapq.heapify(ready_users)
+    order = len(ready_users)
+    ready_lock = threading.Lock()
+    records = []
+    records_lock = threading.Lock()
+
+    def worker():
+        nonlocal order
+        while True:
+            with ready_lock:
+                if not ready_users:
+                    return
+                ready_at, _, user_events = ready_users[0]
+                wait = ready_at - time.perf_counter()
+                if wait <= 0:
+                    heapq.heappop(ready_users)
+                    kind, data, repeat = user_events.popleft()
+                    if repeat is not None:
+                        # The second tap does not wait for the reply to the first one
+                        order += 1
+                        heapq.heappush(ready_users, (time.perf_counter() + DOUBLE_TAP_GAP, order,
+                                                     deque([("repeat", repeat, None)])))
+            if wait > 0:
+                time.sleep(min(wait, 0.05))
+                continue
+            update = Update.de_json(data, stub_bot)
+            sends = []
+            stub_bot.current_sink = sends
+            query_counter.reset()
+            error = None
+            started = time.perf_counter()
+            try:
+                if kind == "start":
+                    bot.start(update, context)
+                else:
+                    # Admission, as the update executor does it before queuing a tap
+                    if bot.double_tap_guard.admit(update):
+                        answer = None
+                        try:
+                            answer = bot.button_click(update, context)
+                        finally:
+                            bot.double_tap_guard.finish(update, answer)
+            except Exception as e:
+                error = repr(e)
+            finished = time.perf_counter()
+            with records_lock:
+                records.append({
+                    "kind": kind,
+                    "user_id": update.effective_user.id,
+                    "update_id": update.update_id,
+                    "started": started,
+                    "finished": finished,
+                    "queries": query_counter.count,
+                    "sends": sends,
+                    "sent_at": stub_bot.current_sent_at,
+                    "error": error,
+                })
+            # Put the user back in line, so their next click waits for this one (and the think time)
+            if user_events:
+                with ready_lock:
+                    order += 1
+                    heapq.heappush(ready_users, (finished + think, order, user_events))
+
+    threads = [threading.Thread(target=worker, name=f"bench-worker-{i}") for i in range(workers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return records, time.perf_counter() - started
+
+
+def run_dispatched(bot, stub_bot, workload, workers, arrival_rate=0.0):
+    """
+    Put every update through the bot's update executor, with `workers` workers, each user's
+    in order (repeated taps right after the tap they repeat), `arrival_rate` a second or all
+    at once; returns the records of the updates handled, as `run` does.
+    """
+    executor = bot.update_executor
+    # The threads start with the first update
+    executor.workers = workers
+    query_counter = QueryCounter(bot.engine)
+    context = fakes.FakeContext(stub_bot)
+    records = []
+    records_lock = threading.Lock()
+    kinds, queued = {}, {}
+
+    def handle(update, context):
+        kind = kinds[update.update_id]
+        sends = []
+        stub_bot.current_sink = sends
+        query_counter.reset()
+        error = answer = None
+        started = time.perf_counter()
+        try:
+            if kind == "start":
+                bot.start(update, context)
+            else:
+                answer = bot.button_click(update, context)
+        except Exception as e:
+            error = repr(e)
+        finished = time.perf_counter()
+        with records_lock:
+            records.append({
+                "kind": kind,
+                "user_id": update.effective_user.id,
+                "update_id": update.update_id,
+                "queued": queued[update.update_id],
+                "started": started,
+                "finished": finished,
+                "queries": query_counter.count,
+                "sends": sends,
+                "sent_at": stub_bot.current_sent_at,
+                "error": error,
+            })
+        return answer
+
+    # Repeated taps are answered at admission, and never reach `handle`
+    dispatch = executor.ordered(handle, guard=bot.double_tap_guard)
+    users = [deque(user_events) for user_events in workload]
+    fed = 0
+    started = time.perf_counter()
+    # Round robin over the users, as their updates would come in
+    while users:
+        for user_events in list(users):
+            kind, data, repeat = user_events.popleft()
+            taps = [(kind, data)] + ([("repeat", repeat)] if repeat is not None else [])
+            for tap_kind, tap_data in taps:
+                if arrival_rate:
+                    delay = started + fed / arrival_rate - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                update = Update.de_json(tap_data, stub_bot)
+                kinds[update.update_id], queued[update.update_id] = tap_kind, time.perf_counter()
+                dispatch(update, context)
+                fed += 1
+            if not user_events:
+                users.remove(user_events)
+    executor.join()
+    return records, time.perf_counter() - started
+
+
+def count_out_of_order(records):
+    """Count updates handled before an update of the same user that came in earlier."""
+    last_update_id = {}
+    out_of_order = 0
+    for record in sorted(records, key=lambda record: record["started"]):
+        if record["update_id"] < last_update_id.get(record["user_id"], 0):
+            out_of_order += 1
+        last_update_id[record["user_id"]] = max(record["update_id"], last_update_id.get(record["user_id"], 0))
+    return out_of_order
+
+
+def count_duplicate_accounts(records, account_links):
+    """
+    Count target accounts sent to a click while another click that was sent the same account
+    was still sending (it holds its accounts until its last send); i.e. accounts that concurrent
+    users all received.
+    """
+    served = defaultdict(list)
+    for record in records:
+        for text, sent_at in zip(record["sends"], record["sent_at"]):
+            if text in account_links:
+                served[text].append((sent_at, record["sent_at"][-1]))
+    duplicates = 0
+    for sends in served.values():
+        sends.sort()
+        latest_end = None
+        for sent_at, done_sending in sends:
+            if latest_end is not None and sent_at < latest_end:
+                duplicates += 1
+            latest_end = done_sending if latest_end is None else max(latest_end, done_sending)
+    return duplicates
+
+
+def count_repeated_tasks(records):
+    """Count tasks that were served again to a user who already received them."""
+    served = Counter()
+    for record in records:
+        for text in record["sends"]:
+            if text.startswith(TASK_LINK_PREFIX):
+                served[(record["user_id"], text.split(":", 1)[1].strip())] += 1
+    return sum(count - 1 for count in served.values() if count > 1)
+
+
+def accounts_per_click(records, account_links):
+    """The number of target accounts sent on every click that got a task (or asked for new accounts)."""
+    counts = []
+    for record in records:
+        if record["kind"] not in ("option1", "option2") or record["error"]:
+            continue
+        got_task = record["kind"] == "option2" or any(text.startswith(TASK_LINK_PREFIX) for text in record["sends"])
+        if got_task:
+            counts.append(sum(text in account_links for text in record["sends"]))
+    return counts
+
+
+def summarize_double_taps(records):
+    repeats = [record for record in records if record["kind"] == "repeat"]
+    return {"repeats": len(repeats), "repeats_that_sent_messages": sum(bool(record["sends"]) for record in repeats)}
+
+
+def summarize(records, elapsed, account_links, stub_bot):
+    by_kind = defaultdict(list)
+    for record in records:
+        by_kind[record["kind"]].append(record)
+    clicks = [record for record in records if record["kind"] != "start"]
+    errors = Counter(record["error"] for record in records if record["error"])
+    sent_accounts = accounts_per_click(records, account_links)
+    return {
+        "updates": len(records),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_updates_per_s": round(len(records) / elapsed, 2) if elapsed else 0,
+        "throughput_clicks_per_s": round(len(clicks) / elapsed, 2) if elapsed else 0,
+        "latency": {
+            kind: report.latency_summary([record["finished"] - record["started"] for record in kind_records])
+            for kind, kind_records in sorted(by_kind.items())
+        },
+        "db_queries_per_update": {
+            kind: round(sum(record["queries"] for record in kind_records) / len(kind_records), 2)
+            for kind, kind_records in sorted(by_kind.items())
+        },
+        "bot_api_calls": stub_bot.calls,
+        "duplicate_account_assignments": count_duplicate_accounts(records, account_links),
+        "repeated_task_assignments": count_repeated_tasks(records),
+        "clicks_without_accounts": sum(count == 0 for count in sent_accounts),
+        "clicks_short_of_accounts": sum(0 < count < 4 for count in sent_accounts),
+        "errors": sum(errors.values()),
+        "error_samples": dict(errors.most_common(5)),
+        "double_taps": summarize_double_taps(records),
+        "out_of_order_updates": count_out_of_order(records),
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    bot, workdir = harness.load_bot(trace=args.trace)
+    print(f"Seeding {args.accounts} target accounts and {args.tasks} tasks in {workdir} ...")
+    harness.seed_database(bot, workdir, args.accounts, args.tasks, args.seed)
+
+    session = bot.SessionLocal()
+    account_links = {link for (link,) in session.query(bot.TargetAccount.account_link)}
+    session.close()
+
+    stub_bot = fakes.StubBot(latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000, seed=args.seed)
+    workload = build_workload(args.users, args.clicks, args.option2_ratio, args.seed, args.double_tap_ratio)
+    print(f"Running {args.users} users x {args.clicks + 1} updates on {args.workers} worker(s) ...")
+    # The handlers print every served task; keep that out of the report
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if args.dispatch:
+            records, elapsed = run_dispatched(bot, stub_bot, workload, args.workers, args.arrival_rate)
+        else:
+            records, elapsed = run(bot, stub_bot, workload, args.workers, args.think_ms / 1000)
+
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "compare")}
+    summary = summarize(records, elapsed, account_links, stub_bot)
+    if args.dispatch:
+        # From the update coming in to the reply, queue wait included
+        summary["response_latency"] = report.latency_summary(
+            [record["finished"] - record["queued"] for record in records])
+        summary["updates_fed"] = sum(1 + (repeat is not None) for user_events in workload
+                                     for _, _, repeat in user_events)
+        summary["load_shedding"] = bot.load_shedder.stats()["shed"]
+    summary["prefetch"] = bot.task_prefetcher.stats()
+    summary["double_tap_guard"] = bot.double_tap_guard.stats()
+    result = report.build_report("handlers", config, summary)
+    report.print_report(result)
+    if args.output:
+        report.write_report(result, args.output)
+    if args.compare:
+        report.compare(result, args.compare)
+    return result
+
+
+if __name__ == "__main__":
+    main()
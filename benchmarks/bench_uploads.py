@@ -0,0 +1,187 @@
+"""
+Ingestion benchmark for `/upload-target-accounts/` and `/upload-isnad-tasks/`.
+
+Workbooks with the exact expected headers are generated at each requested size
+(cached in `--workdir`) and posted through the ASGI app, each case in a fresh
+process against a fresh SQLite database, so that peak memory is measured per case.
+
+Cases, for every size:
+
+- **accounts/insert**: upload target accounts into an empty table.
+- **accounts/update**: re-upload the same accounts with `--change-ratio` of them
+  changed and `--new-ratio` new ones (the daily re-upload).
+- **accounts/delta**: the same re-upload with `mode=delta`, after a delta upload of
+  the original sheet, so only the changed and new rows are written.
+- **tasks/insert**: upload a batch of tasks into an empty table.
+- **tasks/update**: upload the next batch (other tweets) over the first one.
+
+    python -m benchmarks.bench_uploads --sizes 1000,10000,100000 --output uploads.json
+    python -m benchmarks.bench_uploads --sizes 1000000 --cases accounts/update \\
+        --compare uploads.json --max-regression 0.2
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks import datasets, harness, report
+
+CASES = ["accounts/insert", "accounts/update", "accounts/delta", "tasks/insert", "tasks/update"]
+ENDPOINT_URLS = {"accounts": "/upload-target-accounts/", "tasks": "/upload-isnad-tasks/"}
+MODE_PARAMS = {"delta": {"mode": "delta"}}
+# Results where an increase is a regression
+GUARDED_RESULTS = ("elapsed_s", "peak_rss_mb", "db_growth_mb")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000", help="comma separated row counts, up to 1000000")
+    parser.add_argument("--cases", default=",".join(CASES), help=f"comma separated, from {CASES}")
+    parser.add_argument("--change-ratio", type=float, default=0.05, help="changed rows in a re-upload")
+    parser.add_argument("--new-ratio", type=float, default=0.01, help="new rows in a re-upload")
+    parser.add_argument("--workdir", help="where to generate (and cache) the workbooks")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report to this path")
+    parser.add_argument("--compare", help="previous JSON report to compare against")
+    parser.add_argument("--max-regression", type=float,
+                        help="with --compare, exit with an error if time, memory or DB growth rose by more "
+                             "than this ratio (e.g. 0.2 for 20%%)")
+    return parser.parse_args(argv)
+
+
+def workbook(workdir, name, writer, *args):
+    """Generate a workbook once and reuse it on later runs."""
+    path = os.path.join(workdir, name)
+    if not os.path.exists(path):
+        started = time.perf_counter()
+        writer(path, *args)
+        print(f"  generated {name} in {time.perf_counter() - started:.1f}s")
+    return path
+
+
+def prepare_workbooks(workdir, table, size, args):
+    """Return (preload workbook or None, timed workbook, timed rows) for each mode of a table."""
+    if table == "accounts":
+        base = workbook(workdir, f"accounts_{size}_{args.seed}.xlsx", datasets.write_target_accounts_workbook,
+                        size, args.seed)
+        changed = workbook(workdir, f"accounts_{size}_{args.seed}_changed_{args.change_ratio}_{args.new_ratio}.xlsx",
+                           datasets.write_changed_target_accounts_workbook, size, args.seed, args.change_ratio,
+                           args.new_ratio)
+        rows = size + int(size * args.new_ratio)
+        return {"insert": (None, base, size), "update": (base, changed, rows), "delta": (base, changed, rows)}
+    base = workbook(workdir, f"tasks_{size}_{args.seed}.xlsx", datasets.write_isnad_tasks_workbook, size, args.seed)
+    # Tweets already uploaded are skipped, the next batch is made of new ones
+    following = workbook(workdir, f"tasks_{size}_{args.seed}_next.xlsx", datasets.write_isnad_tasks_workbook,
+                         size, args.seed, size)
+    return {"insert": (None, base, size), "update": (base, following, size)}
+
+
+def _database_size(path):
+    return sum(os.path.getsize(f"{path}{suffix}") for suffix in ("", "-journal", "-wal")
+               if os.path.exists(f"{path}{suffix}"))
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+async def _post(app, url, path, api_key, params=None):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://isnad.bench", timeout=None) as client:
+        with open(path, "rb") as file:
+            return await client.post(url, headers={"api-key": api_key}, params=params,
+                                     files={"file": (os.path.basename(path), file)})
+
+
+def run_case(table, mode, preload_path, timed_path, case_dir, results):
+    """Runs in a child process: ingest `timed_path` (after `preload_path`, if any) into a fresh database."""
+    bot, _ = harness.load_bot(workdir=case_dir)
+    url = ENDPOINT_URLS[table]
+    params = MODE_PARAMS.get(mode)
+    if preload_path:
+        asyncio.run(_post(bot.app, url, preload_path, bot.API_KEY_ADMIN, params))
+    database = harness.database_path(bot)
+    size_before = _database_size(database)
+    rss_before = _peak_rss_mb()
+
+    started = time.perf_counter()
+    response = asyncio.run(_post(bot.app, url, timed_path, bot.API_KEY_ADMIN, params))
+    elapsed = time.perf_counter() - started
+
+    size_after = _database_size(database)
+    body = response.json()
+    results.put({
+        **{change: body[change] for change in ("inserted", "updated", "removed", "unchanged", "added",
+                                               "repeated_from_earlier_batches") if change in body},
+        "status_code": response.status_code,
+        "elapsed_s": round(elapsed, 3),
+        "peak_rss_mb": _peak_rss_mb(),
+        "rss_before_mb": rss_before,
+        "db_size_before_mb": round(size_before / 2 ** 20, 2),
+        "db_size_after_mb": round(size_after / 2 ** 20, 2),
+        "db_growth_mb": round((size_after - size_before) / 2 ** 20, 2),
+    })
+
+
+def run_in_subprocess(table, mode, preload_path, timed_path):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    with tempfile.TemporaryDirectory(prefix="isnad-upload-bench-") as case_dir:
+        process = context.Process(target=run_case, args=(table, mode, preload_path, timed_path, case_dir, results))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            return {"error": f"case process exited with {process.exitcode}"}
+        return results.get()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(",")]
+    cases = [case.strip() for case in args.cases.split(",") if case.strip()]
+    workdir = args.workdir or tempfile.mkdtemp(prefix="isnad-upload-workbooks-")
+    os.makedirs(workdir, exist_ok=True)
+
+    results = {}
+    for size in sizes:
+        print(f"Size {size} (workbooks in {workdir}):")
+        workbooks = {}
+        for case in cases:
+            table, mode = case.split("/")
+            if table not in workbooks:
+                workbooks[table] = prepare_workbooks(workdir, table, size, args)
+            preload_path, timed_path, rows = workbooks[table][mode]
+            print(f"  running {case} ...")
+            result = run_in_subprocess(table, mode, preload_path, timed_path)
+            # The rows actually written, when the endpoint tells (the tasks upload skips repeated tweets)
+            result["rows"] = result.get("added", rows)
+            if result.get("elapsed_s"):
+                result["rows_per_s"] = round(rows / result["elapsed_s"], 1)
+            results[f"{case}@{size}"] = result
+
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "compare")}
+    result = report.build_report("uploads", config, results)
+    report.print_report(result)
+    if args.output:
+        report.write_report(result, args.output)
+    if args.compare:
+        changes = report.compare(result, args.compare)
+        if args.max_regression is not None:
+            regressions = [name for name, (old, new) in changes.items()
+                           if name.endswith(GUARDED_RESULTS) and old > 0 and (new - old) / old > args.max_regression]
+            if regressions:
+                print(f"\nRegressed by more than {args.max_regression:.0%}: {', '.join(regressions)}")
+                sys.exit(1)
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Generators for `FINAL_IDs.xlsx`-shaped workbooks used by the benchmarks.
+
+The target accounts sheet mirrors the columns and value ranges of the bundled
+`FINAL_IDs.xlsx`, the tasks sheet the columns expected by `/upload-isnad-tasks/`.
+"""
+import random
+
+from openpyxl import Workbook
+
+TARGET_ACCOUNT_HEADERS = ["ACCOUNT_NAME", "ACCOUNT_ID", "ACCOUNT_LINK", "ACCOUNT_STATUS", "ACCOUNT_CATEGORY",
+                          "ACCOUNT_TYPE", "PUBLISHING_LEVEL", "ACCESS_LEVEL"]
+ISNAD_TASK_HEADERS = ["TASK_URL", "TASK_TARGET_TYPE"]
+
+# Roughly the spread of the bundled sheet: most accounts are of type 1, then 2, then untyped
+ACCOUNT_TYPES = [1, 2, 0, None]
+ACCOUNT_TYPE_WEIGHTS = [0.5, 0.2, 0.15, 0.15]
+TASK_TARGET_TYPES = [1, 2, 0]
+TASK_TARGET_TYPE_WEIGHTS = [0.6, 0.25, 0.15]
+
+
+def target_account_rows(count, seed=0, start=0):
+    """Yield `count` target account rows, deterministic for a given `seed`."""
+    rng = random.Random(seed)
+    for i in range(start, start + count):
+        account_name = f"bench_account_{i}"
+        yield (
+            account_name,
+            str(10_000_000 + i),
+            f"https://x.com/{account_name}",
+            "T",
+            rng.randint(1, 3),
+            rng.choices(ACCOUNT_TYPES, ACCOUNT_TYPE_WEIGHTS)[0],
+            rng.randint(1, 3),
+            rng.randint(1, 4),
+        )
+
+
+def changed_target_account_rows(count, seed=0, change_ratio=0.05, new_ratio=0.01):
+    """
+    Yield the rows of `target_account_rows(count, seed)` as they would look in a later
+    re-upload: `change_ratio` of them with a new status and publishing level, plus
+    `new_ratio * count` new accounts at the end.
+    """
+    rng = random.Random(seed + 1)
+    for row in target_account_rows(count, seed):
+        if rng.random() < change_ratio:
+            row = row[:3] + ("S",) + row[4:6] + (rng.randint(1, 3),) + row[7:]
+        yield row
+    yield from target_account_rows(int(count * new_ratio), seed + 2, start=count)
+
+
+def isnad_task_rows(count, seed=0, start=0):
+    """Yield `count` Isnad task rows, deterministic for a given `seed`, of the tweets numbered from `start`."""
+    rng = random.Random(seed)
+    for i in range(start, start + count):
+        tweet_id = 1_700_000_000_000_000_000 + i
+        yield (
+            f"https://x.com/bench_user_{i % 500}/status/{tweet_id}",
+            rng.choices(TASK_TARGET_TYPES, TASK_TARGET_TYPE_WEIGHTS)[0],
+        )
+
+
+def write_workbook(path, headers, rows):
+    """Write `rows` under `headers` with a write-only workbook, so large sheets stay in constant memory."""
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(headers)
+    for row in rows:
+        sheet.append(row)
+    workbook.save(path)
+    return path
+
+
+def write_target_accounts_workbook(path, count, seed=0, start=0):
+    return write_workbook(path, TARGET_ACCOUNT_HEADERS, target_account_rows(count, seed, start))
+
+
+def write_changed_target_accounts_workbook(path, count, seed=0, change_ratio=0.05, new_ratio=0.01):
+    return write_workbook(path, TARGET_ACCOUNT_HEADERS,
+                          changed_target_account_rows(count, seed, change_ratio, new_ratio))
+
+
+def write_isnad_tasks_workbook(path, count, seed=0, start=0):
+    return write_workbook(path, ISNAD_TASK_HEADERS, isnad_task_rows(count, seed, start))
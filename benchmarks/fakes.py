@@ -0,0 +1,130 @@
+"""
+Stand-ins for the Telegram side of the bot, so the real handlers can be driven offline.
+
+Updates are real `telegram.Update` objects built with `Update.de_json`, bound to a
+`StubBot` that records every Bot API call instead of sending it.
+"""
+import itertools
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+
+class StubBot:
+    """
+    Records sends instead of calling the Bot API, optionally sleeping `latency`
+    seconds (plus up to `jitter` seconds) per call to mimic the round trip.
+    """
+
+    defaults = None
+    id = 1
+    username = "IsnadStubBot"
+
+    def __init__(self, latency=0.0, jitter=0.0, member_status="member", seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.member_status = member_status
+        self.sends = defaultdict(list)
+        self.calls = 0
+        self._rng = random.Random(seed)
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def current_sink(self):
+        """List that sends of the current thread are also appended to (set by the benchmark driver)."""
+        return getattr(self._local, "sink", None)
+
+    @current_sink.setter
+    def current_sink(self, sink):
+        self._local.sink = sink
+        self._local.sent_at = []
+
+    @property
+    def current_sent_at(self):
+        """`time.perf_counter()` of each send appended to the current sink."""
+        return getattr(self._local, "sent_at", [])
+
+    def _round_trip(self):
+        with self._lock:
+            self.calls += 1
+            delay = self.latency + (self._rng.random() * self.jitter if self.jitter else 0.0)
+        if delay:
+            time.sleep(delay)
+
+    def get_chat_member(self, chat_id, user_id, *args, **kwargs):
+        self._round_trip()
+        return SimpleNamespace(status=self.member_status, user=SimpleNamespace(id=user_id))
+
+    def answer_callback_query(self, callback_query_id, *args, **kwargs):
+        self._round_trip()
+        return True
+
+    def send_message(self, chat_id, text, *args, **kwargs):
+        self._round_trip()
+        with self._lock:
+            self.sends[chat_id].append(text)
+        sink = self.current_sink
+        if sink is not None:
+            sink.append(text)
+            self._local.sent_at.append(time.perf_counter())
+        return SimpleNamespace(message_id=next(self._message_ids), chat_id=chat_id, text=text)
+
+
+class FakeContext:
+    """The parts of `CallbackContext` the handlers use."""
+
+    def __init__(self, bot, dispatcher=None):
+        self.bot = bot
+        self.dispatcher = dispatcher
+
+
+def _user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+
+def _message(message_id, user_id, text=None, from_bot=False):
+    message = {
+        "message_id": message_id,
+        "date": int(datetime.now(timezone.utc).timestamp()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": 1, "is_bot": True, "first_name": "IsnadBot"} if from_bot else _user(user_id),
+    }
+    if text is not None:
+        message["text"] = text
+    return message
+
+
+def command_update_data(update_id, user_id, command, message_id=1):
+    """Raw update of a user sending a bot `command` such as `/start`."""
+    message = _message(message_id, user_id, text=command)
+    message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+    return {"update_id": update_id, "message": message}
+
+
+def start_update_data(update_id, user_id, message_id=1):
+    """Raw update of a user sending `/start`."""
+    return command_update_data(update_id, user_id, "/start", message_id)
+
+
+def text_update_data(update_id, user_id, text="...", message_id=1):
+    """Raw update of a user sending a plain text message."""
+    return {"update_id": update_id, "message": _message(message_id, user_id, text=text)}
+
+
+def callback_update_data(update_id, user_id, data, message_id=1):
+    """Raw update of a user pressing an inline keyboard button carrying `data`."""
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": _user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": _message(message_id, user_id, text="menu", from_bot=True),
+        },
+    }
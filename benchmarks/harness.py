@@ -0,0 +1,56 @@
+"""
+Helpers to load the bot module against a throw-away SQLite database and seed it.
+"""
+import asyncio
+import importlib
+import os
+import tempfile
+
+from starlette.datastructures import UploadFile
+
+from benchmarks import datasets
+
+
+def load_bot(workdir=None, trace=False, rate_limits=False):
+    """
+    Import `IsnadTasksBot` bound to a fresh SQLite database in `workdir`.
+
+    Rate limiting is off unless `rate_limits` is set, so a load test measures the
+    endpoints rather than the per-key budget.
+
+    The environment must be set before the first import, since the engine and the
+    tracer are configured at import time.
+    """
+    workdir = workdir or tempfile.mkdtemp(prefix="isnad-bench-")
+    os.environ["ISNAD_DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["ISNAD_TRACING"] = "1" if trace else "0"
+    os.environ["ISNAD_RATE_LIMITING"] = "1" if rate_limits else "0"
+    os.environ.setdefault("ISNAD_TRACE_FILE", os.path.join(workdir, "isnad_traces.json"))
+    os.environ.setdefault("ISNAD_CODE_SECRET", "benchmark")
+    return importlib.import_module("IsnadTasksBot"), workdir
+
+
+def database_path(bot):
+    return bot.engine.url.database
+
+
+def upload_workbook(bot, endpoint, path, **params):
+    """
+    Run an upload endpoint (e.g. `bot.upload_target_accounts`) on the workbook at `path`.
+    Called directly, the endpoint gets no query parameter defaults: pass them all in `params`.
+    """
+    session = bot.SessionLocal()
+    try:
+        with open(path, "rb") as file:
+            upload = UploadFile(file, filename=os.path.basename(path))
+            return asyncio.run(endpoint(api_key="benchmark", file=upload, db=session, **params))
+    finally:
+        session.close()
+
+
+def seed_database(bot, workdir, accounts, tasks, seed=0):
+    """Generate `FINAL_IDs.xlsx`-shaped sheets and load them through the real upload endpoints."""
+    accounts_path = datasets.write_target_accounts_workbook(os.path.join(workdir, "accounts.xlsx"), accounts, seed)
+    tasks_path = datasets.write_isnad_tasks_workbook(os.path.join(workdir, "tasks.xlsx"), tasks, seed)
+    upload_workbook(bot, bot.upload_target_accounts, accounts_path, mode="full", remove_missing=False)
+    upload_workbook(bot, bot.upload_isnad_tasks, tasks_path, allow_repeats=False)
@@ -0,0 +1,110 @@
+"""
+Local mock of the two GraphQL operations used by `graphql_resolver`.
+
+Answers `TweetResultsByRestIds` and `UsersByRestIds` with deterministic results
+depending on the id (modulo 20): 0 is suspended (a tombstone for tweets), 1 does
+not exist, 2 is unavailable (protected), everything else is active. Requests
+whose query string is longer than `MAX_GQL_CHAR_LIMIT` get a 414, like an
+oversized request to the real API. With `rate_limit`, each operation allows
+that many requests per `window_seconds`, answers with the `x-rate-limit-*`
+headers and returns 429 past the limit.
+
+    python -m benchmarks.mock_graphql --port 8765 --latency-ms 150 --rate-limit 500
+    ISNAD_TWITTER_GRAPHQL_URL=http://127.0.0.1:8765/graphql python ...
+
+In-process, pass `httpx.AsyncClient(transport=httpx.ASGITransport(app=create_app()))`
+as the resolver's `client`.
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter, defaultdict, deque
+
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse
+
+from constants import MAX_GQL_CHAR_LIMIT
+
+
+def _kind(id_):
+    return {0: "suspended", 1: "missing", 2: "unavailable"}.get(int(id_) % 20, "active")
+
+
+def tweet_entry(tweet_id):
+    kind = _kind(tweet_id)
+    if kind == "missing":
+        return {}
+    if kind == "suspended":
+        return {"result": {"__typename": "TweetTombstone", "tombstone": {"text": {"text": "This Tweet was deleted"}}}}
+    if kind == "unavailable":
+        return {"result": {"__typename": "TweetUnavailable", "reason": "Protected"}}
+    return {"result": {"__typename": "Tweet", "rest_id": tweet_id,
+                       "legacy": {"full_text": f"mock tweet {tweet_id}", "favorite_count": int(tweet_id) % 1000}}}
+
+
+def user_entry(user_id):
+    kind = _kind(user_id)
+    if kind == "missing":
+        return {}
+    if kind == "suspended":
+        return {"result": {"__typename": "UserUnavailable", "reason": "Suspended"}}
+    if kind == "unavailable":
+        return {"result": {"__typename": "UserUnavailable", "reason": "Protected"}}
+    return {"result": {"__typename": "User", "rest_id": user_id,
+                       "legacy": {"screen_name": f"mock_user_{user_id}", "followers_count": int(user_id) % 5000}}}
+
+
+def create_app(latency=0.0, rate_limit=None, window_seconds=15 * 60):
+    app = FastAPI(title="Mock Twitter GraphQL")
+    app.state.requests = Counter()
+    app.state.rate_limited = Counter()
+    sent = defaultdict(deque)
+
+    @app.get("/graphql/{query_id}/{name}")
+    async def graphql(query_id: str, name: str, request: Request, response: Response):
+        if len(request.url.query) > MAX_GQL_CHAR_LIMIT:
+            raise HTTPException(status_code=414, detail="Request-URI Too Long")
+        if rate_limit:
+            now, window = time.monotonic(), sent[name]
+            while window and window[0] <= now - window_seconds:
+                window.popleft()
+            reset_at = int(time.time() + (window[0] + window_seconds - now if window else window_seconds)) + 1
+            if len(window) >= rate_limit:
+                app.state.rate_limited[name] += 1
+                return JSONResponse({"errors": [{"message": "Rate limit exceeded", "code": 88}]}, status_code=429,
+                                    headers={"x-rate-limit-limit": str(rate_limit), "x-rate-limit-remaining": "0",
+                                             "x-rate-limit-reset": str(reset_at)})
+            window.append(now)
+            response.headers["x-rate-limit-limit"] = str(rate_limit)
+            response.headers["x-rate-limit-remaining"] = str(rate_limit - len(window))
+            response.headers["x-rate-limit-reset"] = str(reset_at)
+        app.state.requests[name] += 1
+        if latency:
+            await asyncio.sleep(latency)
+        variables = json.loads(request.query_params["variables"])
+        if name == "TweetResultsByRestIds":
+            return {"data": {"tweetResult": [tweet_entry(tweet_id) for tweet_id in variables["tweetIds"]]}}
+        if name == "UsersByRestIds":
+            return {"data": {"users": [user_entry(user_id) for user_id in variables["userIds"]]}}
+        raise HTTPException(status_code=404, detail=f"Operation {name} is not mocked")
+
+    return app
+
+
+def main(argv=None):
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=int, help="requests per operation and window, unlimited by default")
+    parser.add_argument("--window-seconds", type=float, default=15 * 60)
+    args = parser.parse_args(argv)
+    uvicorn.run(create_app(args.latency_ms / 1000, args.rate_limit, args.window_seconds), host=args.host,
+                port=args.port)
+
+
+if __name__ == "__main__":
+    main()
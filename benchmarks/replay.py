@@ -0,0 +1,174 @@
+"""
+Replay a traffic recording (see `recorder.py`) through the real dispatcher.
+
+Updates are rebuilt from the recording and put on the dispatcher queue at their
+recorded offsets, divided by `--speed` (`1` for real time, `10` for ten times
+faster, `0` for as fast as possible). The handlers run against a temporary
+SQLite database and a stub bot, so production-shaped bursts can be reproduced
+offline. The updates go through the bot's update executor and load shedding
+(see `ISNAD_SHED_*` in load_shedding.py); the taps shed are reported under `shed`.
+
+    python -m benchmarks.replay traffic.jsonl.gz --speed 5 --latency-ms 40 \\
+        --output replay.json [--compare baseline.json]
+"""
+import argparse
+import contextlib
+import os
+import threading
+import time
+from collections import defaultdict
+
+from telegram import Update
+from telegram.ext import Dispatcher
+
+import recorder
+import tracing
+import user_dispatch
+from benchmarks import fakes, harness, report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recording", help="gzipped JSON lines file written by the recorder")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed factor, 0 for no pacing")
+    parser.add_argument("--limit", type=int, help="replay only the first N updates")
+    parser.add_argument("--accounts", type=int, default=5000, help="target accounts to seed")
+    parser.add_argument("--tasks", type=int, default=500, help="Isnad tasks to seed")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="simulated Bot API round trip")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="random extra Bot API latency")
+    parser.add_argument("--dispatch-workers", type=int, default=user_dispatch.DISPATCH_WORKERS,
+                        help="handler workers (updates of a user are still handled in order)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace", action="store_true", help="also write spans to the trace file")
+    parser.add_argument("--output", help="write the JSON report to this path")
+    parser.add_argument("--compare", help="previous JSON report to compare against")
+    return parser.parse_args(argv)
+
+
+def to_update_data(record, update_id):
+    """Rebuild a raw update from a recorded line."""
+    message_id = record.get("m") or 1
+    if record["k"] == "cb":
+        return fakes.callback_update_data(update_id, record["u"], record["d"], message_id)
+    if record["k"] == "cmd":
+        return fakes.command_update_data(update_id, record["u"], record["d"], message_id)
+    return fakes.text_update_data(update_id, record["u"], message_id=message_id)
+
+
+def kind_of(record):
+    return f"{record['k']}:{record['d']}" if record.get("d") else record["k"]
+
+
+class ReplayProbe:
+    """Measures the time from putting an update on the queue until its handler is done with it."""
+
+    def __init__(self):
+        self.enqueued = {}
+        self.kinds = {}
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def on_put(self, update, kind):
+        with self._lock:
+            self.enqueued[update.update_id] = time.perf_counter()
+            self.kinds[update.update_id] = kind
+
+    def on_handled(self, update, context):
+        finished = time.perf_counter()
+        with self._lock:
+            started = self.enqueued.pop(update.update_id, None)
+            if started is not None:
+                self.latencies[self.kinds.pop(update.update_id)].append(finished - started)
+
+    def on_error(self, update, context):
+        with self._lock:
+            self.errors[repr(context.error)] += 1
+
+
+def replay(bot, stub_bot, records, speed, dispatch_workers):
+    update_queue = tracing.TimedQueue()
+    dispatcher = Dispatcher(stub_bot, update_queue, workers=1)
+    executor = bot.update_executor
+    # The threads start with the first update
+    executor.workers = dispatch_workers
+    bot.register_handlers(dispatcher)
+    probe = ReplayProbe()
+    # The dispatcher only queues the updates, the probe hears from the workers once they are handled
+    executor.listeners.append(probe.on_handled)
+    dispatcher.add_error_handler(probe.on_error)
+
+    ready = threading.Event()
+    dispatcher_thread = threading.Thread(target=dispatcher.start, args=(ready,), name="replay-dispatcher",
+                                         daemon=True)
+    dispatcher_thread.start()
+    if not ready.wait(10):
+        raise RuntimeError("The dispatcher did not start")
+
+    max_backlog = 0
+    started = time.perf_counter()
+    for update_id, record in enumerate(records, start=1):
+        if speed > 0:
+            delay = started + record["t"] / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        update = Update.de_json(to_update_data(record, update_id), stub_bot)
+        probe.on_put(update, kind_of(record))
+        update_queue.put(update)
+        max_backlog = max(max_backlog, update_queue.qsize() + executor.queue_depth)
+    fed = time.perf_counter() - started
+    update_queue.join()
+    executor.join()
+    elapsed = time.perf_counter() - started
+    dispatcher.stop()
+    return probe, fed, elapsed, max_backlog
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    records = list(recorder.read_recording(args.recording))
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        raise SystemExit(f"No updates found in {args.recording}")
+
+    bot, workdir = harness.load_bot(trace=args.trace)
+    print(f"Seeding {args.accounts} target accounts and {args.tasks} tasks in {workdir} ...")
+    harness.seed_database(bot, workdir, args.accounts, args.tasks, args.seed)
+    stub_bot = fakes.StubBot(latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000, seed=args.seed)
+
+    recorded_duration = records[-1]["t"] - records[0]["t"]
+    print(f"Replaying {len(records)} updates recorded over {recorded_duration:.1f}s at {args.speed}x ...")
+    # The handlers print every served task; keep that out of the report
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        probe, fed, elapsed, max_backlog = replay(bot, stub_bot, records, args.speed, args.dispatch_workers)
+
+    all_latencies = [latency for latencies in probe.latencies.values() for latency in latencies]
+    results = {
+        "updates": len(records),
+        "users": len({record["u"] for record in records}),
+        "recorded_duration_s": round(recorded_duration, 3),
+        "feed_duration_s": round(fed, 3),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_updates_per_s": round(len(records) / elapsed, 2) if elapsed else 0,
+        "max_backlog": max_backlog,
+        "latency": report.latency_summary(all_latencies),
+        "latency_by_kind": {kind: report.latency_summary(latencies)
+                            for kind, latencies in sorted(probe.latencies.items())},
+        "bot_api_calls": stub_bot.calls,
+        "shed": bot.load_shedder.stats()["shed"],
+        "errors": sum(probe.errors.values()),
+        "error_samples": dict(sorted(probe.errors.items(), key=lambda item: -item[1])[:5]),
+    }
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "compare")}
+    result = report.build_report("replay", config, results)
+    report.print_report(result)
+    if args.output:
+        report.write_report(result, args.output)
+    if args.compare:
+        report.compare(result, args.compare)
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Shared reporting helpers for the benchmarks.
+
+Every benchmark produces a JSON report of the shape
+`{"benchmark": ..., "config": {...}, "results": {...}}`. Passing a previous
+report with `--compare` prints the change of every numeric result, so a report
+saved from the main branch acts as the regression baseline.
+"""
+import json
+import platform
+import statistics
+import subprocess
+from datetime import datetime, timezone
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of `values`."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(int(round(percent / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def latency_summary(seconds):
+    """Summarise a list of durations in seconds as milliseconds."""
+    if not seconds:
+        return {"count": 0}
+    return {
+        "count": len(seconds),
+        "mean_ms": round(statistics.fmean(seconds) * 1000, 3),
+        "p50_ms": round(percentile(seconds, 50) * 1000, 3),
+        "p90_ms": round(percentile(seconds, 90) * 1000, 3),
+        "p95_ms": round(percentile(seconds, 95) * 1000, 3),
+        "p99_ms": round(percentile(seconds, 99) * 1000, 3),
+        "max_ms": round(max(seconds) * 1000, 3),
+    }
+
+
+def histogram(seconds, bounds_ms=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)):
+    """Count durations per latency bucket, the last bucket holding everything above the largest bound."""
+    buckets = {f"<={bound}ms": 0 for bound in bounds_ms}
+    buckets[f">{bounds_ms[-1]}ms"] = 0
+    for duration in seconds:
+        duration_ms = duration * 1000
+        for bound in bounds_ms:
+            if duration_ms <= bound:
+                buckets[f"<={bound}ms"] += 1
+                break
+        else:
+            buckets[f">{bounds_ms[-1]}ms"] += 1
+    return buckets
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_report(name, config, results):
+    return {
+        "benchmark": name,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "git_revision": _git_revision(),
+        "python": platform.python_version(),
+        "config": config,
+        "results": results,
+    }
+
+
+def write_report(report, path):
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2, ensure_ascii=False)
+
+
+def _flatten(results, prefix=""):
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{name}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, value
+
+
+def compare(report, baseline_path):
+    """
+    Print how every numeric result changed relative to the report saved at `baseline_path`.
+
+    Returns `{name: (old, new)}` for the results present in both reports.
+    """
+    with open(baseline_path, "r", encoding="utf-8") as file:
+        baseline = json.load(file)
+    previous = dict(_flatten(baseline.get("results", {})))
+    changes = {}
+    print(f"\nCompared to {baseline_path} ({baseline.get('git_revision')}):")
+    for name, value in _flatten(report["results"]):
+        if name not in previous:
+            continue
+        old = previous[name]
+        changes[name] = (old, value)
+        change = f"{(value - old) / old * 100:+.1f}%" if old else "n/a"
+        print(f"  {name:<55} {old:>12} -> {value:<12} ({change})")
+    return changes
+
+
+def print_report(report):
+    print(json.dumps(report["results"], indent=2, ensure_ascii=False))
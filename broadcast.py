@@ -0,0 +1,284 @@
+"""
+Broadcast of a notice to every Isnad user.
+
+A broadcast is a row of the `broadcasts` table and runs in a background
+thread. Users are walked in id order, a page at a time, and after every page
+the id of the last user reached and the counters are saved: after a restart,
+`resume` picks the running broadcasts up where they stopped (the users of an
+unsaved page, at most one page, may get the notice twice).
+
+Telegram lets a bot send about 30 messages a second in all. Broadcasts take
+what the replies of the bot leave of it from the bot-wide `SendBudget` (see
+send_budget.py): all of it while nobody clicks, less as the clicks pick up. On a
+flood error the budget is paused for as long as Telegram asks, for every
+broadcast.
+
+The notice is checked before a broadcast starts: an unclosed Markdown entity
+would otherwise fail the send to every user, one by one. Network errors are
+retried; any other error only fails the send to that user, and the broadcast
+goes on.
+"""
+import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from telegram.error import (BadRequest, NetworkError, RetryAfter, TelegramError,
+                            Unauthorized)
+
+from send_budget import SendBudget
+
+PAGE_SIZE = 100
+RATE_WINDOW_SECONDS = 30
+MAX_ATTEMPTS = 3
+# Seconds before retrying after a network error, times the attempt
+NETWORK_RETRY_DELAY = 1
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+CANCELLED = "cancelled"
+FAILED = "failed"
+
+logger = logging.getLogger(__name__)
+
+
+def markdown_error(text):
+    """
+    Why Telegram would refuse `text` as (legacy) Markdown, None when it would not.
+
+    Only looks for what a hand-written notice gets wrong: an entity left open.
+    """
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char == "\\":
+            i += 2
+            continue
+        if text.startswith("```", i):
+            end = text.find("```", i + 3)
+            if end < 0:
+                return f"``` at character {i} is not closed"
+            i = end + 3
+        elif char in "*_`":
+            end = text.find(char, i + 1)
+            if end < 0:
+                return f"{char} at character {i} is not closed"
+            i = end + 1
+        elif char == "[":
+            end = text.find("]", i + 1)
+            if end < 0:
+                return f"[ at character {i} is not closed"
+            i = end + 1
+            if text.startswith("(", i):
+                end = text.find(")", i + 1)
+                if end < 0:
+                    return f"( at character {i} is not closed"
+                i = end + 1
+        else:
+            i += 1
+    return None
+
+
+class _Progress:
+    """Send times of a running broadcast, for its rate."""
+
+    def __init__(self):
+        self.sends = deque()
+        self.cancelled = threading.Event()
+
+    def record(self, now):
+        self.sends.append(now)
+        while self.sends and self.sends[0] < now - RATE_WINDOW_SECONDS:
+            self.sends.popleft()
+
+    def rate(self, now):
+        while self.sends and self.sends[0] < now - RATE_WINDOW_SECONDS:
+            self.sends.popleft()
+        if not self.sends:
+            return 0.0
+        return len(self.sends) / max(now - self.sends[0], 1.0)
+
+
+class Broadcaster:
+    """
+    - **model**: the broadcast model (`message`, `status`, `total`, `sent`, `failed`, `blocked`,
+      `last_user_id`, `started_at`, `finished_at`, `error`).
+    - **user_model**: the users to send to, with `id` and `telegram_user_id`.
+    - **get_bot**: returns the `telegram.Bot` to send with.
+    - **reply_markup**: returns the keyboard sent with the notice.
+    - **budget**: the bot-wide `SendBudget` the sends are taken from.
+    """
+
+    def __init__(self, session_factory, model, user_model, get_bot, reply_markup=None, budget=None,
+                 page_size=PAGE_SIZE):
+        self.session_factory = session_factory
+        self.model = model
+        self.user_model = user_model
+        self.get_bot = get_bot
+        self.reply_markup = reply_markup
+        self.page_size = page_size
+        self.budget = budget or SendBudget()
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def create(self, message):
+        """Save and start a broadcast of `message`; raises ValueError when it is not valid Markdown."""
+        error = markdown_error(message)
+        if error:
+            raise ValueError(f"The message is not valid Markdown: {error}")
+        session = self.session_factory()
+        try:
+            broadcast = self.model(message=message, status=PENDING, sent=0, failed=0, blocked=0,
+                                   total=session.query(self.user_model).count())
+            session.add(broadcast)
+            session.commit()
+            broadcast_id = broadcast.id
+        finally:
+            session.close()
+        self.start(broadcast_id)
+        return broadcast_id
+
+    def start(self, broadcast_id):
+        with self._lock:
+            if broadcast_id in self._running:
+                return
+            progress = self._running[broadcast_id] = _Progress()
+        threading.Thread(target=self._run, args=(broadcast_id, progress), name=f"broadcast-{broadcast_id}",
+                         daemon=True).start()
+
+    def resume(self):
+        """Restart the broadcasts interrupted by a restart; returns their ids."""
+        session = self.session_factory()
+        try:
+            broadcast_ids = [broadcast_id for (broadcast_id,) in session.query(self.model.id).filter(
+                self.model.status.in_((PENDING, RUNNING)))]
+        finally:
+            session.close()
+        for broadcast_id in broadcast_ids:
+            self.start(broadcast_id)
+        return broadcast_ids
+
+    def cancel(self, broadcast_id):
+        with self._lock:
+            progress = self._running.get(broadcast_id)
+        if progress:
+            progress.cancelled.set()
+            return True
+        return self._set_status(broadcast_id, CANCELLED, only_from=(PENDING, RUNNING))
+
+    def _set_status(self, broadcast_id, status, only_from=None, **values):
+        session = self.session_factory()
+        try:
+            query = session.query(self.model).filter(self.model.id == broadcast_id)
+            if only_from:
+                query = query.filter(self.model.status.in_(only_from))
+            updated = query.update({"status": status, **values}, synchronize_session=False)
+            session.commit()
+            return bool(updated)
+        finally:
+            session.close()
+
+    def _send(self, bot, telegram_user_id, message, progress):
+        """Send to one user; returns "sent", "blocked" or "failed"."""
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            if not self.budget.take(progress.cancelled):
+                return None
+            try:
+                bot.send_message(chat_id=telegram_user_id, text=message, parse_mode="Markdown",
+                                 reply_markup=self.reply_markup() if self.reply_markup else None)
+                progress.record(time.monotonic())
+                return "sent"
+            except RetryAfter as e:
+                # Flood control: every broadcast waits (in `take`), the replies to users go on
+                self.budget.pause(e.retry_after)
+            except Unauthorized:
+                # The user blocked the bot
+                return "blocked"
+            except BadRequest:
+                return "failed"
+            except NetworkError as e:
+                # Timeouts, connection resets...
+                if attempt == MAX_ATTEMPTS:
+                    logger.warning(f"Broadcast to {telegram_user_id} failed: {e}")
+                    return "failed"
+                time.sleep(NETWORK_RETRY_DELAY * attempt)
+            except TelegramError as e:
+                # e.g. ChatMigrated: this user only, the broadcast goes on
+                logger.warning(f"Broadcast to {telegram_user_id} failed: {e}")
+                return "failed"
+        return "failed"
+
+    def _run(self, broadcast_id, progress):
+        try:
+            session = self.session_factory()
+            try:
+                broadcast = session.get(self.model, broadcast_id)
+                message, after_id = broadcast.message, broadcast.last_user_id
+                counts = {"sent": broadcast.sent or 0, "failed": broadcast.failed or 0,
+                          "blocked": broadcast.blocked or 0}
+                broadcast.status = RUNNING
+                broadcast.started_at = broadcast.started_at or datetime.utcnow()
+                session.commit()
+            finally:
+                session.close()
+
+            bot = self.get_bot()
+            while not progress.cancelled.is_set():
+                session = self.session_factory()
+                try:
+                    query = session.query(self.user_model.id, self.user_model.telegram_user_id)
+                    if after_id is not None:
+                        query = query.filter(self.user_model.id > after_id)
+                    users = query.order_by(self.user_model.id).limit(self.page_size).all()
+                finally:
+                    session.close()
+                if not users:
+                    break
+                for user_id, telegram_user_id in users:
+                    outcome = self._send(bot, telegram_user_id, message, progress)
+                    if outcome is None:
+                        break
+                    counts[outcome] += 1
+                    after_id = user_id
+                # Checkpoint
+                self._set_status(broadcast_id, RUNNING, last_user_id=after_id, **counts)
+
+            if progress.cancelled.is_set():
+                self._set_status(broadcast_id, CANCELLED, last_user_id=after_id, finished_at=datetime.utcnow(),
+                                 **counts)
+            else:
+                self._set_status(broadcast_id, DONE, finished_at=datetime.utcnow(), **counts)
+            logger.info(f"Broadcast {broadcast_id}: {counts['sent']} sent, {counts['blocked']} blocked, "
+                        f"{counts['failed']} failed")
+        except Exception as e:
+            logger.exception(f"Broadcast {broadcast_id} failed")
+            self._set_status(broadcast_id, FAILED, error=f"{type(e).__name__}: {e}", finished_at=datetime.utcnow())
+        finally:
+            with self._lock:
+                self._running.pop(broadcast_id, None)
+
+    def details(self, broadcast):
+        """Progress of a broadcast, with its current send rate and the seconds left."""
+        with self._lock:
+            progress = self._running.get(broadcast.id)
+        done = (broadcast.sent or 0) + (broadcast.failed or 0) + (broadcast.blocked or 0)
+        remaining = max((broadcast.total or 0) - done, 0)
+        rate = progress.rate(time.monotonic()) if progress else 0.0
+        return {
+            "id": broadcast.id,
+            "status": broadcast.status,
+            "message": broadcast.message,
+            "total": broadcast.total,
+            "sent": broadcast.sent,
+            "blocked": broadcast.blocked,
+            "failed": broadcast.failed,
+            "remaining": remaining,
+            "send_rate_per_second": round(rate, 2),
+            "eta_seconds": round(remaining / rate) if rate else None,
+            "created_at": broadcast.created_at,
+            "started_at": broadcast.started_at,
+            "finished_at": broadcast.finished_at,
+            "error": broadcast.error,
+        }
@@ -0,0 +1,118 @@
+"""
+Guard against double taps on the inline keyboards.
+
+Users often tap a button several times while the reply is on its way, and every
+tap is a callback query of its own: without a guard, each one would get a task
+and target accounts of its own and the same messages would go out again.
+
+The guard works at admission, on the dispatcher thread (see
+`UserOrderedExecutor.ordered` in user_dispatch.py), so a repeated tap never
+waits in the user's queue behind the click it repeats. A tap is only queued if
+the same button of the same message is not queued or being handled already, and
+was not handled in the last `WINDOW_SECONDS`; the user's other taps are queued
+behind it as usual. The repeated taps are answered right away (which stops the spinner on the button), without
+touching the database or sending any message: while the first click is pending
+with the pending notice, after it with the answer the handler returned for it
+(what it sent), or the done notice if it returned none.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cachetools import TTLCache
+from telegram.error import TelegramError
+
+# Counted from the end of the first click. Replies come with a new keyboard, so pressing the
+# same button of the same message again is hardly ever meant.
+WINDOW_SECONDS = float(os.getenv("ISNAD_DOUBLE_TAP_WINDOW", "30"))
+MAX_CLICKS = 100_000
+
+RUN = "run"
+# The same button of the same message is queued or being handled
+PENDING = "pending"
+# The same button of the same message was handled a moment ago
+DONE = "done"
+
+logger = logging.getLogger(__name__)
+
+
+def click_of(update):
+    """`(user_id, message_id, callback data)` of the tap in `update`."""
+    query = update.callback_query
+    return query.from_user.id, query.message.message_id if query.message else None, query.data
+
+
+class CallbackGuard:
+    """
+    - **notices**: `{PENDING: text, DONE: text}`, shown to the user on a repeated tap.
+    """
+
+    def __init__(self, notices=None, window=WINDOW_SECONDS, max_clicks=MAX_CLICKS):
+        self.notices = notices or {}
+        self.window = window
+        # Clicks queued or being handled
+        self._in_flight = set()
+        # click -> what the handler answered for it
+        self._done = TTLCache(maxsize=max_clicks, ttl=max(window, 0.001))
+        self._lock = threading.Lock()
+        # Answers go out on their own threads, the dispatcher thread must not wait on the Bot API
+        self._answers = ThreadPoolExecutor(max_workers=2, thread_name_prefix="repeat-answer")
+        self.repeats = {PENDING: 0, DONE: 0}
+
+    def begin(self, click):
+        """
+        `(RUN, None)` if the click is to be handled (its update then has to be `finish`ed or `cancel`led),
+        else `(PENDING, answer)` or `(DONE, answer)`.
+        """
+        with self._lock:
+            if click in self._in_flight:
+                outcome, answer = PENDING, self.notices.get(PENDING)
+            elif click in self._done:
+                outcome, answer = DONE, self._done[click] or self.notices.get(DONE)
+            else:
+                self._in_flight.add(click)
+                return RUN, None
+            self.repeats[outcome] += 1
+            return outcome, answer
+
+    def finish(self, update, answer=None):
+        """The click of `update` has been handled; its repeats are answered with `answer` from now on."""
+        if update.callback_query is None:
+            return
+        click = click_of(update)
+        with self._lock:
+            self._in_flight.discard(click)
+            if self.window > 0:
+                self._done[click] = answer
+
+    def cancel(self, update):
+        """The click of `update` was dropped before it was handled."""
+        if update.callback_query is None:
+            return
+        with self._lock:
+            self._in_flight.discard(click_of(update))
+
+    def admit(self, update):
+        """Whether to queue `update`; a repeated tap is answered instead."""
+        if update.callback_query is None:
+            return True
+        outcome, answer = self.begin(click_of(update))
+        if outcome == RUN:
+            return True
+        self._answer(update.callback_query, answer)
+        return False
+
+    def _answer(self, query, text):
+        def answer():
+            try:
+                query.answer(text=text)
+            except TelegramError as e:
+                # e.g. the query is too old to be answered
+                logger.debug(f"Could not answer a repeated callback query: {e}")
+        self._answers.submit(answer)
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._in_flight), "recent_clicks": len(self._done),
+                    "repeats_pending": self.repeats[PENDING], "repeats_done": self.repeats[DONE]}
@@ -8,6 +8,7 @@ MAX_ENDPOINT_LIMIT = 500  # 500/15 mins
 MAX_IMAGE_SIZE = 5_242_880  # ~5 MB
 MAX_GIF_SIZE = 15_728_640  # ~15 MB
 MAX_VIDEO_SIZE = 536_870_912  # ~530 MB
+MAX_BOT_UPLOAD_SIZE = 52_428_800  # 50 MB, the most a bot can upload to Telegram
 
 UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
 MEDIA_UPLOAD_SUCCEED = 'succeeded'
@@ -0,0 +1,121 @@
+"""
+Delta sync of an uploaded sheet into a table.
+
+The sheet is loaded into a pandas DataFrame and every row is hashed at once
+(`pandas.util.hash_pandas_object`) over the synced columns. The hashes are
+compared, by key, with the `row_hash` stored on each row, so only inserted,
+changed and (optionally) removed rows are written, with bulk statements.
+
+Rows without a stored hash (written by a full upload) are hashed from their
+stored values the first time, and their hash is saved.
+"""
+import numpy as np
+import pandas as pd
+
+WRITE_CHUNK_SIZE = 500
+
+
+def read_sheet(file, columns):
+    """
+    Load the sheet as strings, like SQLite stores them in the String columns, with
+    empty cells as None. `columns` maps the sheet headers to attribute names.
+    """
+    frame = pd.read_excel(file, dtype=str, engine="openpyxl")
+    missing = [header for header in columns if header not in frame.columns]
+    if missing:
+        raise ValueError(f"Missing columns: {', '.join(missing)}")
+    frame = frame[list(columns)].rename(columns=columns)
+    return frame.astype(object).where(frame.notna(), None)
+
+
+def row_hashes(frame, attributes):
+    """
+    64-bit hash of each row over `attributes`, as signed integers to fit an SQLite INTEGER.
+    The nullable Int64 dtype keeps them exact through outer merges (float64 would round them).
+    """
+    if frame.empty:
+        return pd.array([], dtype="Int64")
+    return pd.array(pd.util.hash_pandas_object(frame[attributes], index=False).to_numpy().view("int64"),
+                    dtype="Int64")
+
+
+def _python_value(value):
+    if value is None or value is pd.NA or (isinstance(value, float) and np.isnan(value)):
+        return None
+    if isinstance(value, np.integer):
+        return int(value)
+    return value
+
+
+def _chunks(records):
+    for start in range(0, len(records), WRITE_CHUNK_SIZE):
+        yield records[start:start + WRITE_CHUNK_SIZE]
+
+
+def sync_sheet(session, model, frame, key, remove_missing=False, name_attribute=None):
+    """
+    Write the rows of `frame` that differ from `model`'s table, matching rows on `key`.
+
+    - **remove_missing**: also delete the rows whose key is not in the sheet.
+    - **name_attribute**: collect the old and new values of this attribute of every
+      written row, e.g. to invalidate a cache keyed on it.
+
+    Returns `(summary, names)`. The caller commits.
+    """
+    attributes = list(frame.columns)
+    summary = {"inserted": 0, "updated": 0, "removed": 0, "unchanged": 0, "skipped": 0, "hashes_backfilled": 0}
+
+    # Rows without a key cannot be matched, the last of duplicated keys wins like in a full upload
+    keyed = frame[frame[key].notna()]
+    summary["skipped"] = len(frame) - len(keyed)
+    sheet = keyed.drop_duplicates(subset=key, keep="last").copy()
+    summary["skipped"] += len(keyed) - len(sheet)
+    sheet["row_hash"] = row_hashes(sheet, attributes)
+
+    other_attributes = [attribute for attribute in attributes if attribute != key]
+    stored = pd.DataFrame(
+        session.query(model.id, getattr(model, key), model.row_hash,
+                      *(getattr(model, attribute) for attribute in other_attributes)).all(),
+        columns=["id", key, "row_hash"] + other_attributes, dtype=object)
+    stored = stored[stored[key].notna()].drop_duplicates(subset=key, keep="first")
+    stored["id"] = stored["id"].astype("Int64")
+    legacy = stored["row_hash"].isna()
+    stored["row_hash"] = stored["row_hash"].astype("Int64")
+    if legacy.any():
+        stored.loc[legacy, "row_hash"] = row_hashes(stored[legacy], attributes)
+
+    merged = sheet.merge(stored[["id", key, "row_hash"] + ([name_attribute] if name_attribute else [])],
+                         on=key, how="outer", suffixes=("", "_stored"), indicator=True)
+    new_rows = merged[merged["_merge"] == "left_only"]
+    matched = merged[merged["_merge"] == "both"]
+    same_hash = (matched["row_hash"] == matched["row_hash_stored"]).fillna(False).astype(bool)
+    changed = matched[~same_hash]
+    unchanged = matched[same_hash]
+    removed = merged[merged["_merge"] == "right_only"] if remove_missing else merged.iloc[0:0]
+
+    def records(rows, with_id):
+        columns = (["id"] if with_id else []) + attributes + ["row_hash"]
+        return [{column: _python_value(value) for column, value in zip(columns, row)}
+                for row in rows[columns].itertuples(index=False, name=None)]
+
+    for chunk in _chunks(records(new_rows, with_id=False)):
+        session.bulk_insert_mappings(model, chunk)
+    for chunk in _chunks(records(changed, with_id=True)):
+        session.bulk_update_mappings(model, chunk)
+    removed_ids = [int(row_id) for row_id in removed["id"]]
+    for chunk in _chunks(removed_ids):
+        session.query(model).filter(model.id.in_(chunk)).delete(synchronize_session=False)
+    backfilled = unchanged[unchanged["id"].isin(stored.loc[legacy, "id"])]
+    for chunk in _chunks([{"id": int(row_id), "row_hash": int(row_hash)}
+                          for row_id, row_hash in zip(backfilled["id"], backfilled["row_hash"])]):
+        session.bulk_update_mappings(model, chunk)
+
+    summary.update(inserted=len(new_rows), updated=len(changed), removed=len(removed_ids),
+                   unchanged=len(unchanged), hashes_backfilled=len(backfilled))
+    names = set()
+    if name_attribute:
+        for column in (name_attribute, f"{name_attribute}_stored"):
+            for rows in (new_rows, changed, removed):
+                if column in rows:
+                    names.update(name for name in map(_python_value, rows[column]) if name is not None)
+    return summary, names
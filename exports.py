@@ -0,0 +1,81 @@
+"""
+Keyset pagination and streaming exports of database tables.
+
+Rows are read in chunks ordered by primary key, each chunk starting after the
+last id of the previous one (`WHERE id > :after_id ORDER BY id LIMIT :n`), so
+a page costs the same wherever it is in the table. Exports use a new session
+per chunk: SQLite read locks are released between chunks and a long export
+never holds up uploads or the bot.
+"""
+import csv
+import io
+import os
+import tempfile
+
+from openpyxl import Workbook
+
+EXPORT_CHUNK_SIZE = 1_000
+XLSX_READ_SIZE = 64 * 1024
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+def keyset_page(session, model, conditions, after_id=None, limit=100):
+    """Return `(rows, next_after_id)`; `next_after_id` is None on the last page."""
+    query = session.query(model).filter(*conditions)
+    if after_id is not None:
+        query = query.filter(model.id > after_id)
+    rows = query.order_by(model.id).limit(limit + 1).all()
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1].id
+    return rows, None
+
+
+def iter_rows(session_factory, model, conditions, to_row, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield `to_row(instance)` for every matching row, one session and one query per chunk."""
+    after_id = None
+    while True:
+        session = session_factory()
+        try:
+            instances, after_id = keyset_page(session, model, conditions, after_id, chunk_size)
+            rows = [to_row(instance) for instance in instances]
+        finally:
+            session.close()
+        yield from rows
+        if after_id is None:
+            return
+
+
+def csv_chunks(headers, rows, rows_per_chunk=EXPORT_CHUNK_SIZE):
+    """Encode `rows` as CSV, yielding about `rows_per_chunk` rows at a time."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(headers)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(["" if value is None else value for value in row])
+        if count % rows_per_chunk == 0:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+
+def write_xlsx(headers, rows):
+    """
+    Write `rows` to a temporary xlsx file with a write-only workbook, which keeps
+    memory flat however many rows there are. Returns the path; the caller deletes it.
+    """
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(headers)
+    for row in rows:
+        sheet.append(row)
+    file_descriptor, path = tempfile.mkstemp(prefix="isnad-export-", suffix=".xlsx")
+    os.close(file_descriptor)
+    workbook.save(path)
+    return path
+
+
+def file_chunks(path, chunk_size=XLSX_READ_SIZE):
+    with open(path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            yield chunk
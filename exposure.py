@@ -0,0 +1,49 @@
+"""
+Fair exposure of target accounts and tasks.
+
+Every account and task counts the times it was handed out (`served_count`) and
+when it last was (`last_served_at`). The rotation serves the least served
+accounts first, through an index on the count, and the tasks in proportion to
+their priority (see task_sampler.py), instead of flagging rows used and
+resetting the flags of a whole pool once it runs out: nothing is ever reset, a
+new account is served until it catches up with the others, and the counts tell
+how evenly every category was exposed.
+"""
+import math
+
+from sqlalchemy import case, func
+
+
+def exposure_stats(session, model, group_by):
+    """
+    Per value of the `group_by` column: the number of rows, the times they were served in
+    total, and the spread of their `served_count` (min, max, mean, standard deviation).
+    """
+    served = func.coalesce(model.served_count, 0)
+    rows = session.query(
+        group_by,
+        func.count(model.id),
+        func.sum(served),
+        func.sum(served * served),
+        func.min(served),
+        func.max(served),
+        func.sum(case((served == 0, 1), else_=0)),
+        func.max(model.last_served_at),
+    ).group_by(group_by).order_by(group_by).all()
+
+    stats = []
+    for key, count, total, total_of_squares, minimum, maximum, never_served, last_served_at in rows:
+        mean = total / count if count else 0.0
+        variance = max(total_of_squares / count - mean * mean, 0.0) if count else 0.0
+        stats.append({
+            group_by.key: key,
+            "count": count,
+            "served": total or 0,
+            "min_served": minimum,
+            "max_served": maximum,
+            "mean_served": round(mean, 2),
+            "stddev_served": round(math.sqrt(variance), 2),
+            "never_served": never_served or 0,
+            "last_served_at": last_served_at,
+        })
+    return stats
@@ -0,0 +1,245 @@
+"""
+Batched resolution of tweet and account ids through Twitter's GraphQL API.
+
+Ids are packed into as few `TweetResultsByRestIds` / `UsersByRestIds` requests
+as fit under `constants.MAX_GQL_CHAR_LIMIT` (the query string, features
+included), the requests run concurrently, and every result is cached for
+`cache_ttl` seconds, so checking a batch of tasks or accounts twice costs one
+round of requests. Every request first takes a slot from a
+`twitter_scheduler.RequestScheduler`, which keeps each operation inside its
+15-minute budget and sends interactive lookups before background refreshes.
+
+An id is only `NOT_FOUND` when its entry comes back empty or as a tombstone. A
+response without the expected `data` (auth, query id or feature flag errors, a
+schema change) raises `ResolverError`, and ids whose entry an error left empty
+are `UNKNOWN`; neither is cached.
+
+The base URL and the auth headers come from the environment, so the resolver
+can be pointed at a local mock server (see `benchmarks/mock_graphql.py`):
+
+    ISNAD_TWITTER_GRAPHQL_URL=http://127.0.0.1:8765/graphql
+    ISNAD_TWITTER_BEARER_TOKEN=...  ISNAD_TWITTER_AUTH_TOKEN=...  ISNAD_TWITTER_CT0=...
+"""
+import asyncio
+import json
+import os
+import threading
+from urllib.parse import quote, urlencode
+
+import httpx
+from cachetools import TTLCache
+
+import twitter_scheduler
+from constants import MAX_GQL_CHAR_LIMIT, Operation
+
+GRAPHQL_URL = os.getenv("ISNAD_TWITTER_GRAPHQL_URL", "https://twitter.com/i/api/graphql")
+CACHE_TTL = 15 * 60
+CACHE_SIZE = 100_000
+MAX_CONCURRENCY = 4
+REQUEST_TIMEOUT = 20
+MAX_ATTEMPTS = 3
+
+# Statuses of a resolved tweet or account
+ACTIVE = "active"
+SUSPENDED = "suspended"
+NOT_FOUND = "not_found"
+UNAVAILABLE = "unavailable"
+# The response did not tell, e.g. the entry was left empty by an error
+UNKNOWN = "unknown"
+
+TWEET_VARIABLES = {"withCommunity": False, "includePromotedContent": False, "withVoice": False}
+USER_VARIABLES = {"withSafetyModeUserFields": True}
+
+
+def default_headers():
+    headers = {}
+    if os.getenv("ISNAD_TWITTER_BEARER_TOKEN"):
+        headers["authorization"] = f"Bearer {os.getenv('ISNAD_TWITTER_BEARER_TOKEN')}"
+    if os.getenv("ISNAD_TWITTER_AUTH_TOKEN") and os.getenv("ISNAD_TWITTER_CT0"):
+        headers["cookie"] = f"auth_token={os.getenv('ISNAD_TWITTER_AUTH_TOKEN')}; ct0={os.getenv('ISNAD_TWITTER_CT0')}"
+        headers["x-csrf-token"] = os.getenv("ISNAD_TWITTER_CT0")
+    return headers
+
+
+def _dumps(value):
+    return json.dumps(value, separators=(",", ":"))
+
+
+def query_params(ids_variable, ids, variables):
+    return {"variables": _dumps({**variables, ids_variable: [str(i) for i in ids]}),
+            "features": _dumps(Operation.default_features)}
+
+
+def chunk_ids(ids_variable, ids, variables, limit=MAX_GQL_CHAR_LIMIT):
+    """Split `ids` into lists whose request query string stays within `limit` characters."""
+    chunks, current = [], []
+    length = len(urlencode(query_params(ids_variable, [], variables)))
+    separator = len(quote(","))
+    for id_ in ids:
+        cost = len(quote(_dumps(str(id_)))) + (separator if current else 0)
+        if current and length + cost > limit:
+            chunks.append(current)
+            current, length = [], len(urlencode(query_params(ids_variable, [], variables)))
+            cost -= separator
+        current.append(id_)
+        length += cost
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class ResolverError(Exception):
+    """A response that does not tell the status of the ids it was asked for."""
+
+
+def _entries(body, key):
+    """The result list of a response, `ResolverError` if it has none."""
+    data = body.get("data") if isinstance(body, dict) else None
+    entries = data.get(key) if isinstance(data, dict) else None
+    if not isinstance(entries, list):
+        errors = body.get("errors") if isinstance(body, dict) else None
+        raise ResolverError(f"No {key} in the response: {_dumps(errors) if errors else 'unexpected body'}"[:500])
+    return entries
+
+
+def _parse(chunk, body, key, id_of, status_of):
+    results = {id_: {"status": UNKNOWN, "result": None} for id_ in chunk}
+    entries = _entries(body, key)
+    errors = body.get("errors")
+    for id_, entry in zip(chunk, entries):
+        result = (entry or {}).get("result")
+        if not result and errors:
+            # Left empty by an error, not a missing tweet or account
+            continue
+        id_ = id_of(result) or id_
+        if id_ in results:
+            results[id_] = {"status": status_of(result), "result": result}
+    return results
+
+
+def tweet_status(result):
+    typename = (result or {}).get("__typename")
+    if typename in ("Tweet", "TweetWithVisibilityResults"):
+        return ACTIVE
+    if typename == "TweetTombstone" or not result:
+        return NOT_FOUND
+    return UNAVAILABLE
+
+
+def user_status(result):
+    typename = (result or {}).get("__typename")
+    if typename == "User":
+        return ACTIVE
+    if typename == "UserUnavailable":
+        return SUSPENDED if result.get("reason") == "Suspended" else UNAVAILABLE
+    return NOT_FOUND
+
+
+class GraphQLResolver:
+    """
+    - **client**: an `httpx.AsyncClient` to use, e.g. one with an ASGI transport in tests.
+    - **scheduler**: the `RequestScheduler` shared by everything calling Twitter.
+    """
+
+    def __init__(self, base_url=GRAPHQL_URL, headers=None, client=None, scheduler=None, cache_ttl=CACHE_TTL,
+                 cache_size=CACHE_SIZE, max_concurrency=MAX_CONCURRENCY):
+        self.base_url = base_url.rstrip("/")
+        self.headers = default_headers() if headers is None else headers
+        self.client = client
+        self.scheduler = scheduler or twitter_scheduler.RequestScheduler()
+        self.max_concurrency = max_concurrency
+        self._cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self._cache_lock = threading.Lock()
+        self.requests_sent = 0
+
+    async def resolve_tweets(self, tweet_ids, priority=twitter_scheduler.INTERACTIVE):
+        """Return `{tweet_id: {"status": ..., "result": ...}}` for every id, see `ResolverError`."""
+        return await self._resolve(Operation.TweetResultsByRestIds, "tweetIds", TWEET_VARIABLES, tweet_ids,
+                                   self._parse_tweets, priority)
+
+    async def resolve_users(self, user_ids, priority=twitter_scheduler.INTERACTIVE):
+        """Return `{user_id: {"status": ..., "result": ...}}` for every id, see `ResolverError`."""
+        return await self._resolve(Operation.UsersByRestIds, "userIds", USER_VARIABLES, user_ids,
+                                   self._parse_users, priority)
+
+    async def _resolve(self, operation, ids_variable, variables, ids, parse, priority):
+        _, query_id, name = operation
+        ids = [str(id_) for id_ in dict.fromkeys(ids)]
+        resolved = {}
+        with self._cache_lock:
+            for id_ in ids:
+                cached = self._cache.get((name, id_))
+                if cached is not None:
+                    resolved[id_] = cached
+        missing = [id_ for id_ in ids if id_ not in resolved]
+        if not missing:
+            return resolved
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        url = f"{self.base_url}/{query_id}/{name}"
+
+        async def fetch(client, chunk):
+            for attempt in range(1, MAX_ATTEMPTS + 1):
+                await self.scheduler.acquire(name, priority)
+                async with semaphore:
+                    response = await client.get(url, params=query_params(ids_variable, chunk, variables),
+                                                headers=self.headers)
+                self.requests_sent += 1
+                self._observe(name, response)
+                # A 429 closed the window until its reset, the next acquire waits for it
+                if response.status_code == 429 and attempt < MAX_ATTEMPTS:
+                    continue
+                response.raise_for_status()
+                return parse(chunk, response.json())
+
+        client = self.client or httpx.AsyncClient(timeout=REQUEST_TIMEOUT)
+        try:
+            for results in await asyncio.gather(*(fetch(client, chunk) for chunk in
+                                                  chunk_ids(ids_variable, missing, variables))):
+                resolved.update(results)
+        finally:
+            if self.client is None:
+                await client.aclose()
+
+        with self._cache_lock:
+            for id_ in missing:
+                if resolved[id_]["status"] != UNKNOWN:
+                    self._cache[(name, id_)] = resolved[id_]
+        return resolved
+
+    def _observe(self, name, response):
+        headers = response.headers
+        if response.status_code == 429:
+            retry_after = headers.get("retry-after")
+            reset_at = headers.get("x-rate-limit-reset")
+            if retry_after and retry_after.isdigit():
+                self.scheduler.observe(name, retry_after=int(retry_after))
+            elif reset_at and reset_at.isdigit():
+                self.scheduler.observe(name, remaining=0, reset_at=int(reset_at))
+            else:
+                self.scheduler.observe(name, retry_after=twitter_scheduler.WINDOW_SECONDS)
+        elif headers.get("x-rate-limit-remaining", "").isdigit() and headers.get("x-rate-limit-reset", "").isdigit():
+            self.scheduler.observe(name, remaining=int(headers["x-rate-limit-remaining"]),
+                                   reset_at=int(headers["x-rate-limit-reset"]))
+
+    @staticmethod
+    def _parse_tweets(chunk, body):
+        # Results carry their id, fall back on the request order for tombstones that do not
+        return _parse(chunk, body, "tweetResult",
+                      lambda result: (result or {}).get("rest_id") or (result or {}).get("tweet", {}).get("rest_id"),
+                      tweet_status)
+
+    @staticmethod
+    def _parse_users(chunk, body):
+        return _parse(chunk, body, "users", lambda result: (result or {}).get("rest_id"), user_status)
+
+    def has_credentials(self):
+        return "authorization" in self.headers or "cookie" in self.headers
+
+    def cache_info(self):
+        with self._cache_lock:
+            return {"size": len(self._cache), "requests_sent": self.requests_sent}
+
+    def budget(self):
+        """Budget left and expected drain time of every operation, see `RequestScheduler.status`."""
+        return self.scheduler.status()
@@ -0,0 +1,93 @@
+"""
+Signed Isnad codes.
+
+A code carries the Telegram user id and an HMAC-SHA256 tag of it, truncated to
+64 bits, so `/check-membership/` can check a code and get the user id back
+without a database lookup, and a code cannot be made up from a user id.
+
+    I1 + base32(user id on 7 bytes + 8 bytes of tag)    e.g. I1AAAADHI3TDAGKPFHJRJW5KLO
+
+Codes of the old format (each digit of the user id mapped to three letters,
+see `generate_custom_id`) never start with `I1`; they are still looked up in
+`isnad_users`. A user with such a code gets a signed one in its place on their
+next `/start`, which retires the old code.
+
+The key comes from `ISNAD_CODE_SECRET`, or else from a key file created on
+first use (`ISNAD_CODE_SECRET_FILE`, `./isnad_code.secret` by default). Changing
+the key invalidates every signed code (re-issued on `/start` as well).
+"""
+import base64
+import functools
+import hashlib
+import hmac
+import os
+import secrets
+import tempfile
+
+PREFIX = "I1"
+USER_ID_BYTES = 7
+TAG_BYTES = 8
+CODE_LENGTH = len(PREFIX) + 24  # 15 bytes are 24 base32 characters, without padding
+SECRET_FILE = os.getenv("ISNAD_CODE_SECRET_FILE", "./isnad_code.secret")
+
+
+def _create_secret_file():
+    """Create the key file, or read the one another process created first."""
+    secret = secrets.token_hex(32).encode()
+    # Written in full under a temporary name, then linked into place: a reader never sees a
+    # partly written key, and a key file another process got in first is never overwritten
+    file_descriptor, temporary_path = tempfile.mkstemp(prefix=".isnad_code.secret-",
+                                                       dir=os.path.dirname(os.path.abspath(SECRET_FILE)))
+    try:
+        with os.fdopen(file_descriptor, "wb") as file:
+            file.write(secret)
+        os.link(temporary_path, SECRET_FILE)
+    except FileExistsError:
+        with open(SECRET_FILE, "rb") as file:
+            return file.read()
+    finally:
+        os.remove(temporary_path)
+    return secret
+
+
+# Read once: signing and checking a code never touch the disk
+@functools.lru_cache(maxsize=None)
+def _secret():
+    secret = os.getenv("ISNAD_CODE_SECRET")
+    if secret:
+        return secret.encode()
+    try:
+        with open(SECRET_FILE, "rb") as file:
+            return file.read()
+    except FileNotFoundError:
+        return _create_secret_file()
+
+
+def _tag(payload):
+    return hmac.new(_secret(), PREFIX.encode() + payload, hashlib.sha256).digest()[:TAG_BYTES]
+
+
+def sign(user_id):
+    """The signed code of a Telegram user id."""
+    payload = int(user_id).to_bytes(USER_ID_BYTES, "big")
+    return PREFIX + base64.b32encode(payload + _tag(payload)).decode()
+
+
+def is_signed(code):
+    """Whether `code` is in the signed format, whether or not its tag is valid."""
+    return code.strip().upper().startswith(PREFIX)
+
+
+def user_id(code):
+    """The Telegram user id of a signed code, or None if it is not one or was tampered with."""
+    code = code.strip().upper()
+    if len(code) != CODE_LENGTH or not code.startswith(PREFIX):
+        return None
+    try:
+        raw = base64.b32decode(code[len(PREFIX):])
+    except ValueError:
+        return None
+    payload, tag = raw[:USER_ID_BYTES], raw[USER_ID_BYTES:]
+    if not hmac.compare_digest(tag, _tag(payload)):
+        return None
+    return int.from_bytes(payload, "big")
@@ -0,0 +1,117 @@
+"""
+Load shedding when the update backlog grows.
+
+During announcement spikes, updates come in faster than the workers can handle
+them, and the replies reach the users minutes late, after they have tapped a
+few more times. The age of the oldest update waiting for a worker (see
+user_dispatch.py) drives three steps of degradation, each past its own
+threshold in seconds (0 turns a step off):
+
+- `SKIP_AFTER`: the sends that are not needed to do the task (the header of the
+  target accounts, the batch media) are skipped.
+- `SUPERSEDE_AFTER`: a new tap replaces the taps of the same user still waiting
+  for a worker, which are only answered.
+- `BUSY_AFTER`: taps are answered right away with a "busy, retry shortly" alert
+  and dropped, so the backlog stops growing: the taps already in it are still
+  handled, and wait at most about as long as it takes to drain what came in
+  during the last `BUSY_AFTER` seconds.
+
+Commands such as `/start` are always queued. Every shed event is counted.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram.error import TelegramError
+
+SKIP_AFTER = float(os.getenv("ISNAD_SHED_SKIP_AFTER", "5"))
+SUPERSEDE_AFTER = float(os.getenv("ISNAD_SHED_SUPERSEDE_AFTER", "15"))
+BUSY_AFTER = float(os.getenv("ISNAD_SHED_BUSY_AFTER", "30"))
+
+NORMAL = "normal"
+SKIPPING = "skipping_optional_sends"
+SUPERSEDING = "superseding_taps"
+BUSY = "busy"
+
+logger = logging.getLogger(__name__)
+
+
+class LoadShedder:
+    """
+    - **executor**: the `UserOrderedExecutor` whose backlog is watched; the shedder becomes its admission.
+    - **busy_notice**: the alert shown on the taps dropped while the bot is busy.
+    """
+
+    def __init__(self, executor, busy_notice, skip_after=SKIP_AFTER, supersede_after=SUPERSEDE_AFTER,
+                 busy_after=BUSY_AFTER):
+        self.executor = executor
+        self.busy_notice = busy_notice
+        self.skip_after = skip_after
+        self.supersede_after = supersede_after
+        self.busy_after = busy_after
+        executor.admission = self.admit
+        # Answers go out on their own threads, the dispatcher thread must not wait on the Bot API
+        self._answers = ThreadPoolExecutor(max_workers=2, thread_name_prefix="shed-answer")
+        self._lock = threading.Lock()
+        self.shed = {"busy": 0, "superseded": 0, "skipped_sends": {}}
+
+    def level(self, backlog_age=None):
+        backlog_age = self.executor.oldest_wait() if backlog_age is None else backlog_age
+        for step, threshold in ((BUSY, self.busy_after), (SUPERSEDING, self.supersede_after),
+                                (SKIPPING, self.skip_after)):
+            if threshold and backlog_age >= threshold:
+                return step
+        return NORMAL
+
+    def _answer(self, query, text=None):
+        def answer():
+            try:
+                query.answer(text=text, show_alert=bool(text))
+            except TelegramError as e:
+                # e.g. the query is too old to be answered
+                logger.debug(f"Could not answer a shed callback query: {e}")
+        self._answers.submit(answer)
+
+    def admit(self, update, context):
+        """Whether to queue `update`; taps are answered and dropped while the bot is busy."""
+        query = update.callback_query
+        if query is None:
+            return True
+        level = self.level()
+        if level == BUSY:
+            with self._lock:
+                self.shed["busy"] += 1
+            self._answer(query, self.busy_notice)
+            return False
+        if level == SUPERSEDING:
+            replaced = self.executor.drop_waiting(
+                update.effective_user.id, lambda handler, waiting, *_: waiting.callback_query is not None)
+            with self._lock:
+                self.shed["superseded"] += len(replaced)
+            for _, waiting, _, guard in replaced:
+                if guard is not None:
+                    # Never handled, so the new tap is not a repeat of it
+                    guard.cancel(waiting)
+                self._answer(waiting.callback_query)
+        return True
+
+    def allows(self, send):
+        """Whether the optional `send` is to go out, counted as skipped if not."""
+        if self.level() == NORMAL:
+            return True
+        with self._lock:
+            self.shed["skipped_sends"][send] = self.shed["skipped_sends"].get(send, 0) + 1
+        return False
+
+    def stats(self):
+        backlog_age = self.executor.oldest_wait()
+        with self._lock:
+            return {
+                "level": self.level(backlog_age),
+                "backlog_age_seconds": round(backlog_age, 3),
+                "thresholds_seconds": {SKIPPING: self.skip_after, SUPERSEDING: self.supersede_after,
+                                       BUSY: self.busy_after},
+                "shed": {"busy": self.shed["busy"], "superseded": self.shed["superseded"],
+                         "skipped_sends": dict(self.shed["skipped_sends"])},
+            }
@@ -0,0 +1,175 @@
+"""
+Media attached to task batches, sent to Telegram once and then by `file_id`.
+
+Images, GIFs and videos uploaded for a batch are streamed to `MEDIA_DIR` in
+`UPLOAD_CHUNK_SIZE` pieces, never held in memory whole, and checked against the
+size ceilings of `constants.py`, at most the 50 MB a bot can upload to Telegram. The first time a media is sent to a user it is
+uploaded to Telegram; the `file_id` Telegram returns is kept, in memory and in
+the database, and every later send (after a restart too) reuses it, so the file
+itself goes up only once.
+
+The `file_id`s of a batch are dropped when its media change or when the batch
+is replaced by a new upload of tasks.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+
+from telegram.error import BadRequest
+
+from constants import (MAX_BOT_UPLOAD_SIZE, MAX_GIF_SIZE, MAX_IMAGE_SIZE,
+                       MAX_VIDEO_SIZE, UPLOAD_CHUNK_SIZE)
+
+MEDIA_DIR = os.getenv("ISNAD_MEDIA_DIR", "./media")
+
+PHOTO = "photo"
+ANIMATION = "animation"
+VIDEO = "video"
+# Larger files would be accepted here, fail to upload and be tried again on every send
+MAX_SIZES = {kind: min(size, MAX_BOT_UPLOAD_SIZE)
+             for kind, size in {PHOTO: MAX_IMAGE_SIZE, ANIMATION: MAX_GIF_SIZE, VIDEO: MAX_VIDEO_SIZE}.items()}
+EXTENSIONS = {".jpg": PHOTO, ".jpeg": PHOTO, ".png": PHOTO, ".webp": PHOTO, ".gif": ANIMATION,
+              ".mp4": VIDEO, ".mov": VIDEO, ".m4v": VIDEO}
+
+
+class MediaError(ValueError):
+    pass
+
+
+def media_kind(filename, content_type=None):
+    """`photo`, `animation` or `video`, from the file extension or else the content type."""
+    kind = EXTENSIONS.get(os.path.splitext(filename or "")[1].lower())
+    if kind is None and content_type:
+        if content_type == "image/gif":
+            kind = ANIMATION
+        elif content_type.startswith("image/"):
+            kind = PHOTO
+        elif content_type.startswith("video/"):
+            kind = VIDEO
+    if kind is None:
+        raise MediaError("Only images (jpg, png, webp), GIFs and videos (mp4, mov) can be attached")
+    return kind
+
+
+async def save_upload(upload, kind, media_dir=MEDIA_DIR):
+    """
+    Stream an `UploadFile` to `media_dir`, stopping as soon as it goes over the size
+    ceiling of `kind`. Files are named after their SHA-256, so the same file uploaded
+    twice is stored once. Returns `(path, size, sha256)`.
+    """
+    os.makedirs(media_dir, exist_ok=True)
+    max_size = MAX_SIZES[kind]
+    digest, size = hashlib.sha256(), 0
+    file_descriptor, temporary_path = tempfile.mkstemp(prefix=".upload-", dir=media_dir)
+    try:
+        with os.fdopen(file_descriptor, "wb") as file:
+            while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_size:
+                    raise MediaError(f"The {kind} is larger than the {max_size // (1024 * 1024)} MB allowed")
+                digest.update(chunk)
+                file.write(chunk)
+        if size == 0:
+            raise MediaError("The file is empty")
+        sha256 = digest.hexdigest()
+        path = os.path.join(media_dir, sha256 + os.path.splitext(upload.filename or "")[1].lower())
+        os.replace(temporary_path, path)
+        return path, size, sha256
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+def _file_id(message):
+    attachment = message.effective_attachment
+    # Photos come back in every size, the largest last
+    if isinstance(attachment, list):
+        attachment = attachment[-1]
+    return attachment.file_id
+
+
+class FileIdCache:
+    """
+    The media of every batch with their Telegram `file_id`, loaded from `model`
+    (`id`, `batch_id`, `kind`, `path`, `telegram_file_id`) the first time a batch is sent.
+    Batch ids are keyed as strings: the tasks table may return an all-digit id as an int.
+    """
+
+    def __init__(self, session_factory, model):
+        self.session_factory = session_factory
+        self.model = model
+        self._batches = {}
+        self._lock = threading.Lock()
+        # One lock per media, so a media that is not on Telegram yet is uploaded by one send only
+        self._upload_locks = {}
+        self.uploads = 0
+        self.reused = 0
+
+    def media_for_batch(self, batch_id):
+        batch_id = str(batch_id)
+        with self._lock:
+            media = self._batches.get(batch_id)
+        if media is None:
+            session = self.session_factory()
+            try:
+                rows = session.query(self.model).filter(self.model.batch_id == batch_id).order_by(
+                    self.model.id).all()
+                media = [{"id": row.id, "kind": row.kind, "path": row.path, "file_id": row.telegram_file_id}
+                         for row in rows]
+            finally:
+                session.close()
+            with self._lock:
+                media = self._batches.setdefault(batch_id, media)
+        return media
+
+    def _remember(self, media, file_id):
+        session = self.session_factory()
+        try:
+            session.query(self.model).filter(self.model.id == media["id"]).update(
+                {self.model.telegram_file_id: file_id}, synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+        media["file_id"] = file_id
+
+    def invalidate(self, batch_ids=None):
+        """Forget the media of `batch_ids`, or of every batch."""
+        with self._lock:
+            if batch_ids is None:
+                self._batches.clear()
+            else:
+                for batch_id in batch_ids:
+                    self._batches.pop(str(batch_id), None)
+
+    def send(self, bot, chat_id, media):
+        """Send one media to `chat_id`, by `file_id` when Telegram already has it."""
+        send = {PHOTO: bot.send_photo, ANIMATION: bot.send_animation, VIDEO: bot.send_video}[media["kind"]]
+        if media["file_id"]:
+            try:
+                send(chat_id, media["file_id"])
+                self.reused += 1
+                return
+            except BadRequest:
+                # The file_id is no longer valid (e.g. another bot token), upload the file again
+                media["file_id"] = None
+        with self._lock:
+            upload_lock = self._upload_locks.setdefault(media["id"], threading.Lock())
+        with upload_lock:
+            if media["file_id"]:
+                send(chat_id, media["file_id"])
+                self.reused += 1
+                return
+            with open(media["path"], "rb") as file:
+                message = send(chat_id, file)
+            self.uploads += 1
+            self._remember(media, _file_id(message))
+
+    def send_batch(self, bot, chat_id, batch_id):
+        for media in self.media_for_batch(batch_id):
+            self.send(bot, chat_id, media)
+
+    def stats(self):
+        with self._lock:
+            return {"batches": len(self._batches), "uploads": self.uploads, "reused": self.reused}
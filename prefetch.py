@@ -0,0 +1,190 @@
+"""
+Speculative prefetch of the next task bundle of active users.
+
+Right after the bot replies to a click, a background thread works out the
+user's next task and next target accounts, so the next click is answered from
+memory instead of paying for the task and account queries while the user waits.
+
+Target accounts can only go to one user at a time, so the prefetched ones are
+held in `Reservations`, and every account selection skips the accounts held
+for someone else. Prefetch holds are only a head start: they last
+`PREFETCH_HOLD_SECONDS`, take at most `PREFETCH_HOLD_SHARE` of a pool, and a
+click that finds too few free accounts takes them over (see `hold`). A bundle
+that is not used within `ttl` seconds expires and its accounts go back to the
+pool; nothing is written to the database until the bundle is used, so there is
+nothing to undo after a restart either. The task of a bundle is picked the
+normal way instead if the user got another task in the meantime, and so are its
+accounts if they are no longer held for the user or were served since.
+"""
+import heapq
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+PREFETCH_TTL = float(os.getenv("ISNAD_PREFETCH_TTL", "120"))
+# How long accounts stay held while they are being sent, in case the send fails halfway
+SEND_HOLD_SECONDS = 30
+# How long prefetched accounts stay held, and the most of a pool prefetch holds may take
+PREFETCH_HOLD_SECONDS = float(os.getenv("ISNAD_PREFETCH_HOLD", "20"))
+PREFETCH_HOLD_SHARE = 0.2
+MAX_BUNDLES = 10_000
+
+logger = logging.getLogger(__name__)
+
+
+class Reservations:
+    """
+    Target accounts held for a user, which other users' selections must skip. Selections look up
+    the accounts they consider (see `free`), so no call goes through every hold.
+    """
+
+    def __init__(self):
+        # id -> (owner, expires_at, prefetched)
+        self._held = {}
+        # (expires_at, id) of the holds, earliest first; holds renewed or released since leave theirs behind
+        self._expiries = []
+        self._prefetched = 0
+        self.lock = threading.Lock()
+
+    def _expire(self, now):
+        while self._expiries and self._expiries[0][0] <= now:
+            expires_at, account_id = heapq.heappop(self._expiries)
+            if self._held.get(account_id, (None, None))[1] == expires_at:
+                self._drop(account_id)
+
+    def _drop(self, account_id):
+        _, _, is_prefetched = self._held.pop(account_id)
+        self._prefetched -= is_prefetched
+
+    def _takes(self, account_id, owner, now, take_prefetched):
+        current_owner, expires_at, is_prefetched = self._held.get(account_id, (owner, now, False))
+        return current_owner == owner or expires_at <= now or (take_prefetched and is_prefetched)
+
+    def free(self, account_ids, owner=None, take_prefetched=False):
+        """
+        The `account_ids` not held for anyone but `owner`, in order; with `take_prefetched`, those only
+        held by a prefetch as well.
+        """
+        now = time.monotonic()
+        with self.lock:
+            return [account_id for account_id in account_ids if self._takes(account_id, owner, now, take_prefetched)]
+
+    def hold(self, account_ids, owner, ttl, prefetched=False, take_prefetched=False):
+        """
+        Hold the accounts not held for someone else yet; returns the ids now held for `owner`.
+        Two selections that picked the same account concurrently cannot both get it. With
+        `take_prefetched`, the accounts only held by a prefetch are taken over as well.
+        """
+        now = time.monotonic()
+        held = []
+        with self.lock:
+            for account_id in account_ids:
+                if self._takes(account_id, owner, now, take_prefetched):
+                    if account_id in self._held:
+                        self._drop(account_id)
+                    self._held[account_id] = (owner, now + ttl, prefetched)
+                    self._prefetched += prefetched
+                    heapq.heappush(self._expiries, (now + ttl, account_id))
+                    held.append(account_id)
+        return held
+
+    def prefetched_count(self):
+        with self.lock:
+            self._expire(time.monotonic())
+            return self._prefetched
+
+    def release(self, account_ids, owner=None):
+        """Stop holding `account_ids`, only those held for `owner` if given."""
+        with self.lock:
+            for account_id in account_ids:
+                if account_id in self._held and (owner is None or self._held[account_id][0] == owner):
+                    self._drop(account_id)
+
+    def __len__(self):
+        with self.lock:
+            self._expire(time.monotonic())
+            return len(self._held)
+
+
+class Prefetcher:
+    """
+    - **prepare**: `prepare(user_id)` returns the bundle of the user's next click, or None.
+    - **release**: `release(bundle)` hands back what an unused bundle held.
+    """
+
+    def __init__(self, prepare, release, ttl=PREFETCH_TTL, max_bundles=MAX_BUNDLES):
+        self.prepare = prepare
+        self.release = release
+        self.ttl = ttl
+        self.max_bundles = max_bundles
+        self.enabled = ttl > 0
+        self._bundles = {}
+        self._pending = set()
+        self._lock = threading.Lock()
+        # One thread: prefetching is background work and should not compete with the handlers
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def schedule(self, user_id):
+        """Prefetch the next bundle of `user_id` in the background."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if user_id in self._pending:
+                return
+            self._pending.add(user_id)
+        self._executor.submit(self._prefetch, user_id)
+
+    def _prefetch(self, user_id):
+        try:
+            self._expire()
+            bundle = self.prepare(user_id)
+            if bundle is None:
+                return
+            with self._lock:
+                previous = self._bundles.pop(user_id, None)
+                self._bundles[user_id] = (time.monotonic() + self.ttl, bundle)
+                evicted = []
+                while len(self._bundles) > self.max_bundles:
+                    oldest = next(iter(self._bundles))
+                    evicted.append(self._bundles.pop(oldest)[1])
+            for unused in ([previous[1]] if previous else []) + evicted:
+                self.release(unused)
+        except Exception:
+            logger.exception(f"Prefetch failed for user {user_id}")
+        finally:
+            with self._lock:
+                self._pending.discard(user_id)
+
+    def take(self, user_id):
+        """The prefetched bundle of `user_id`, or None if there is none or it expired."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            expires_at, bundle = self._bundles.pop(user_id, (None, None))
+        if bundle is not None and expires_at > time.monotonic():
+            self.hits += 1
+            return bundle
+        if bundle is not None:
+            self.expired += 1
+            self.release(bundle)
+        self.misses += 1
+        return None
+
+    def _expire(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [user_id for user_id, (expires_at, _) in self._bundles.items() if expires_at <= now]
+            bundles = [self._bundles.pop(user_id)[1] for user_id in expired]
+        self.expired += len(bundles)
+        for bundle in bundles:
+            self.release(bundle)
+
+    def stats(self):
+        with self._lock:
+            return {"bundles": len(self._bundles), "pending": len(self._pending), "hits": self.hits,
+                    "misses": self.misses, "expired": self.expired}
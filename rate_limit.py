@@ -0,0 +1,117 @@
+"""
+Token-bucket rate limiting per API key and per endpoint.
+
+Every (userid, endpoint) pair gets its own bucket. By default a bucket holds
+`constants.MAX_ENDPOINT_LIMIT` requests and refills over 15 minutes, the same
+budget the bot itself has to live with. Per-key limits, for one endpoint or for
+all of them (`*`), come from a `loader` and are reloaded periodically.
+"""
+import math
+import os
+import threading
+import time
+
+from constants import MAX_ENDPOINT_LIMIT
+
+RATE_LIMITING_ENABLED = os.getenv("ISNAD_RATE_LIMITING", "1") == "1"
+DEFAULT_WINDOW_SECONDS = 15 * 60
+RELOAD_INTERVAL = 30
+ALL_ENDPOINTS = "*"
+
+
+class TokenBucket:
+    def __init__(self, max_requests, window_seconds):
+        self.capacity = max_requests
+        self.refill_rate = max_requests / window_seconds
+        self.tokens = float(max_requests)
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_rate)
+        self.updated_at = now
+
+    def consume(self):
+        """Take one token; returns (allowed, seconds until a token is available)."""
+        self._refill(time.monotonic())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True, 0.0
+        return False, (1 - self.tokens) / self.refill_rate
+
+    def remaining(self):
+        self._refill(time.monotonic())
+        return int(self.tokens)
+
+
+class RateLimiter:
+    """
+    - **loader**: callable returning `{(userid, endpoint or "*"): (max_requests, window_seconds)}`.
+    """
+
+    def __init__(self, loader=None, default_limit=(MAX_ENDPOINT_LIMIT, DEFAULT_WINDOW_SECONDS),
+                 reload_interval=RELOAD_INTERVAL, enabled=RATE_LIMITING_ENABLED):
+        self.loader = loader
+        self.default_limit = default_limit
+        self.reload_interval = reload_interval
+        self.enabled = enabled
+        self._limits = {}
+        self._loaded_at = None
+        self._buckets = {}
+        self._usage = {}
+        self._lock = threading.Lock()
+
+    def reload(self):
+        limits = dict(self.loader()) if self.loader else {}
+        with self._lock:
+            self._limits = limits
+            self._loaded_at = time.monotonic()
+            # Buckets whose limit changed are rebuilt (full) on their next request
+            for (userid, endpoint), bucket in list(self._buckets.items()):
+                max_requests, window_seconds = self._limit_for(userid, endpoint)
+                if bucket.capacity != max_requests or bucket.refill_rate != max_requests / window_seconds:
+                    del self._buckets[(userid, endpoint)]
+
+    def _limit_for(self, userid, endpoint):
+        return (self._limits.get((userid, endpoint))
+                or self._limits.get((userid, ALL_ENDPOINTS))
+                or self.default_limit)
+
+    def _bucket(self, userid, endpoint):
+        bucket = self._buckets.get((userid, endpoint))
+        if bucket is None:
+            bucket = self._buckets[(userid, endpoint)] = TokenBucket(*self._limit_for(userid, endpoint))
+        return bucket
+
+    def hit(self, userid, endpoint):
+        """
+        Count a request of `userid` to `endpoint`.
+
+        Returns (allowed, limit, remaining, retry_after seconds).
+        """
+        if self._loaded_at is None or time.monotonic() - self._loaded_at >= self.reload_interval:
+            self.reload()
+        with self._lock:
+            usage = self._usage.setdefault((userid, endpoint), {"allowed": 0, "limited": 0})
+            if not self.enabled:
+                usage["allowed"] += 1
+                return True, None, None, 0
+            bucket = self._bucket(userid, endpoint)
+            allowed, retry_after = bucket.consume()
+            usage["allowed" if allowed else "limited"] += 1
+            return allowed, bucket.capacity, int(bucket.tokens), math.ceil(retry_after)
+
+    def usage(self, userid=None):
+        """Request counters per userid and endpoint, with the remaining budget."""
+        with self._lock:
+            report = {}
+            for (key_userid, endpoint), counters in sorted(self._usage.items()):
+                if userid is not None and key_userid != userid:
+                    continue
+                max_requests, window_seconds = self._limit_for(key_userid, endpoint)
+                report.setdefault(key_userid, {})[endpoint] = {
+                    **counters,
+                    "limit": max_requests,
+                    "window_seconds": window_seconds,
+                    "remaining": self._bucket(key_userid, endpoint).remaining() if self.enabled else None,
+                }
+            return report
@@ -0,0 +1,120 @@
+"""
+Opt-in recorder of incoming Telegram traffic.
+
+Set `ISNAD_RECORD_FILE` to a path (e.g. `traffic.jsonl.gz`) and every update put
+on the dispatcher queue is written to that file as one gzipped JSON line:
+
+    {"t": 12.345, "k": "cb", "u": 73019283312, "d": "option1", "m": 812}
+
+- **t**: seconds since the recording started.
+- **k**: update kind, `cmd` for commands, `msg` for other messages, `cb` for button clicks.
+- **u**: pseudonymous user id; stable within one recording, not reversible.
+- **d**: the command (e.g. `/start`) or the callback data.
+- **m**: id of the message (or of the message the button belongs to); a per-chat counter.
+
+A recording covers one run of the bot: its times and pseudonyms mean nothing
+to another run. If the file already exists, the run is recorded next to it
+under a name with its start time, e.g. `traffic-20240301-101500.jsonl.gz`.
+
+Names, usernames and free text are never written, so recordings can be shared
+for offline replay with `python -m benchmarks.replay`.
+"""
+import atexit
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+RECORD_FILE = os.getenv("ISNAD_RECORD_FILE")
+FLUSH_EVERY = 100
+
+
+def run_path(path, now=None):
+    """`path`, or the name with the run's start time the run is recorded under when `path` exists."""
+    if not os.path.exists(path):
+        return path
+    directory, name = os.path.split(path)
+    stem, dot, extensions = name.partition(".")
+    stamp = (now or datetime.now()).strftime("%Y%m%d-%H%M%S")
+    candidate, n = os.path.join(directory, f"{stem}-{stamp}{dot}{extensions}"), 1
+    while os.path.exists(candidate):
+        n += 1
+        candidate = os.path.join(directory, f"{stem}-{stamp}-{n}{dot}{extensions}")
+    return candidate
+
+
+class UpdateRecorder:
+    """Writes anonymised updates with their arrival time to a gzipped JSON lines file."""
+
+    def __init__(self, path):
+        self.path = run_path(path)
+        # A fresh salt per recording keeps pseudonyms stable inside the file but unlinkable to real ids
+        self._salt = os.urandom(16)
+        self._started_at = None
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._file = gzip.open(self.path, "xt", encoding="utf-8")
+        atexit.register(self.close)
+
+    def pseudonym(self, telegram_id):
+        digest = hmac.new(self._salt, str(telegram_id).encode(), hashlib.sha256).digest()
+        return int.from_bytes(digest[:6], "big")
+
+    def to_record(self, update, enqueued_at):
+        if update.callback_query is not None:
+            query = update.callback_query
+            message_id = query.message.message_id if query.message else None
+            record = {"k": "cb", "u": self.pseudonym(query.from_user.id), "d": query.data, "m": message_id}
+        elif update.message is not None and update.effective_user is not None:
+            text = update.message.text or ""
+            is_command = text.startswith("/")
+            record = {
+                "k": "cmd" if is_command else "msg",
+                "u": self.pseudonym(update.effective_user.id),
+                # Only the command itself is kept, never its arguments or any other text
+                "d": text.split()[0].split("@")[0] if is_command else None,
+                "m": update.message.message_id,
+            }
+        else:
+            return None
+        record["t"] = round(enqueued_at - self._started_at, 4)
+        return record
+
+    def record(self, update, enqueued_at=None):
+        enqueued_at = enqueued_at or time.time()
+        with self._lock:
+            if self._file is None:
+                return
+            if self._started_at is None:
+                self._started_at = enqueued_at
+            record = self.to_record(update, enqueued_at)
+            if record is None:
+                return
+            self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+            self._pending += 1
+            if self._pending >= FLUSH_EVERY:
+                self._file.flush()
+                self._pending = 0
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_recording(path):
+    """Yield the records of a recording, in arrival order."""
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        try:
+            for line in file:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        except (EOFError, json.JSONDecodeError):
+            # The bot was stopped without closing the recording; keep what was written
+            return
@@ -0,0 +1,210 @@
+"""
+In-memory search index over the target accounts.
+
+Every account is indexed under its name and the handle of its link, casefolded
+and without a leading `@`. A query is matched, best first, as:
+
+- **exact**: the whole name or handle.
+- **prefix**: the start of it, found by bisecting the sorted keys.
+- **substring**: anywhere in it, checking only the keys of the query's rarest trigram.
+- **fuzzy**: within `max_typos` edits of the start of the key (or of all of it),
+  found by walking the sorted keys as a trie and dropping every branch that is
+  already more than `max_typos` edits away.
+
+The index is built from a `loader` on first use. `mark_stale()` (called after
+uploads) rebuilds it in a background thread while searches keep using the
+current one.
+"""
+import bisect
+import heapq
+import threading
+from array import array
+from urllib.parse import urlparse
+
+MATCH_RANKS = {"exact": 0, "prefix": 1, "substring": 2, "fuzzy": 3}
+DEFAULT_LIMIT = 20
+# How many prefix matches are ranked at most, a one-letter query would otherwise rank them all
+MAX_PREFIX_SCAN = 2_000
+MAX_FUZZY_SCAN = 2_000
+_LAST_CHARACTER = chr(0x10FFFF)
+
+
+def normalize(text):
+    return str(text or "").strip().casefold().lstrip("@")
+
+
+def link_handle(link):
+    """`https://x.com/Some_Handle?s=20` -> `some_handle`."""
+    if not link:
+        return ""
+    path = urlparse(link if "//" in link else "//" + link).path
+    return normalize(path.strip("/").split("/")[0])
+
+
+def trigrams(key):
+    return {key[i:i + 3] for i in range(len(key) - 2)}
+
+
+def default_max_typos(query):
+    return 0 if len(query) < 4 else 1 if len(query) < 8 else 2
+
+
+def _next_row(row, before_previous_row, query, character, previous_character):
+    """Next row of the optimal string alignment distance table when the key grows by `character`."""
+    current = [row[0] + 1]
+    for j in range(1, len(query) + 1):
+        cost = query[j - 1] != character
+        distance = min(row[j] + 1, current[j - 1] + 1, row[j - 1] + cost)
+        if before_previous_row is not None and j > 1 and query[j - 1] == previous_character \
+                and query[j - 2] == character:
+            distance = min(distance, before_previous_row[j - 2] + 1)
+        current.append(distance)
+    return current
+
+
+class _Index:
+    def __init__(self, accounts):
+        self.documents = []
+        entries = []
+        for account_name, account_link, account_category, account_type in accounts:
+            document_id = len(self.documents)
+            self.documents.append({
+                "account_name": account_name,
+                "account_link": account_link,
+                "account_category": None if account_category is None else str(account_category),
+                "account_type": None if account_type is None else str(account_type),
+            })
+            for key in {normalize(account_name), link_handle(account_link)} - {""}:
+                entries.append((key, document_id))
+        entries.sort()
+        self.keys = [key for key, _ in entries]
+        self.key_documents = array("I", (document_id for _, document_id in entries))
+        postings = {}
+        for position, key in enumerate(self.keys):
+            for trigram in trigrams(key):
+                postings.setdefault(trigram, array("I")).append(position)
+        self.postings = postings
+
+    def _fuzzy_prefix_ranges(self, query, max_typos):
+        """
+        Yield `(distance, low, high, bound)` for the runs of keys starting with a prefix within
+        `max_typos` edits of `query`. A prefix is a trie node: the run of sorted keys sharing it.
+
+        Nodes are expanded closest first; `bound` is a lower bound of the distance of every
+        run yielded afterwards, so the caller can stop once it has enough close matches.
+        """
+        keys = self.keys
+        row = list(range(len(query) + 1))
+        heap = [(0, 0, "", 0, len(keys), row, None, None)]
+        pushed = 0
+        while heap:
+            bound, _, prefix, low, high, row, before_previous_row, previous_character = heapq.heappop(heap)
+            if row[-1] <= max_typos:
+                yield row[-1], low, high, bound
+            # Go deeper only while a longer prefix could still be closer
+            if min(row) > min(max_typos, row[-1] - 1):
+                continue
+            depth = len(prefix)
+            # The keys equal to the prefix itself, if any (several accounts may share a name or
+            # handle), sort first and have no child
+            position = bisect.bisect_right(keys, prefix, low, high)
+            while position < high:
+                character = keys[position][depth]
+                child_high = bisect.bisect_left(keys, prefix + character + _LAST_CHARACTER, position, high)
+                child_row = _next_row(row, before_previous_row, query, character, previous_character)
+                pushed += 1
+                heapq.heappush(heap, (min(child_row), pushed, prefix + character, position, child_high,
+                                      child_row, row, character))
+                position = child_high
+
+    def search(self, query, limit, account_category, account_type, max_typos):
+        matches = {}
+
+        def consider(position, match, distance=0):
+            document_id = self.key_documents[position]
+            document = self.documents[document_id]
+            if account_category is not None and document["account_category"] != account_category:
+                return
+            if account_type is not None and document["account_type"] != account_type:
+                return
+            rank = (MATCH_RANKS[match], distance, len(self.keys[position]), self.keys[position])
+            if document_id not in matches or rank < matches[document_id][0]:
+                matches[document_id] = (rank, match)
+
+        # Exact and prefix matches are a contiguous run of the sorted keys
+        start = bisect.bisect_left(self.keys, query)
+        for position in range(start, min(start + MAX_PREFIX_SCAN, len(self.keys))):
+            if not self.keys[position].startswith(query):
+                break
+            consider(position, "exact" if self.keys[position] == query else "prefix")
+
+        if len(matches) < limit and len(query) >= 3:
+            # Every key containing the query is in the posting of each of its trigrams: check the smallest
+            rarest = min((self.postings.get(trigram, ()) for trigram in trigrams(query)), key=len)
+            for position in rarest:
+                if query in self.keys[position]:
+                    consider(position, "substring")
+
+        if max_typos is None:
+            max_typos = default_max_typos(query)
+        if len(matches) < limit and max_typos > 0:
+            # Stop walking once enough keys are found closer than anything left to find; with filters
+            # many of them may be dropped, so look further
+            enough = MAX_FUZZY_SCAN if account_category is not None or account_type is not None else limit
+            ranges, found = [], [0] * (max_typos + 1)
+            for distance, low, high, bound in self._fuzzy_prefix_ranges(query, max_typos):
+                ranges.append((distance, low, high))
+                found[distance] += high - low
+                if sum(found[:bound + 1]) >= enough:
+                    break
+            # Closest first, so the scan budget goes to the best fuzzy matches
+            scanned = 0
+            for distance, low, high in sorted(ranges):
+                for position in range(low, min(high, low + MAX_FUZZY_SCAN - scanned)):
+                    consider(position, "fuzzy", distance)
+                scanned += min(high - low, MAX_FUZZY_SCAN - scanned)
+                if scanned >= MAX_FUZZY_SCAN:
+                    break
+
+        ranked = sorted(matches.items(), key=lambda item: item[1][0])[:limit]
+        return [{**self.documents[document_id], "match": match} for document_id, (_, match) in ranked]
+
+
+class AccountSearchIndex:
+    """
+    - **loader**: callable returning an iterable of
+      `(account_name, account_link, account_category, account_type)`.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self._index = None
+        self._build_lock = threading.Lock()
+        self._stale = False
+
+    def rebuild(self):
+        with self._build_lock:
+            self._stale = False
+            self._index = _Index(self.loader())
+
+    def mark_stale(self):
+        """Rebuild in the background; searches use the current index meanwhile."""
+        self._stale = True
+        if self._index is not None:
+            threading.Thread(target=self._rebuild_if_stale, name="account-search-index", daemon=True).start()
+
+    def _rebuild_if_stale(self):
+        # Uploads in quick succession queue up behind the lock and share one rebuild
+        with self._build_lock:
+            if self._stale:
+                self._stale = False
+                self._index = _Index(self.loader())
+
+    def search(self, query, limit=DEFAULT_LIMIT, account_category=None, account_type=None, max_typos=None):
+        """Return up to `limit` accounts matching `query`, each with the kind of `match`, best first."""
+        if self._index is None:
+            self.rebuild()
+        query = normalize(query)
+        if not query:
+            return []
+        return self._index.search(query, limit, account_category, account_type, max_typos)
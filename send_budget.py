@@ -0,0 +1,114 @@
+"""
+Bot-wide budget of Telegram sends.
+
+Telegram lets a bot send about 30 messages a second, all chats together. Every
+message the bot sends is taken from one token bucket of `BOT_SEND_RATE`
+messages a second, holding a second of sends:
+
+- the replies to users (`spend`) are never held up: they take their tokens
+  even when the bucket is empty and leave it in debt;
+- background sends such as broadcasts (`take`) wait until more than the
+  `RESERVE_SHARE` of the bucket kept for the replies is left.
+
+So a broadcast gets the whole budget while nobody clicks, and slows down by as
+much as the replies pick up. When Telegram still answers with a flood error,
+`pause` stops the background sends for as long as it asks.
+
+`BudgetedBot` is the `telegram.Bot` that counts its sends as replies, except
+for the send a thread made right after its own `take`.
+"""
+import os
+import threading
+import time
+
+from telegram import Bot
+
+BOT_SEND_RATE = float(os.getenv("ISNAD_BOT_SEND_RATE", "30"))
+# Share of the bucket background sends leave to the replies (a click sends half a dozen messages)
+RESERVE_SHARE = float(os.getenv("ISNAD_SEND_RESERVE_SHARE", "0.3"))
+
+
+class SendBudget:
+    """
+    - **rate**: messages a second the bot may send in all.
+    - **reserve_share**: share of the bucket background sends leave untouched.
+    """
+
+    def __init__(self, rate=BOT_SEND_RATE, reserve_share=RESERVE_SHARE):
+        self.rate = rate
+        self.capacity = rate
+        self.reserve = rate * reserve_share
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.spent = 0
+        self.taken = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def spend(self, count=1):
+        """Count `count` messages sent to users right away."""
+        if getattr(self._local, "taken", False):
+            # Already taken by this thread's `take`
+            self._local.taken = False
+            return
+        with self._lock:
+            self._refill(time.monotonic())
+            # The debt is bounded, so a burst of replies does not stop the broadcasts for long
+            self.tokens = max(self.tokens - count, -self.capacity)
+            self.spent += count
+
+    def take(self, cancelled=None):
+        """
+        Wait for a background send, taking its token; returns False when `cancelled` (an Event)
+        is set first.
+        """
+        while cancelled is None or not cancelled.is_set():
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= self.reserve + 1:
+                    self.tokens -= 1
+                    self.taken += 1
+                    self._local.taken = True
+                    return True
+                else:
+                    wait = (self.reserve + 1 - self.tokens) / self.rate
+            # Short naps, so a cancel is seen quickly
+            time.sleep(min(wait, 1.0))
+        return False
+
+    def pause(self, seconds):
+        """Hold the background sends for `seconds`, e.g. on a flood error."""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def stats(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return {"rate": self.rate, "tokens": round(self.tokens, 1), "spent": self.spent, "taken": self.taken,
+                    "paused_seconds": round(max(self.paused_until - time.monotonic(), 0.0), 1)}
+
+
+class BudgetedBot(Bot):
+    """A `telegram.Bot` counting every message it sends in a `SendBudget`."""
+
+    __slots__ = ("send_budget",)
+
+    def __init__(self, token, send_budget, **kwargs):
+        super().__init__(token, **kwargs)
+        self.send_budget = send_budget
+
+    def _message(self, *args, **kwargs):
+        self.send_budget.spend()
+        return super()._message(*args, **kwargs)
+
+    def send_media_group(self, chat_id, media, *args, **kwargs):
+        self.send_budget.spend(len(media))
+        return super().send_media_group(chat_id, media, *args, **kwargs)
@@ -0,0 +1,176 @@
+"""
+Background refresh of the status of target accounts.
+
+Accounts get suspended or deleted and the rotation keeps handing them out. A
+job run by APScheduler takes, every few minutes, the accounts checked the
+longest time ago (never checked first), resolves their ids through
+`graphql_resolver` at background priority, so interactive lookups keep going
+first, and writes the statuses to `twitter_status` with bulk updates; the
+`account_status` of the upload sheet is left alone.
+
+An account is only marked dead after `CONFIRM_CHECKS` checks in a row found it
+suspended or deleted (it is checked again on the next run), and nothing is
+written from a failed request or for an id the response did not answer. The
+job only runs when the resolver has Twitter credentials.
+
+The refresh lag is the age of the stalest status (an account never checked
+counts from its upload): while it stays under the interval times the number of
+batches the table takes, the refresh keeps up.
+"""
+import asyncio
+import logging
+import threading
+import time
+from datetime import datetime
+
+import pytz
+from apscheduler.schedulers.background import BackgroundScheduler
+from sqlalchemy import and_, case, func
+
+import graphql_resolver
+import twitter_scheduler
+
+BATCH_SIZE = 10_000
+INTERVAL_MINUTES = 10
+WRITE_CHUNK_SIZE = 500
+# Statuses of accounts the rotation no longer hands out
+DEAD_STATUSES = (graphql_resolver.SUSPENDED, graphql_resolver.NOT_FOUND)
+# Checks in a row finding an account dead before it is marked so
+CONFIRM_CHECKS = 2
+
+logger = logging.getLogger(__name__)
+
+
+class StatusRefresher:
+    """
+    - **model**: the target account model, with `account_id`, `account_name`, `twitter_status`,
+      `dead_checks`, `status_checked_at` and `created_at` columns.
+    - **on_changed**: called with the names of the accounts whose status changed, e.g. to
+      invalidate a cache.
+    """
+
+    def __init__(self, session_factory, model, resolver, batch_size=BATCH_SIZE, on_changed=None):
+        self.session_factory = session_factory
+        self.model = model
+        self.resolver = resolver
+        self.batch_size = batch_size
+        self.on_changed = on_changed
+        self._run_lock = threading.Lock()
+        self.runs = 0
+        self.last_run = None
+        self.last_error = None
+        self.scheduler = None
+
+    def _awaiting_confirmation(self):
+        model = self.model
+        return and_(model.dead_checks > 0, model.dead_checks < CONFIRM_CHECKS)
+
+    def _next_batch(self):
+        model = self.model
+        session = self.session_factory()
+        try:
+            # The accounts waiting for their dead status to be confirmed go first
+            return session.query(model.id, model.account_id, model.account_name, model.twitter_status,
+                                 model.dead_checks).filter(model.account_id.isnot(None)).order_by(
+                case((self._awaiting_confirmation(), 0), else_=1), model.status_checked_at.isnot(None),
+                model.status_checked_at, model.id).limit(self.batch_size).all()
+        finally:
+            session.close()
+
+    async def refresh(self):
+        """Check one batch of accounts; returns a summary of the run."""
+        started = time.monotonic()
+        accounts = self._next_batch()
+        # Ids that are not numeric cannot be looked up, they still count as checked so they
+        # do not hold the front of the queue
+        user_ids = [str(account_id).strip() for _, account_id, _, _, _ in accounts
+                    if str(account_id).strip().isdigit()]
+        resolved = await self.resolver.resolve_users(user_ids, priority=twitter_scheduler.BACKGROUND)
+
+        checked_at = datetime.utcnow()
+        updates, changed_names, statuses = [], set(), {}
+        for row_id, account_id, account_name, twitter_status, dead_checks in accounts:
+            update = {"id": row_id, "status_checked_at": checked_at}
+            result = resolved.get(str(account_id).strip())
+            # No answer for this account, keep its status
+            if result is not None and result["status"] != graphql_resolver.UNKNOWN:
+                status = result["status"]
+                statuses[status] = statuses.get(status, 0) + 1
+                if status in DEAD_STATUSES:
+                    update["dead_checks"] = (dead_checks or 0) + 1
+                    if update["dead_checks"] < CONFIRM_CHECKS:
+                        # Not confirmed yet, it stays in the rotation until the next check
+                        status = twitter_status
+                else:
+                    update["dead_checks"] = 0
+                update["twitter_status"] = status
+                if status != twitter_status:
+                    changed_names.add(account_name)
+            updates.append(update)
+
+        session = self.session_factory()
+        try:
+            for start in range(0, len(updates), WRITE_CHUNK_SIZE):
+                session.bulk_update_mappings(self.model, updates[start:start + WRITE_CHUNK_SIZE])
+            session.commit()
+        finally:
+            session.close()
+        changed_names.discard(None)
+        if changed_names and self.on_changed:
+            self.on_changed(changed_names)
+
+        return {"checked": len(accounts), "resolved": len(resolved), "changed": len(changed_names),
+                "statuses": statuses, "seconds": round(time.monotonic() - started, 2),
+                "finished_at": checked_at}
+
+    def run(self):
+        """Job entry point, runs in an APScheduler worker thread."""
+        if not self._run_lock.acquire(blocking=False):
+            return None
+        try:
+            summary = asyncio.run(self.refresh())
+            self.runs += 1
+            self.last_run, self.last_error = summary, None
+            logger.info(f"Account status refresh: {summary['checked']} checked, {summary['changed']} changed")
+            return summary
+        except Exception as e:
+            self.last_error = f"{type(e).__name__}: {e}"
+            logger.exception("Account status refresh failed")
+            return None
+        finally:
+            self._run_lock.release()
+
+    def stats(self):
+        model = self.model
+        session = self.session_factory()
+        try:
+            oldest, checked, total = session.query(
+                func.min(func.coalesce(model.status_checked_at, model.created_at)),
+                func.count(model.status_checked_at),
+                func.count(model.id)).filter(model.account_id.isnot(None)).one()
+            dead = session.query(func.count(model.id)).filter(model.twitter_status.in_(DEAD_STATUSES)).scalar()
+            awaiting = session.query(func.count(model.id)).filter(self._awaiting_confirmation()).scalar()
+        finally:
+            session.close()
+        return {
+            "refresh_lag_seconds": round((datetime.utcnow() - oldest).total_seconds()) if oldest else 0,
+            "accounts": total,
+            "never_checked": total - checked,
+            "dead_accounts": dead,
+            "awaiting_confirmation": awaiting,
+            "scheduled": self.scheduler is not None,
+            "batch_size": self.batch_size,
+            "runs": self.runs,
+            "last_run": self.last_run,
+            "last_error": self.last_error,
+        }
+
+    def start(self, interval_minutes=INTERVAL_MINUTES):
+        """Run `run` every `interval_minutes` in a background scheduler; returns the scheduler."""
+        # APScheduler 3.6 only takes pytz timezones
+        scheduler = BackgroundScheduler(timezone=pytz.utc, daemon=True)
+        scheduler.add_job(self.run, "interval", minutes=interval_minutes, id="account_status_refresh",
+                          max_instances=1, coalesce=True, next_run_time=datetime.now(pytz.utc))
+        scheduler.start()
+        self.scheduler = scheduler
+        return scheduler
@@ -0,0 +1,161 @@
+"""
+Weighted sampling of the tasks of a batch.
+
+Every task has a `priority` (1 by default, or the optional PRIORITY column of
+the upload sheet) and is handed out in proportion to it: a task of priority 3
+goes to about three times as many users as a task of priority 1. The tasks of a
+batch are loaded once into an alias table (Vose's alias method), which draws a
+task in O(1) whatever the size of the batch; nothing is scanned per click, and
+the table is only built again when a new batch is uploaded.
+
+Each pick takes two weighted draws and keeps the task served the least for its
+priority, so the exposure follows the priorities closely instead of drifting
+with chance (see exposure.py). The sampler keeps the tasks every user did in
+their current batch, updated on each serve. They are skipped by drawing again
+until the user has done half of the batch; from then on the draws come from the
+user's remaining tasks, listed once and shrunk in O(1) with every serve, so a
+user near the end of a batch does not cost a pass over it on every click.
+"""
+import random
+import threading
+
+DEFAULT_PRIORITY = 1
+# Draws per pick before falling back to the tasks left to the user
+MAX_DRAWS = 16
+
+
+class AliasTable:
+    """Draws index `i` with probability `weights[i] / sum(weights)`, in O(1)."""
+
+    def __init__(self, weights):
+        count = len(weights)
+        total = sum(weights)
+        self.probability = [1.0] * count
+        self.alias = list(range(count))
+        scaled = [weight * count / total for weight in weights]
+        small = [i for i, share in enumerate(scaled) if share < 1]
+        large = [i for i, share in enumerate(scaled) if share >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.probability[less], self.alias[less] = scaled[less], more
+            scaled[more] += scaled[less] - 1
+            (small if scaled[more] < 1 else large).append(more)
+        # Whatever is left is at 1, give or take rounding errors
+
+    def __len__(self):
+        return len(self.probability)
+
+    def draw(self, rng=random):
+        i = int(rng.random() * len(self.probability))
+        return i if rng.random() < self.probability[i] else self.alias[i]
+
+
+class _Batch:
+    def __init__(self, rows):
+        self.task_ids = [task_id for task_id, _, _ in rows]
+        self.priorities = {task_id: max(priority or DEFAULT_PRIORITY, 1) for task_id, priority, _ in rows}
+        self.served = {task_id: served_count or 0 for task_id, _, served_count in rows}
+        self.table = AliasTable([self.priorities[task_id] for task_id in self.task_ids]) if rows else None
+
+
+class _Remaining:
+    """The tasks of a batch a user has not done, drawn by priority; removal and draws in O(1)."""
+
+    def __init__(self, batch, done):
+        self.batch = batch
+        self.task_ids = [task_id for task_id in batch.task_ids if task_id not in done]
+        self.positions = {task_id: i for i, task_id in enumerate(self.task_ids)}
+        self.max_priority = max((batch.priorities[task_id] for task_id in self.task_ids), default=DEFAULT_PRIORITY)
+
+    def discard(self, task_id):
+        i = self.positions.pop(task_id, None)
+        if i is None:
+            return
+        last = self.task_ids.pop()
+        if i < len(self.task_ids):
+            self.task_ids[i], self.positions[last] = last, i
+
+    def draw(self, rng):
+        # Uniform draws kept in proportion to the priority (max_priority only ever gets too high)
+        for _ in range(MAX_DRAWS):
+            task_id = self.task_ids[int(rng.random() * len(self.task_ids))]
+            if rng.random() * self.max_priority < self.batch.priorities[task_id]:
+                return task_id
+        return task_id
+
+
+class _UserTasks:
+    def __init__(self, batch_id):
+        self.batch_id = batch_id
+        self.done = set()
+        self.remaining = None
+
+
+class TaskSampler:
+    """
+    - **loader**: `loader(batch_id)` returns the `(task_id, priority, served_count)` of the tasks of a batch.
+    """
+
+    def __init__(self, loader, rng=None):
+        self.loader = loader
+        self.rng = rng or random.Random()
+        self._batches = {}
+        # user_id -> the tasks they did in their current batch
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def _batch(self, batch_id):
+        batch = self._batches.get(batch_id)
+        if batch is None:
+            with self._lock:
+                batch = self._batches.get(batch_id)
+                if batch is None:
+                    batch = self._batches[batch_id] = _Batch(self.loader(batch_id))
+        return batch
+
+    def pick(self, batch_id, user_id=None):
+        """A task id of `batch_id` that `user_id` did not do, or None if the batch has none left."""
+        batch = self._batch(batch_id)
+        if batch.table is None:
+            return None
+        user = self._users.get(user_id)
+        if user is None or user.batch_id != batch_id:
+            user = _UserTasks(batch_id)
+        candidates = []
+        if len(user.done) * 2 < len(batch.task_ids):
+            for _ in range(MAX_DRAWS):
+                task_id = batch.task_ids[batch.table.draw(self.rng)]
+                if task_id not in user.done:
+                    candidates.append(task_id)
+                    if len(candidates) == 2:
+                        break
+        if not candidates:
+            with self._lock:
+                # Listed once per user and batch, then kept up to date by `record_serve`
+                if user.remaining is None or user.remaining.batch is not batch:
+                    user.remaining = _Remaining(batch, user.done)
+                if not user.remaining.task_ids:
+                    return None
+                candidates = [user.remaining.draw(self.rng), user.remaining.draw(self.rng)]
+        return min(candidates, key=lambda task_id: batch.served[task_id] / batch.priorities[task_id])
+
+    def record_serve(self, batch_id, task_id, user_id=None):
+        """Count a serve of `task_id`, done by `user_id` from now on."""
+        with self._lock:
+            batch = self._batches.get(batch_id)
+            if batch is not None and task_id in batch.served:
+                batch.served[task_id] += 1
+            if user_id is None:
+                return
+            user = self._users.get(user_id)
+            if user is None or user.batch_id != batch_id:
+                # A new batch for the user, what they did in the previous one no longer matters
+                user = self._users[user_id] = _UserTasks(batch_id)
+            user.done.add(task_id)
+            if user.remaining is not None:
+                user.remaining.discard(task_id)
+
+    def invalidate(self):
+        """Forget every batch, e.g. when the tasks are uploaded again."""
+        with self._lock:
+            self._batches.clear()
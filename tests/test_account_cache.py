@@ -0,0 +1,73 @@
+import os
+import sys
+
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from account_cache import AccountDetailsCache, etag
+
+Base = declarative_base()
+
+
+class Account(Base):
+    __tablename__ = "accounts"
+    id = Column(Integer, primary_key=True)
+    account_name = Column(String)
+    account_status = Column(String)
+    served_count = Column(Integer, default=0)
+
+
+def make_cache():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    loads = []
+
+    def loader(names):
+        loads.append(sorted(names))
+        session = Session()
+        try:
+            return {account.account_name: {"account_name": account.account_name, "status": account.account_status}
+                    for account in session.query(Account).filter(Account.account_name.in_(names))}
+        finally:
+            session.close()
+
+    cache = AccountDetailsCache(loader)
+    cache.watch(Session, Account, ignored=("served_count",))
+    session = Session()
+    session.add_all([Account(account_name="a", account_status="T"), Account(account_name="b", account_status="T")])
+    session.commit()
+    session.close()
+    return cache, Session, loads
+
+
+def test_lookups_are_cached_found_or_not():
+    cache, _, loads = make_cache()
+    assert set(cache.get_many(["a", "b", "missing"])) == {"a", "b"}
+    assert set(cache.get_many(["a", "b", "missing"])) == {"a", "b"}
+    assert loads == [["a", "b", "missing"]]
+    assert cache.stats()["hits"] == 3
+
+
+def test_commits_invalidate_changed_accounts_only():
+    cache, Session, loads = make_cache()
+    before = etag(cache.get("a"))
+    session = Session()
+    account = session.query(Account).filter_by(account_name="a").one()
+    # A serve only bumps the ignored counter: the entry and its ETag stay
+    account.served_count = 1
+    session.commit()
+    assert cache.get("a") is not None and len(loads) == 1
+    account.account_status = "S"
+    session.commit()
+    session.close()
+    assert cache.get("a")["status"] == "S"
+    assert etag(cache.get("a")) != before
+    assert len(loads) == 2
+
+
+def test_etag_ignores_key_order():
+    assert etag({"a": 1, "b": 2}) == etag({"b": 2, "a": 1})
+    assert etag({"a": 1}) != etag({"a": 2})
@@ -0,0 +1,43 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api_keys import SERVICE_SCOPE, USER_SCOPE, ApiKeyIndex, digest_key, key_file_loader
+
+
+def test_resolve_accepts_valid_keys_and_rejects_others():
+    keys = [("partner", digest_key("secret-1"), {USER_SCOPE}),
+            ("service7", digest_key("secret-2"), {SERVICE_SCOPE}),
+            ("partner", digest_key("secret-1"), {SERVICE_SCOPE})]
+    index = ApiKeyIndex(lambda: keys)
+    assert index.resolve("secret-1", USER_SCOPE) == "partner"
+    # The same key listed twice gets both scopes
+    assert index.resolve("secret-1", SERVICE_SCOPE) == "partner"
+    assert index.resolve("secret-2", SERVICE_SCOPE) == "service7"
+    assert index.resolve("secret-2", USER_SCOPE) is None
+    assert index.resolve("secret-3", USER_SCOPE) is None
+    assert index.resolve("", USER_SCOPE) is None
+    assert index.names() == [("partner", [SERVICE_SCOPE, USER_SCOPE]), ("service7", [SERVICE_SCOPE])]
+
+
+def test_revoked_key_stops_working_on_reload():
+    keys = [("partner", digest_key("secret-1"), {USER_SCOPE})]
+    index = ApiKeyIndex(lambda: list(keys))
+    assert index.resolve("secret-1", USER_SCOPE) == "partner"
+    keys.clear()
+    # Still cached until the index is reloaded
+    assert index.resolve("secret-1", USER_SCOPE) == "partner"
+    index.reload()
+    assert index.resolve("secret-1", USER_SCOPE) is None
+
+
+def test_key_file(tmp_path):
+    path = tmp_path / "keys.json"
+    path.write_text(json.dumps([{"name": "a", "key_sha256": digest_key("k1"), "scopes": [SERVICE_SCOPE]},
+                                {"name": "b", "key": "k2"}]))
+    index = ApiKeyIndex(lambda: key_file_loader(str(path)))
+    assert index.resolve("k1", SERVICE_SCOPE) == "a"
+    assert index.resolve("k2", USER_SCOPE) == "b"
+    assert key_file_loader(str(tmp_path / "missing.json")) == []
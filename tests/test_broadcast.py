@@ -0,0 +1,126 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+from sqlalchemy import Column, DateTime, Integer, String, create_engine
+from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import StaticPool
+from telegram.error import BadRequest, RetryAfter, Unauthorized
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from broadcast import DONE, Broadcaster, markdown_error
+from send_budget import SendBudget
+
+Base = declarative_base()
+
+
+class Notice(Base):
+    __tablename__ = "broadcasts"
+    id = Column(Integer, primary_key=True)
+    message = Column(String)
+    status = Column(String)
+    total = Column(Integer)
+    sent = Column(Integer)
+    failed = Column(Integer)
+    blocked = Column(Integer)
+    last_user_id = Column(Integer)
+    error = Column(String)
+    created_at = Column(DateTime)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+
+class User(Base):
+    __tablename__ = "users"
+    id = Column(Integer, primary_key=True)
+    telegram_user_id = Column(Integer)
+
+
+class FakeBot:
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.sent = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        error = self.errors.pop(chat_id, None)
+        if error:
+            raise error
+        self.sent.append(chat_id)
+
+
+def make_broadcaster(bot, users=5):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    session = Session()
+    session.add_all([User(id=user_id, telegram_user_id=100 + user_id) for user_id in range(1, users + 1)])
+    session.commit()
+    session.close()
+    return Broadcaster(Session, Notice, User, lambda: bot, budget=SendBudget(rate=1000), page_size=2), Session
+
+
+def wait_for(broadcaster, broadcast_id):
+    for _ in range(500):
+        if broadcast_id not in broadcaster._running:
+            return
+        time.sleep(0.01)
+    raise AssertionError("broadcast did not finish")
+
+
+def test_markdown_error_finds_unclosed_entities():
+    assert markdown_error("🔻 *مهمات جديدة* [link](https://x.com) `code` ```pre```") is None
+    assert markdown_error("user\\_name") is None
+    assert markdown_error("batch_1 is out") == "_ at character 5 is not closed"
+    assert markdown_error("*bold") is not None
+    assert markdown_error("[link](https://x.com") is not None
+
+
+def test_invalid_markdown_is_refused_before_anything_is_sent():
+    bot = FakeBot()
+    broadcaster, Session = make_broadcaster(bot)
+    with pytest.raises(ValueError):
+        broadcaster.create("*unclosed")
+    assert Session().query(Notice).count() == 0 and bot.sent == []
+
+
+def test_broadcast_reaches_every_user_and_counts_the_outcomes():
+    bot = FakeBot(errors={102: Unauthorized("blocked"), 103: BadRequest("chat not found"),
+                          104: RetryAfter(0.01)})
+    broadcaster, Session = make_broadcaster(bot)
+    broadcast_id = broadcaster.create("*hello*")
+    wait_for(broadcaster, broadcast_id)
+    notice = Session().get(Notice, broadcast_id)
+    assert (notice.status, notice.sent, notice.blocked, notice.failed) == (DONE, 3, 1, 1)
+    # The user of the flood error got the notice on the retry
+    assert sorted(bot.sent) == [101, 104, 105]
+
+
+def test_background_sends_leave_the_reserve_to_the_replies():
+    budget = SendBudget(rate=10, reserve_share=0.5)
+    cancelled = threading.Event()
+    taken = 0
+    while budget.tokens >= budget.reserve + 1:
+        assert budget.take(cancelled)
+        taken += 1
+    assert taken == 5
+    # Replies are never held up, even past the budget
+    for _ in range(20):
+        budget.spend()
+    assert budget.tokens == -10
+    cancelled.set()
+    assert budget.take(cancelled) is False
+
+
+def test_pause_holds_background_sends_without_blocking_others():
+    budget = SendBudget(rate=1000)
+    budget.pause(0.2)
+    started = time.monotonic()
+    # The lock is free while paused
+    budget.spend()
+    assert budget.stats()["paused_seconds"] > 0
+    assert time.monotonic() - started < 0.1
+    assert budget.take()
+    assert time.monotonic() - started >= 0.2
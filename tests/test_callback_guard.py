@@ -0,0 +1,70 @@
+import os
+import sys
+import threading
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from callback_guard import DONE, PENDING, CallbackGuard
+from user_dispatch import UserOrderedExecutor
+
+
+class Query:
+    def __init__(self, user_id, message_id, data):
+        self.from_user = SimpleNamespace(id=user_id)
+        self.message = SimpleNamespace(message_id=message_id)
+        self.data = data
+        self.answered = threading.Event()
+        self.answer_text = None
+
+    def answer(self, text=None, **kwargs):
+        self.answer_text = text
+        self.answered.set()
+
+
+def tap(user_id, message_id, data):
+    query = Query(user_id, message_id, data)
+    return SimpleNamespace(callback_query=query, effective_user=query.from_user)
+
+
+def test_repeat_of_a_pending_click_is_answered_at_admission():
+    guard = CallbackGuard(notices={PENDING: "pending", DONE: "done"})
+    executor = UserOrderedExecutor(workers=1)
+    release = threading.Event()
+    handled = []
+
+    def handler(update, context):
+        release.wait(5)
+        handled.append(update)
+        return "sent above"
+
+    dispatch = executor.ordered(handler, guard=guard)
+    first, repeat, other = tap(1, 10, "option1"), tap(1, 10, "option1"), tap(1, 10, "option2")
+    dispatch(first, None)
+    dispatch(repeat, None)
+    dispatch(other, None)
+    # Answered while the first click is still being handled, not queued behind it
+    assert repeat.callback_query.answered.wait(5)
+    assert repeat.callback_query.answer_text == "pending"
+    release.set()
+    assert executor.join(5)
+    # Another button of the same message is not a repeat
+    assert handled == [first, other]
+
+    again = tap(1, 10, "option1")
+    dispatch(again, None)
+    assert again.callback_query.answered.wait(5)
+    assert again.callback_query.answer_text == "sent above"
+    assert executor.join(5)
+    assert handled == [first, other]
+    assert guard.stats()["repeats_pending"] == 1
+    assert guard.stats()["repeats_done"] == 1
+    assert guard.stats()["in_flight"] == 0
+
+
+def test_cancelled_click_is_not_a_repeat():
+    guard = CallbackGuard(notices={DONE: "done"})
+    first = tap(1, 10, "option1")
+    assert guard.admit(first)
+    guard.cancel(first)
+    assert guard.admit(tap(1, 10, "option1"))
@@ -0,0 +1,70 @@
+import io
+import os
+import sys
+
+import pandas as pd
+from sqlalchemy import BigInteger, Column, Integer, String, create_engine
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from delta_sync import read_sheet, sync_sheet
+
+Base = declarative_base()
+COLUMNS = {"ACCOUNT_ID": "account_id", "ACCOUNT_NAME": "account_name", "ACCOUNT_STATUS": "account_status"}
+
+
+class Account(Base):
+    __tablename__ = "accounts"
+    id = Column(Integer, primary_key=True)
+    account_id = Column(String)
+    account_name = Column(String)
+    account_status = Column(String)
+    row_hash = Column(BigInteger)
+
+
+def sheet(rows):
+    buffer = io.BytesIO()
+    pd.DataFrame(rows, columns=list(COLUMNS)).to_excel(buffer, index=False)
+    buffer.seek(0)
+    return read_sheet(buffer, COLUMNS)
+
+
+def make_session():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)()
+
+
+def test_only_the_differences_are_written():
+    session = make_session()
+    summary, _ = sync_sheet(session, Account, sheet([[1, "a", "T"], [2, "b", "T"], [3, "c", "T"]]), "account_id")
+    session.commit()
+    assert (summary["inserted"], summary["updated"], summary["removed"]) == (3, 0, 0)
+
+    summary, names = sync_sheet(session, Account, sheet([[1, "a", "T"], [2, "b2", "S"], [4, "d", "T"]]),
+                                "account_id", remove_missing=True, name_attribute="account_name")
+    session.commit()
+    assert (summary["inserted"], summary["updated"], summary["removed"], summary["unchanged"]) == (1, 1, 1, 1)
+    # The old and new names of every written row
+    assert names == {"b", "b2", "c", "d"}
+    assert sorted(session.query(Account.account_id, Account.account_name, Account.account_status)) == [
+        ("1", "a", "T"), ("2", "b2", "S"), ("4", "d", "T")]
+
+    # The same sheet again writes nothing
+    summary, _ = sync_sheet(session, Account, sheet([[1, "a", "T"], [2, "b2", "S"], [4, "d", "T"]]), "account_id")
+    assert (summary["inserted"], summary["updated"], summary["unchanged"]) == (0, 0, 3)
+
+
+def test_rows_without_key_are_skipped_and_legacy_hashes_backfilled():
+    session = make_session()
+    # Written by a full upload: no row hash yet
+    session.add(Account(account_id="1", account_name="a", account_status="T"))
+    session.commit()
+    summary, _ = sync_sheet(session, Account, sheet([[1, "a", "T"], [None, "x", "T"], [5, "e", "T"], [5, "e2", "T"]]),
+                            "account_id")
+    session.commit()
+    assert (summary["unchanged"], summary["hashes_backfilled"], summary["skipped"], summary["inserted"]) == (1, 1, 2, 1)
+    assert session.query(Account).filter_by(account_id="1").one().row_hash is not None
+    # The last of duplicated keys wins
+    assert session.query(Account).filter_by(account_id="5").one().account_name == "e2"
@@ -0,0 +1,38 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import isnad_codes
+
+
+@pytest.fixture(autouse=True)
+def secret(monkeypatch):
+    monkeypatch.setenv("ISNAD_CODE_SECRET", "test-secret")
+    isnad_codes._secret.cache_clear()
+    yield
+    isnad_codes._secret.cache_clear()
+
+
+def test_signed_code_gives_the_user_id_back():
+    code = isnad_codes.sign(6123456789)
+    assert len(code) == isnad_codes.CODE_LENGTH and isnad_codes.is_signed(code)
+    assert isnad_codes.user_id(code) == 6123456789
+    # Pasted with stray spaces or in lower case
+    assert isnad_codes.user_id(" " + code.lower() + "\n") == 6123456789
+
+
+def test_tampered_and_foreign_codes_are_rejected(monkeypatch):
+    code = isnad_codes.sign(42)
+    tampered = code[:-1] + ("A" if code[-1] != "A" else "B")
+    assert isnad_codes.user_id(tampered) is None
+    assert isnad_codes.user_id(code[:-1]) is None
+    assert isnad_codes.user_id("I1" + "!" * 24) is None
+    # An old-format code is not signed, and is looked up instead
+    assert not isnad_codes.is_signed("dxvmfcUsT") and isnad_codes.user_id("dxvmfcUsT") is None
+    # Another key does not accept it
+    monkeypatch.setenv("ISNAD_CODE_SECRET", "another-secret")
+    isnad_codes._secret.cache_clear()
+    assert isnad_codes.user_id(code) is None
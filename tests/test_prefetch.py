@@ -0,0 +1,49 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prefetch import Prefetcher, Reservations
+
+
+def test_holds_are_skipped_by_other_users():
+    reservations = Reservations()
+    assert reservations.hold([1, 2], owner="a", ttl=60) == [1, 2]
+    assert reservations.hold([2, 3], owner="b", ttl=60) == [3]
+    assert reservations.free([1, 2, 3, 4], owner="a") == [1, 2, 4]
+    # A prefetch skips the holds of the user's own click as well
+    assert reservations.free([1, 2, 3, 4]) == [4]
+
+
+def test_clicks_take_over_prefetch_holds():
+    reservations = Reservations()
+    reservations.hold([1, 2], owner="a", ttl=60, prefetched=True)
+    assert reservations.prefetched_count() == 2
+    assert reservations.free([1, 2], owner="b") == []
+    assert reservations.free([1, 2], owner="b", take_prefetched=True) == [1, 2]
+    assert reservations.hold([1], owner="b", ttl=60, take_prefetched=True) == [1]
+    assert reservations.prefetched_count() == 1
+    # Only the owner's release drops a hold
+    reservations.release([1, 2], owner="a")
+    assert reservations.free([1, 2], owner="c") == [2]
+
+
+def test_holds_expire():
+    reservations = Reservations()
+    reservations.hold([1], owner="a", ttl=0.01, prefetched=True)
+    reservations.hold([2], owner="a", ttl=60)
+    time.sleep(0.02)
+    assert reservations.free([1, 2], owner="b") == [1]
+    assert reservations.prefetched_count() == 0
+    assert len(reservations) == 1
+
+
+def test_prefetched_bundle_is_taken_once():
+    released = []
+    prefetcher = Prefetcher(prepare=lambda user_id: {"user_id": user_id}, release=released.append, ttl=60)
+    prefetcher._prefetch(7)
+    assert prefetcher.take(7) == {"user_id": 7}
+    assert prefetcher.take(7) is None
+    assert prefetcher.stats()["hits"] == 1 and prefetcher.stats()["misses"] == 1
+    assert released == []
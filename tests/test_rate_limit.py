@@ -0,0 +1,46 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rate_limit import ALL_ENDPOINTS, RateLimiter, TokenBucket
+
+
+def test_bucket_refills_over_its_window():
+    bucket = TokenBucket(2, 0.2)
+    assert bucket.consume()[0] and bucket.consume()[0]
+    allowed, wait = bucket.consume()
+    assert not allowed and 0 < wait <= 0.1
+    time.sleep(wait + 0.01)
+    assert bucket.consume()[0]
+
+
+def test_limits_per_key_and_endpoint():
+    limits = {("partner", "/tasks/"): (1, 60), ("partner", ALL_ENDPOINTS): (3, 60)}
+    limiter = RateLimiter(loader=lambda: limits, default_limit=(2, 60))
+    assert limiter.hit("partner", "/tasks/")[:3] == (True, 1, 0)
+    allowed, limit, remaining, retry_after = limiter.hit("partner", "/tasks/")
+    assert (allowed, limit, remaining) == (False, 1, 0) and retry_after == 60
+    # The key's limit for every other endpoint, each with its own bucket
+    assert [limiter.hit("partner", "/accounts/")[0] for _ in range(4)] == [True, True, True, False]
+    # Other keys get the default
+    assert [limiter.hit("other", "/tasks/")[0] for _ in range(3)] == [True, True, False]
+    usage = limiter.usage("partner")["partner"]
+    assert usage["/tasks/"]["allowed"] == 1 and usage["/tasks/"]["limited"] == 1
+
+
+def test_changed_limit_applies_on_reload():
+    limits = {}
+    limiter = RateLimiter(loader=lambda: dict(limits), default_limit=(1, 60))
+    assert limiter.hit("partner", "/tasks/")[0]
+    assert not limiter.hit("partner", "/tasks/")[0]
+    limits[("partner", ALL_ENDPOINTS)] = (5, 60)
+    limiter.reload()
+    assert limiter.hit("partner", "/tasks/")[:2] == (True, 5)
+
+
+def test_disabled_limiter_only_counts():
+    limiter = RateLimiter(default_limit=(1, 60), enabled=False)
+    assert all(limiter.hit("partner", "/tasks/")[0] for _ in range(5))
+    assert limiter.usage()["partner"]["/tasks/"]["allowed"] == 5
@@ -0,0 +1,27 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search import AccountSearchIndex
+
+
+def accounts(*rows):
+    return lambda: [(name, link, "1", "1") for name, link in rows]
+
+
+def test_fuzzy_search_with_duplicate_keys():
+    # Two accounts with the same name, and a name equal to another account's handle
+    index = AccountSearchIndex(accounts(("foo", None), ("foo", None), ("bar", "https://x.com/foo"),
+                                        ("foobarbaz", None)))
+    results = index.search("foobarbax")
+    assert [result["account_name"] for result in results] == ["foobarbaz"]
+    assert results[0]["match"] == "fuzzy"
+
+
+def test_duplicate_keys_are_all_found():
+    index = AccountSearchIndex(accounts(("foo", None), ("foo", None), ("bar", "https://x.com/foo")))
+    results = index.search("foo")
+    assert len(results) == 3
+    assert {result["match"] for result in results} == {"exact"}
+    assert len(index.search("fooo", max_typos=1)) == 3
@@ -0,0 +1,60 @@
+import os
+import random
+import sys
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from task_sampler import AliasTable, TaskSampler
+
+
+def test_alias_table_follows_the_weights():
+    rng = random.Random(1)
+    table = AliasTable([1, 3, 0, 6])
+    draws = Counter(table.draw(rng) for _ in range(50_000))
+    assert draws[2] == 0
+    assert abs(draws[1] / 50_000 - 0.3) < 0.02
+    assert abs(draws[3] / 50_000 - 0.6) < 0.02
+
+
+def test_user_gets_every_task_of_the_batch_once():
+    rows = [(task_id, 1 + task_id % 3, 0) for task_id in range(1, 41)]
+    sampler = TaskSampler(lambda batch_id: rows, rng=random.Random(2))
+    done = []
+    while True:
+        task_id = sampler.pick("b1", user_id=7)
+        if task_id is None:
+            break
+        assert task_id not in done
+        sampler.record_serve("b1", task_id, user_id=7)
+        done.append(task_id)
+    assert sorted(done) == list(range(1, 41))
+    # Another user starts from the whole batch
+    assert sampler.pick("b1", user_id=8) is not None
+
+
+def test_remaining_tasks_are_listed_once_per_user():
+    rows = [(task_id, 1, 0) for task_id in range(1, 101)]
+    sampler = TaskSampler(lambda batch_id: rows, rng=random.Random(3))
+    for task_id in range(1, 61):
+        sampler.record_serve("b1", task_id, user_id=7)
+    assert sampler.pick("b1", user_id=7) > 60
+    remaining = sampler._users[7].remaining
+    assert remaining is not None and len(remaining.task_ids) == 40
+    sampler.record_serve("b1", 61, user_id=7)
+    assert sampler.pick("b1", user_id=7) > 61
+    assert sampler._users[7].remaining is remaining and len(remaining.task_ids) == 39
+    # A new batch starts over
+    sampler.record_serve("b2", 1, user_id=7)
+    assert sampler._users[7].done == {1}
+
+
+def test_priorities_and_serves_drive_the_picks():
+    rows = [(1, 1, 0), (2, 3, 0)]
+    sampler = TaskSampler(lambda batch_id: rows, rng=random.Random(4))
+    picks = Counter()
+    for _ in range(4000):
+        task_id = sampler.pick("b1")
+        sampler.record_serve("b1", task_id)
+        picks[task_id] += 1
+    assert abs(picks[2] / picks[1] - 3) < 0.2
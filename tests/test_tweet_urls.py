@@ -0,0 +1,25 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tweet_urls import tweet_id, tweet_url
+
+
+def test_every_form_of_a_tweet_link_gives_its_id():
+    for url in ["https://twitter.com/someone/status/1790000000000000000?s=20",
+                "x.com/someone/status/1790000000000000000/photo/1",
+                "https://mobile.twitter.com/i/web/status/1790000000000000000",
+                "https://www.x.com/i/status/1790000000000000000",
+                "  HTTPS://X.COM/someone/statuses/1790000000000000000  ",
+                "1790000000000000000",
+                1790000000000000000]:
+        assert tweet_id(url) == 1790000000000000000, url
+    assert tweet_url(1790000000000000000) == "https://x.com/i/status/1790000000000000000"
+
+
+def test_links_that_are_not_tweets_have_no_id():
+    for url in [None, "", "   ", "https://example.com/someone/status/1", "https://x.com/someone",
+                "https://x.com/someone/status/", "https://x.com/someone/status/99999999999999999999",
+                "0", -5, "not a link"]:
+        assert tweet_id(url) is None, url
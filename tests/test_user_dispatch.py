@@ -0,0 +1,54 @@
+import os
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from user_dispatch import UserOrderedExecutor
+
+
+def update_of(user_id, n):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id), n=n)
+
+
+def test_updates_of_a_user_are_handled_in_order():
+    executor = UserOrderedExecutor(workers=4)
+    handled = {1: [], 2: [], 3: []}
+    active = set()
+
+    def handler(update, context):
+        user_id = update.effective_user.id
+        assert user_id not in active
+        active.add(user_id)
+        time.sleep(0.001)
+        handled[user_id].append(update.n)
+        active.discard(user_id)
+
+    wrapper = executor.ordered(handler)
+    for n in range(30):
+        for user_id in handled:
+            wrapper(update_of(user_id, n), None)
+    assert executor.join(timeout=10)
+    assert all(numbers == list(range(30)) for numbers in handled.values())
+    assert executor.stats()["handled"] == 90 and executor.oldest_wait() == 0.0
+
+
+def test_oldest_wait_follows_the_waiting_updates():
+    executor = UserOrderedExecutor(workers=1)
+    release = threading.Event()
+    executor.submit(1, release.wait)
+    time.sleep(0.05)
+    # The update being handled is not waiting
+    assert executor.oldest_wait() == 0.0
+    executor.submit(2, lambda: None)
+    time.sleep(0.05)
+    executor.submit(3, lambda: None)
+    assert 0.04 < executor.oldest_wait() < 1
+    # Dropping the oldest waiting update leaves the next one
+    assert executor.drop_waiting(2, lambda *args: True) == [()]
+    assert executor.oldest_wait() < 0.04
+    release.set()
+    assert executor.join(timeout=5)
+    assert executor.oldest_wait() == 0.0 and not executor._left
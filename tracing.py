@@ -0,0 +1,295 @@
+"""
+Request tracing for the Isnad bot.
+
+Spans are exported to a local file in the Chrome Trace Event format (JSON array
+form), which opens directly in https://ui.perfetto.dev or chrome://tracing.
+Every span carries the update id and user id of the Telegram update that
+caused it, so a single click can be followed from the dispatcher queue through
+the DB queries down to the Bot API sends.
+
+Tracing is off unless `ISNAD_TRACING=1`: it records every SQL statement of
+every update, which is meant for a profiling session, not for running in
+production all the time. The trace file rotates at `TRACE_MAX_BYTES`, keeping
+`TRACE_BACKUP_COUNT` old files.
+
+Run `python tracing.py [trace_file]` to print p50/p95 per stage for each kind
+of update (`/start`, `option1`, `option2`).
+"""
+import contextvars
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from queue import Empty, Queue
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+TRACING_ENABLED = os.getenv("ISNAD_TRACING", "0") == "1"
+TRACE_FILE = os.getenv("ISNAD_TRACE_FILE", "isnad_traces.json")
+TRACE_MAX_BYTES = 1024 * 1024 * 50
+TRACE_BACKUP_COUNT = 3
+
+# The trace context of the update currently being handled in this thread.
+_current_trace = contextvars.ContextVar("isnad_current_trace", default=None)
+
+
+class TimedQueue(Queue):
+    """
+    Update queue that remembers when each update was put on it, so the time an
+    update spends waiting for the dispatcher can be measured.
+
+    `listeners` are called with `(update, enqueued_at)` for every incoming update.
+    """
+
+    def __init__(self, maxsize=0, max_tracked=10_000):
+        super().__init__(maxsize)
+        self.max_tracked = max_tracked
+        self.listeners = []
+        self._enqueued_at = OrderedDict()
+        self._stamps_lock = threading.Lock()
+
+    def put(self, item, block=True, timeout=None):
+        update_id = getattr(item, "update_id", None)
+        if update_id is not None:
+            enqueued_at = time.time()
+            with self._stamps_lock:
+                self._enqueued_at[update_id] = enqueued_at
+                # Updates that are never handled must not leak memory
+                while len(self._enqueued_at) > self.max_tracked:
+                    self._enqueued_at.popitem(last=False)
+            for listener in self.listeners:
+                listener(item, enqueued_at)
+        super().put(item, block, timeout)
+
+    def pop_enqueued_at(self, update_id):
+        with self._stamps_lock:
+            return self._enqueued_at.pop(update_id, None)
+
+
+class FileSpanExporter:
+    """
+    Writes finished spans to a rotating trace file from a background thread, so
+    handlers never wait on disk I/O.
+    """
+
+    def __init__(self, path, max_bytes=TRACE_MAX_BYTES, backup_count=TRACE_BACKUP_COUNT):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._queue = Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def export(self, event_data):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="isnad-trace-exporter", daemon=True)
+                    self._thread.start()
+        self._queue.put(event_data)
+
+    def flush(self, timeout=5.0):
+        deadline = time.time() + timeout
+        while self._thread is not None and self._queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.01)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < 500:
+                    batch.append(self._queue.get_nowait())
+            except Empty:
+                pass
+            try:
+                self._write(batch)
+            except OSError as e:
+                print(f"Trace export failed: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, batch):
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+            self._rotate()
+        is_new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, "a", encoding="utf-8") as file:
+            # The trace event format allows the closing bracket to be omitted,
+            # which lets us append to the array forever.
+            if is_new_file:
+                file.write("[\n")
+            for event_data in batch:
+                file.write(json.dumps(event_data, ensure_ascii=False) + ",\n")
+
+    def _rotate(self):
+        for i in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{i}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+
+exporter = FileSpanExporter(TRACE_FILE)
+
+
+def _emit(name, start, end, attrs):
+    trace = _current_trace.get()
+    # Work done outside of an update (API requests, startup) is not traced
+    if trace is None:
+        return
+    args = dict(trace)
+    args.update(attrs)
+    exporter.export({
+        "name": name,
+        "cat": "isnad",
+        "ph": "X",
+        "ts": int(start * 1_000_000),
+        "dur": max(int((end - start) * 1_000_000), 0),
+        "pid": os.getpid(),
+        "tid": threading.get_ident(),
+        "args": args,
+    })
+
+
+@contextmanager
+def span(name, **attrs):
+    """Time the wrapped block as a span of the current trace."""
+    if not TRACING_ENABLED:
+        yield attrs
+        return
+    start = time.time()
+    try:
+        yield attrs
+    finally:
+        _emit(name, start, time.time(), attrs)
+
+
+def annotate(**attrs):
+    """Attach extra attributes (e.g. the served task id) to the current trace."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.update(attrs)
+
+
+def traced_handler(func):
+    """
+    Wrap a telegram handler so the whole update becomes one trace: a root span
+    named after the handler (and the callback data for button clicks), plus the
+    time the update spent waiting in the dispatcher queue.
+    """
+    @functools.wraps(func)
+    def wrapper(update, context):
+        if not TRACING_ENABLED:
+            return func(update, context)
+
+        started_at = time.time()
+        name = func.__name__
+        if update.callback_query is not None:
+            name = f"{name}:{update.callback_query.data}"
+        trace = {
+            "trace_id": uuid.uuid4().hex,
+            "update_id": update.update_id,
+            "user_id": update.effective_user.id if update.effective_user else None,
+            "handler": name,
+        }
+        token = _current_trace.set(trace)
+        try:
+            update_queue = getattr(context.dispatcher, "update_queue", None)
+            if isinstance(update_queue, TimedQueue):
+                enqueued_at = update_queue.pop_enqueued_at(update.update_id)
+                if enqueued_at is not None:
+                    _emit("dispatcher.queue", enqueued_at, started_at, {})
+            with span(name):
+                return func(update, context)
+        finally:
+            _current_trace.reset(token)
+
+    return wrapper
+
+
+class TracedSession(Session):
+    """Session that records each commit as a span."""
+
+    def commit(self):
+        with span("db.commit"):
+            super().commit()
+
+
+def instrument_engine(engine):
+    """Record every SQL statement executed on `engine` while handling an update as a span."""
+    if not TRACING_ENABLED:
+        return
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("isnad_query_start", []).append(time.time())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info["isnad_query_start"].pop()
+        verb = statement.lstrip().split(" ", 1)[0].upper()
+        _emit(f"db.{verb}", start, time.time(), {"statement": statement[:200]})
+
+
+def load_trace_file(path):
+    with open(path, "r", encoding="utf-8") as file:
+        content = file.read().strip().rstrip(",")
+    if not content:
+        return []
+    if not content.endswith("]"):
+        content += "]"
+    return json.loads(content)
+
+
+def _percentile(values, percent):
+    ordered = sorted(values)
+    index = min(int(round(percent / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def summarize(events):
+    """
+    Group spans by trace, and report p50/p95 (in ms) of each stage for every
+    handler kind. Stage durations are summed per trace, so a stage that runs
+    four times in one click counts as its total.
+    """
+    traces = defaultdict(lambda: defaultdict(float))
+    handlers = {}
+    for event_data in events:
+        args = event_data.get("args", {})
+        trace_id = args.get("trace_id")
+        if not trace_id:
+            continue
+        traces[trace_id][event_data["name"]] += event_data["dur"] / 1000
+        handlers[trace_id] = args.get("handler")
+
+    report = defaultdict(lambda: defaultdict(list))
+    for trace_id, stages in traces.items():
+        for stage, duration in stages.items():
+            report[handlers[trace_id]][stage].append(duration)
+
+    summary = {}
+    for handler_name, stages in report.items():
+        summary[handler_name] = {
+            stage: {
+                "count": len(durations),
+                "p50_ms": round(_percentile(durations, 50), 3),
+                "p95_ms": round(_percentile(durations, 95), 3),
+            }
+            for stage, durations in stages.items()
+        }
+    return summary
+
+
+if __name__ == "__main__":
+    trace_file = sys.argv[1] if len(sys.argv) > 1 else TRACE_FILE
+    for handler_name, stages in sorted(summarize(load_trace_file(trace_file)).items(), key=lambda item: str(item[0])):
+        print(f"\n{handler_name}")
+        for stage, stats in sorted(stages.items(), key=lambda item: -item[1]["p95_ms"]):
+            print(f"  {stage:<28} n={stats['count']:<7} p50={stats['p50_ms']:>9.3f}ms  p95={stats['p95_ms']:>9.3f}ms")
@@ -0,0 +1,42 @@
+"""
+Tweet URL normalisation.
+
+`https://twitter.com/someone/status/1790000000000000000?s=20`,
+`x.com/someone/status/1790000000000000000/photo/1` and
+`https://mobile.twitter.com/i/web/status/1790000000000000000` are all the same
+tweet: tasks store just its id, and the link is rebuilt when it is shown.
+"""
+import re
+from urllib.parse import urlparse
+
+TWEET_HOSTS = {"x.com", "twitter.com", "mobile.twitter.com", "mobile.x.com", "fxtwitter.com", "vxtwitter.com",
+               "fixupx.com"}
+# /<user>/status/<id>, /i/web/status/<id>, /i/status/<id>, with anything after the id (/photo/1, /analytics, ...)
+STATUS_PATH = re.compile(r"^/(?:[^/]+/|i/web/|i/)?status(?:es)?/(\d{1,19})(?:/.*)?$")
+MAX_TWEET_ID = 2 ** 63 - 1
+
+
+def tweet_id(url):
+    """The id of the tweet `url` points to, or None if it is not a tweet URL."""
+    if url is None:
+        return None
+    if isinstance(url, int) and 0 < url <= MAX_TWEET_ID:
+        # A bare id typed into the sheet
+        return url
+    url = str(url).strip()
+    if url.isdigit():
+        return int(url) if 0 < int(url) <= MAX_TWEET_ID else None
+    parsed = urlparse(url if "//" in url else "//" + url)
+    host = (parsed.hostname or "").lower()
+    if host.startswith("www."):
+        host = host[4:]
+    if host not in TWEET_HOSTS:
+        return None
+    match = STATUS_PATH.match(parsed.path)
+    if not match or int(match.group(1)) > MAX_TWEET_ID:
+        return None
+    return int(match.group(1))
+
+
+def tweet_url(tweet_id):
+    return f"https://x.com/i/status/{tweet_id}"
@@ -0,0 +1,197 @@
+"""
+Scheduling of outbound Twitter requests inside the rate window of each operation.
+
+Twitter allows `constants.MAX_ENDPOINT_LIMIT` requests per 15 minutes per
+GraphQL operation. The scheduler keeps, per operation, the send times of the
+last 15 minutes (a sliding window) and a priority queue of requests waiting for
+a slot: a request goes out as soon as the window has room and nothing more
+urgent is waiting, so a bulk check runs at the full published rate and never
+over it.
+
+Interactive lookups (a user waiting on an answer) go before background
+refreshes, and background requests leave `interactive_reserve` slots of every
+window free, so an interactive lookup never waits behind a 15-minute backlog.
+When Twitter reports a lower budget than ours (`x-rate-limit-*` headers, or a
+429), the window is closed until its reset.
+"""
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+
+from constants import MAX_ENDPOINT_LIMIT
+
+WINDOW_SECONDS = 15 * 60
+INTERACTIVE_RESERVE = 50
+
+# Priorities, lower goes first
+INTERACTIVE = 0
+BACKGROUND = 10
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+
+class OperationWindow:
+    def __init__(self, limit, window_seconds):
+        self.limit = limit
+        self.window_seconds = window_seconds
+        self.sent = deque()
+        # heap of (priority, sequence, loop, future)
+        self.waiting = []
+        self.blocked_until = 0.0
+        self.granted = 0
+
+    def expire(self, now):
+        while self.sent and self.sent[0] <= now - self.window_seconds:
+            self.sent.popleft()
+
+    def capacity(self, priority, reserve):
+        return self.limit - (reserve if priority > INTERACTIVE else 0)
+
+    def free_at(self, now):
+        """When each of the `limit` slots is next free, earliest first."""
+        free = [now] * (self.limit - len(self.sent)) + [sent + self.window_seconds for sent in self.sent]
+        return [max(at, self.blocked_until) for at in free]
+
+
+class RequestScheduler:
+    """
+    - **limit**: requests allowed per operation and window.
+    - **interactive_reserve**: slots of every window that only interactive requests may use.
+    """
+
+    def __init__(self, limit=MAX_ENDPOINT_LIMIT, window_seconds=WINDOW_SECONDS,
+                 interactive_reserve=INTERACTIVE_RESERVE, clock=time.monotonic):
+        self.limit = limit
+        self.window_seconds = window_seconds
+        self.interactive_reserve = min(interactive_reserve, limit - 1)
+        self.clock = clock
+        self._windows = {}
+        self._sequence = itertools.count()
+        # Waiters may sit on different event loops (the API's and the refresh job's), so
+        # the state is guarded by a thread lock and futures are resolved thread-safely
+        self._lock = threading.Lock()
+
+    def _window(self, operation):
+        window = self._windows.get(operation)
+        if window is None:
+            window = self._windows[operation] = OperationWindow(self.limit, self.window_seconds)
+        return window
+
+    def _dispatch(self, window, now):
+        """Grant slots to the waiters at the head of the queue while the window has room."""
+        window.expire(now)
+        while window.waiting and now >= window.blocked_until:
+            priority, _, loop, future = window.waiting[0]
+            if future.done():
+                heapq.heappop(window.waiting)
+                continue
+            if len(window.sent) >= window.capacity(priority, self.interactive_reserve):
+                break
+            heapq.heappop(window.waiting)
+            window.sent.append(now)
+            window.granted += 1
+            loop.call_soon_threadsafe(_grant, future)
+
+    def _next_change(self, window, now):
+        """Seconds until the window might have room again."""
+        if now < window.blocked_until:
+            return window.blocked_until - now
+        if window.sent:
+            return max(window.sent[0] + self.window_seconds - now, 0.001)
+        return None
+
+    async def acquire(self, operation, priority=INTERACTIVE):
+        """Wait until a request of `operation` may be sent, then count it as sent."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            window = self._window(operation)
+            heapq.heappush(window.waiting, (priority, next(self._sequence), loop, future))
+            self._dispatch(window, self.clock())
+        try:
+            while True:
+                with self._lock:
+                    delay = None if future.done() else self._next_change(window, self.clock())
+                try:
+                    await asyncio.wait_for(asyncio.shield(future), delay)
+                    return
+                except asyncio.TimeoutError:
+                    with self._lock:
+                        self._dispatch(window, self.clock())
+        except asyncio.CancelledError:
+            future.cancel()
+            with self._lock:
+                self._dispatch(window, self.clock())
+            raise
+
+    def observe(self, operation, remaining=None, reset_at=None, retry_after=None):
+        """
+        Take in what Twitter says about the budget left: `x-rate-limit-remaining` and
+        `x-rate-limit-reset` (epoch seconds), or the `Retry-After` of a 429.
+        """
+        now = self.clock()
+        with self._lock:
+            window = self._window(operation)
+            if retry_after is not None:
+                window.blocked_until = max(window.blocked_until, now + retry_after)
+            elif remaining is not None and reset_at is not None:
+                window.expire(now)
+                if remaining <= 0:
+                    window.blocked_until = max(window.blocked_until, now + max(reset_at - time.time(), 0))
+                else:
+                    # Twitter counts requests we did not see (other clients on the same account)
+                    while self.limit - len(window.sent) > remaining:
+                        window.sent.append(now)
+
+    def status(self, operation=None):
+        """
+        Budget of every operation: requests sent in the current window, remaining,
+        queued by priority, and the seconds until everything queued has gone out.
+        """
+        now = self.clock()
+        with self._lock:
+            operations = [operation] if operation else sorted(self._windows)
+            return {name: self._status(self._window(name), now) for name in operations}
+
+    def _status(self, window, now):
+        window.expire(now)
+        queued = sorted((priority, sequence) for priority, sequence, _, future in window.waiting
+                        if not future.done())
+        by_priority = {}
+        for priority, _ in queued:
+            name = PRIORITY_NAMES.get(priority, str(priority))
+            by_priority[name] = by_priority.get(name, 0) + 1
+        return {
+            "limit": window.limit,
+            "window_seconds": window.window_seconds,
+            "used": len(window.sent),
+            "remaining": max(window.limit - len(window.sent), 0) if now >= window.blocked_until else 0,
+            "blocked_for_seconds": round(max(window.blocked_until - now, 0), 1),
+            "queued": by_priority,
+            "drain_seconds": round(self._drain_time(window, [priority for priority, _ in queued], now), 1),
+            "sent_total": window.granted,
+        }
+
+    def _drain_time(self, window, queued, now):
+        """
+        Estimate of when the last queued request goes out: the i-th one takes the
+        i-th slot to free up, recurring every window (background requests cannot
+        take the reserved slots).
+        """
+        if not queued:
+            return 0.0
+        free_at = window.free_at(now)
+        last = now
+        for position, priority in enumerate(queued):
+            reserve = self.interactive_reserve if priority > INTERACTIVE else 0
+            slots = window.limit - reserve
+            cycle, index = divmod(position, slots)
+            last = max(last, free_at[reserve + index] + cycle * window.window_seconds)
+        return last - now
+
+
+def _grant(future):
+    if not future.done():
+        future.set_result(None)
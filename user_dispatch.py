@@ -0,0 +1,228 @@
+"""
+Concurrent handling of Telegram updates, in order for every user.
+
+The dispatcher of python-telegram-bot runs the handlers one update at a time,
+so one slow Bot API call holds every other user up. Its `run_async` handlers
+run on a thread pool instead, but then two updates of the same user can be
+handled at the same time, or the wrong way round.
+
+`UserOrderedExecutor` runs the handlers on `DISPATCH_WORKERS` threads with one
+queue per user: updates of different users are handled in parallel, the
+updates of a user one after the other and in the order they came. Users take
+turns, so a user tapping away does not hold the workers to themselves. The
+dispatcher thread only puts updates in the queues: register a handler wrapped
+in `ordered(handler)`. An `admission` callable, if set, is asked first whether an
+update is to be queued at all (see load_shedding.py), then the `guard` of the
+handler, if any, which answers repeated taps there instead (see callback_guard.py).
+
+The age of the oldest waiting update, which the load shedding reads on every
+update, is kept up to date as updates come and go rather than looked for in
+every queue.
+"""
+import functools
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+DISPATCH_WORKERS = int(os.getenv("ISNAD_DISPATCH_WORKERS", "8"))
+UTILISATION_WINDOW = 60
+RECENT_WAITS = 1000
+
+logger = logging.getLogger(__name__)
+
+
+class UserOrderedExecutor:
+    def __init__(self, workers=DISPATCH_WORKERS):
+        self.workers = max(workers, 1)
+        # Called with `(update, context)` once an update has been handled by an `ordered` handler
+        self.listeners = []
+        # `admission(update, context)` returns False for the updates not to queue
+        self.admission = None
+        # key -> updates of the user not handled yet, the one being handled included
+        self._queues = {}
+        # Users with updates waiting and none being handled
+        self._ready = deque()
+        # Users with an update being handled
+        self._running = set()
+        # (enqueued_at, sequence) of the updates waiting for a worker, in the order they came: the
+        # first one is the oldest. Updates leaving out of order are only marked in `_left`, and
+        # dropped once they get to the front
+        self._waiting = deque()
+        self._left = set()
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._threads = []
+        self._depth = 0
+        self._busy = 0
+        # (finished_at, seconds busy) of the recent updates, for the utilisation
+        self._busy_periods = deque()
+        self._running_since = {}
+        self._waits = deque(maxlen=RECENT_WAITS)
+        self._created_at = time.monotonic()
+        self.handled = 0
+        self.failed = 0
+
+    def _start(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name=f"update-worker-{len(self._threads)}", daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def submit(self, key, function, *args):
+        """Run `function(*args)` after the updates of `key` submitted before."""
+        with self._condition:
+            self._start()
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = deque()
+                self._ready.append(key)
+                self._condition.notify()
+            enqueued_at, sequence = time.monotonic(), next(self._sequence)
+            queue.append((enqueued_at, sequence, function, args))
+            self._waiting.append((enqueued_at, sequence))
+            self._depth += 1
+
+    def ordered(self, handler, guard=None):
+        """
+        A handler that queues the update for `handler`, behind the earlier updates of the same user.
+        With a `CallbackGuard`, repeated taps are answered by the guard and not queued.
+        """
+        @functools.wraps(handler)
+        def wrapper(update, context):
+            if self.admission is not None and not self.admission(update, context):
+                return
+            if guard is not None and not guard.admit(update):
+                return
+            user = update.effective_user
+            self.submit(user.id if user else None, self._handle, handler, update, context, guard)
+        return wrapper
+
+    def _handle(self, handler, update, context, guard=None):
+        answer = None
+        try:
+            answer = handler(update, context)
+        except Exception as e:
+            # What the dispatcher would have done, had it run the handler itself
+            dispatcher = getattr(context, "dispatcher", None)
+            if dispatcher is None or not dispatcher.error_handlers:
+                raise
+            dispatcher.dispatch_error(update, e)
+        finally:
+            if guard is not None:
+                guard.finish(update, answer)
+            for listener in self.listeners:
+                listener(update, context)
+
+    def _work(self):
+        worker = threading.get_ident()
+        while True:
+            with self._condition:
+                while not self._ready:
+                    self._condition.wait()
+                key = self._ready.popleft()
+                self._running.add(key)
+                queue = self._queues[key]
+                enqueued_at, sequence, function, args = queue[0]
+                self._leave(sequence)
+                self._depth -= 1
+                self._busy += 1
+                started = self._running_since[worker] = time.monotonic()
+                self._waits.append(started - enqueued_at)
+            try:
+                function(*args)
+            except Exception:
+                self.failed += 1
+                logger.exception(f"Update of {key} failed")
+            finally:
+                finished = time.monotonic()
+                with self._condition:
+                    queue.popleft()
+                    self._running.discard(key)
+                    if queue:
+                        # The user's next update, after the users already waiting
+                        self._ready.append(key)
+                    else:
+                        del self._queues[key]
+                    self._busy -= 1
+                    self.handled += 1
+                    del self._running_since[worker]
+                    self._busy_periods.append((finished, finished - started))
+                    while self._busy_periods and self._busy_periods[0][0] < finished - UTILISATION_WINDOW:
+                        self._busy_periods.popleft()
+                    self._condition.notify_all()
+
+    def drop_waiting(self, key, predicate):
+        """
+        Take the updates of `key` waiting for a worker for which `predicate(*args)` holds
+        out of the queue (not the one being handled); returns their `args`.
+        """
+        with self._condition:
+            queue = self._queues.get(key)
+            if not queue:
+                return []
+            running = [queue.popleft()] if key in self._running else []
+            dropped = [item for item in queue if predicate(*item[3])]
+            kept = running + [item for item in queue if not predicate(*item[3])]
+            queue.clear()
+            queue.extend(kept)
+            self._depth -= len(dropped)
+            for _, sequence, _, _ in dropped:
+                self._leave(sequence)
+            if not queue:
+                del self._queues[key]
+                self._ready.remove(key)
+            self._condition.notify_all()
+        return [args for _, _, _, args in dropped]
+
+    def _leave(self, sequence):
+        """An update stops waiting for a worker; under the condition."""
+        self._left.add(sequence)
+        while self._waiting and self._waiting[0][1] in self._left:
+            self._left.remove(self._waiting.popleft()[1])
+
+    def join(self, timeout=None):
+        """Wait until every submitted update has been handled; returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._queues:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    @property
+    def queue_depth(self):
+        """Updates waiting for a worker."""
+        return self._depth
+
+    def oldest_wait(self):
+        """Seconds the longest waiting update has been waiting for a worker."""
+        with self._condition:
+            return time.monotonic() - self._waiting[0][0] if self._waiting else 0.0
+
+    def stats(self):
+        now = time.monotonic()
+        with self._condition:
+            busy_seconds = sum(min(seconds, UTILISATION_WINDOW - (now - finished))
+                               for finished, seconds in self._busy_periods if now - finished < UTILISATION_WINDOW)
+            busy_seconds += sum(min(now - started, UTILISATION_WINDOW) for started in self._running_since.values())
+            # Over the uptime, until it reaches the window
+            window = max(min(UTILISATION_WINDOW, now - self._created_at), 0.001)
+            waits = sorted(self._waits)
+            stats = {
+                "workers": self.workers,
+                "busy_workers": self._busy,
+                "utilisation": round(min(busy_seconds / (self.workers * window), 1.0), 3),
+                "queue_depth": self._depth,
+                "queued_users": len(self._ready),
+                "handled": self.handled,
+                "failed": self.failed,
+                "queue_wait_p50_ms": round(waits[len(waits) // 2] * 1000, 1) if waits else 0.0,
+                "queue_wait_p95_ms": round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else 0.0,
+            }
+        stats["oldest_wait_seconds"] = round(self.oldest_wait(), 3)
+        return stats